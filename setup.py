@@ -39,7 +39,8 @@ setup(
     license='MIT',
     packages=find_packages('src'),
     package_dir={'': 'src'},
-    install_requires=['tdigest'],
+    install_requires=[],
+    extras_require={'orjson': ['orjson'], 'ujson': ['ujson']},
     tests_require=['tdigest'],
     include_package_data=True,
     zip_safe=False
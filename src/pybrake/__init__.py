@@ -1,5 +1,6 @@
 from . import middleware
 from .notifier import Notifier
+from .circuit import CircuitOpenError
 from .logging import LoggingHandler
 from .constant import version as __version__
 from .route_metric import RouteMetric, RouteBreakdowns
@@ -0,0 +1,266 @@
+import os
+import socket
+import threading
+import time
+
+from . import constant
+from . import metrics
+from .backlog import merge_payloads
+from .utils import logger
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# Payloads are sent in one datagram. Larger payloads are sent to Airbrake
+# by the worker itself.
+_MAX_DATAGRAM = 4 * 1024 * 1024
+_SOCKET_BUFFER = 8 * 1024 * 1024
+
+OWNER = "owner"
+CLIENT = "client"
+
+
+class Aggregator:
+    """
+    Aggregator merges the route, breakdown, query and queue stats of the
+    worker processes of a pre-fork server (gunicorn, uwsgi), so Airbrake
+    receives one payload per endpoint per flush instead of one per worker.
+
+    Every worker creates an Aggregator with the same socket path. The first
+    worker that flushes takes a lock on path + ".lock" and becomes the
+    owner: it binds a Unix datagram socket at path, merges the payloads it
+    receives with its own (counters summed, t-digests merged) and sends
+    them every flush period. The other workers send their encoded payloads
+    to the socket. If the owner exits, the next worker that flushes takes
+    over. When the socket can't be used the worker sends its payloads to
+    Airbrake itself.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, path, *, headers=None, transport=None,
+                 backpressure=None, flush_period=None):
+        self._path = path
+        self._headers = headers
+        self._transport = transport
+        self._backpressure = backpressure
+        self._flush_period = flush_period or constant.FLUSH_PERIOD
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        # Payloads that couldn't be merged with the pending one of their url.
+        self._unmerged = []
+        self._pid = None
+        self._role = None
+        self._lock_file = None
+        self._sock = None
+        self._thread = None
+
+        self.received = 0
+        self.sent = 0
+
+    @property
+    def role(self):
+        return self._role
+
+    def submit(self, url, payload):
+        """
+        Hands an encoded payload to the aggregator. Returns False if it must
+        be sent to Airbrake by the caller.
+        """
+        if fcntl is None or not hasattr(socket, "AF_UNIX"):
+            return False
+
+        with self._lock:
+            self._elect()
+            role = self._role
+            if role == OWNER:
+                self._merge(url, payload)
+                return True
+            sock = self._sock
+
+        if sock is None:
+            return False
+        message = url.encode("utf8") + b"\n" + payload
+        if len(message) > _MAX_DATAGRAM:
+            return False
+        try:
+            sock.sendto(message, self._path)
+        except BlockingIOError:
+            # The receive buffer of the owner is full.
+            return False
+        except OSError as err:
+            logger.debug("pybrake: aggregator socket: %s", err)
+            return False
+        return True
+
+    def flush(self, timeout=None):  # pylint: disable=unused-argument
+        """
+        Sends the merged payloads if this process is the owner. Returns the
+        number of payloads that were dropped.
+        """
+        with self._lock:
+            pending = list(self._pending.items()) + self._unmerged
+            self._pending = {}
+            self._unmerged = []
+
+        dropped = 0
+        for url, payload in pending:
+            ok = metrics.send(
+                url=url, payload=payload, headers=self._headers,
+                method="POST", transport=self._transport,
+                backpressure=self._backpressure,
+            )
+            if ok:
+                self.sent += 1
+            elif ok is metrics.BACKLOGGED:
+                pass  # The backlog sends it later.
+            elif (self._backpressure is not None and
+                  self._backpressure.throttled(url)):
+                # Keep the payload until the endpoint accepts stats again.
+                with self._lock:
+                    self._merge(url, payload)
+            else:
+                dropped += 1
+        return dropped
+
+    def close(self):
+        with self._lock:
+            self._reset()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                role=self._role,
+                pending=len(self._pending) + len(self._unmerged),
+                received=self.received,
+                sent=self.sent,
+            )
+
+    def _elect(self):
+        if self._pid != os.getpid():
+            # The state was inherited from the parent of a forked worker.
+            # Closing the copies doesn't release the lock of the parent.
+            self._close_socket()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            self._thread = None
+            self._role = None
+            self._pending = {}
+            self._unmerged = []
+            self._pid = os.getpid()
+
+        if self._role == OWNER:
+            return
+        if self._take_lock():
+            self._serve()
+        elif self._role is None:
+            self._connect()
+
+    def _take_lock(self):
+        if self._lock_file is None:
+            try:
+                self._lock_file = open(  # pylint: disable=consider-using-with
+                    self._path + ".lock", "ab")
+            except OSError as err:
+                logger.error("pybrake: aggregator lock: %s", err)
+                return False
+        try:
+            fcntl.flock(self._lock_file.fileno(),
+                        fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _serve(self):
+        self._close_socket()
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            _SOCKET_BUFFER)
+            sock.bind(self._path)
+        except OSError as err:
+            logger.error("pybrake: aggregator socket: %s", err)
+            return
+
+        sock.settimeout(1)
+        self._sock = sock
+        self._role = OWNER
+        self._thread = threading.Thread(
+            target=self._run, args=(sock,), name="pybrake-aggregator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _connect(self):
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                            _SOCKET_BUFFER)
+        except OSError as err:
+            logger.error("pybrake: aggregator socket: %s", err)
+            return
+        # While the owner is busy sending, its receive buffer can fill up.
+        # Workers then send their payloads themselves instead of waiting.
+        sock.setblocking(False)
+        self._sock = sock
+        self._role = CLIENT
+
+    def _run(self, sock):
+        next_flush = time.monotonic() + self._flush_period
+        while self._sock is sock:
+            try:
+                message = sock.recv(_MAX_DATAGRAM)
+            except socket.timeout:
+                message = None
+            except OSError:
+                return
+
+            if message:
+                self._receive(message)
+            if time.monotonic() >= next_flush:
+                next_flush = time.monotonic() + self._flush_period
+                self.flush()
+
+    def _receive(self, message):
+        url, sep, payload = message.partition(b"\n")
+        if not sep:
+            logger.error("pybrake: aggregator: bad message")
+            return
+        with self._lock:
+            self.received += 1
+            self._merge(url.decode("utf8"), payload)
+
+    def _merge(self, url, payload):
+        prev = self._pending.get(url)
+        if prev is not None:
+            try:
+                payload = merge_payloads(prev, payload)
+            except (ValueError, KeyError, TypeError) as err:
+                logger.error(err)
+                self._unmerged.append((url, payload))
+                return
+        self._pending[url] = payload
+
+    def _close_socket(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
+
+    def _reset(self):
+        if self._role == OWNER:
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+        self._close_socket()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self._role = None
@@ -1,49 +1,276 @@
+import json
+import os
+import random
+import threading
 import time
 from collections import deque
-from threading import Timer
+from concurrent import futures
 
 from . import metrics
+from . import serializer
+from .constant import MaxRetryAttempt
+from .spool import Spool
+from .tdigest import merge_stat_dicts
+from .utils import logger
 
+_BASE_DELAY = 1
+_DEFAULT_MAX_PARALLEL = 4
+
+# Fields of route, breakdown, query and queue stats that are aggregated. The
+# other fields identify the stat, like route_stat_key and query_stat_key.
+_STAT_FIELDS = ("count", "sum", "sumsq", "tdigest", "groups", "spans")
+
+
+class Backlog:
+    """
+    Backlog retries stats and notices that failed to send. Every item is
+    scheduled with exponential backoff and jitter, starting at 1 second and
+    capped at interval seconds, and is dropped after max_attempts retries.
+    Retries rejected by an open circuit are not counted, and the item waits
+    until the circuit lets a request through. Items that are due are sent
+    concurrently by up to max_parallel threads.
+
+    Failed APM stats kept in memory are merged per endpoint: a newer payload
+    for the same url is folded into the queued one, so after an outage one
+    payload per endpoint is sent instead of one per failed flush. Items in a
+    spool are not merged, because its records can't be rewritten: every
+    failed flush is kept and sent as its own payload.
+    """
+
+    # pylint: disable=too-many-instance-attributes
 
-class Backlog(Timer):
     def __init__(self, method, header, interval=60, maxlen=100,
-                 error_notice=False, notifier=None, args=None, kwargs=None):
-        super().__init__(interval, self.send, args, kwargs)
-        self._backlog = deque(maxlen=maxlen)
+                 error_notice=False, notifier=None, transport=None,
+                 spool=None, max_attempts=None, max_parallel=None):
+        # pylint: disable=too-many-arguments
+        self.interval = interval
+        # A spool replaces the in-memory queue and is bounded by bytes.
+        self._backlog = spool if spool is not None else deque(maxlen=maxlen)
         self._method = method
         self._header = header
         self._error_notice = error_notice
         self._notifier = notifier
+        self._transport = transport
+        self._max_attempts = max_attempts or MaxRetryAttempt
+        self._max_parallel = max_parallel or _DEFAULT_MAX_PARALLEL
+
+        self._cond = threading.Condition()
+        self._slots = threading.BoundedSemaphore(self._max_parallel)
+        self._in_flight = 0
+        self._running = False
+        # Spooled records are append-only, so only in-memory stats merge.
+        self._merge = not error_notice and spool is None
+        self._pending = {}
+
+        self.sent = 0
+        self.dropped = 0
+
+        if spool is not None and len(spool) > 0:
+            with self._cond:
+                self._start()
+
+    def _start(self):
+        if self._running:
+            return
+        self._running = True
+        t = threading.Thread(target=self.send, name="pybrake-backlog")
+        # Items in a spool are kept on disk, so only the in-memory backlog
+        # keeps the process alive until it is sent.
+        t.daemon = not isinstance(self._backlog, deque)
+        t.start()
 
     def send(self):
-        # pop out queue items every 1 sec
-        # (please ignore empty deque for now)
-        while len(self._backlog) > 0:
-            payload = self._backlog.popleft()
+        """
+        Sends items when they are due until the backlog is empty.
+        """
+        with futures.ThreadPoolExecutor(
+                self._max_parallel,
+                thread_name_prefix="pybrake-backlog") as pool:
+            while True:
+                item = self._next_due()
+                if item is None:
+                    return
+                try:
+                    pool.submit(self._send_item, item)
+                except RuntimeError:
+                    # The interpreter is exiting and the pool doesn't accept
+                    # new work, so send the remaining items on this thread.
+                    self._send_item(item)
+
+    def _next_due(self):
+        self._slots.acquire()
+        with self._cond:
+            while True:
+                if len(self._backlog) == 0:
+                    if self._in_flight == 0:
+                        self._running = False
+                        self._slots.release()
+                        return None
+                    # Failed items in flight may come back.
+                    self._cond.wait()
+                    continue
+
+                wait = self._peek().get("due", 0) - time.time()
+                if wait <= 0:
+                    self._in_flight += 1
+                    item = self._backlog.popleft()
+                    if self._pending.get(item["url"]) is item:
+                        del self._pending[item["url"]]
+                    return item
+                self._cond.wait(wait)
+
+    def _peek(self):
+        if isinstance(self._backlog, deque):
+            return self._backlog[0]
+        return self._backlog.peek()
+
+    def _send_item(self, item):
+        try:
             if not self._error_notice:
-                metrics.send(
-                    url=payload.get('url'),
+                ok = metrics.send(
+                    url=item.get('url'),
                     headers=self._header,
                     method=self._method,
-                    payload=payload.get('data'),
-                    retry_count=payload.get('retry_count') + 1
+                    payload=item.get('data'),
+                    retry_count=item.get('retry_count') + 1,
+                    transport=self._transport,
                 )
             else:
-                metrics.send_notice(
+                notice = metrics.send_notice(
                     self._notifier,
-                    notice=payload.get('data'),
-                    url=payload.get('url'),
+                    notice=item.get('data'),
+                    url=item.get('url'),
                     headers=self._header,
                     method=self._method,
-                    retry_count=payload.get('retry_count') + 1
+                    retry_count=item.get('retry_count') + 1,
+                    transport=self._transport,
                 )
-            time.sleep(self.interval)
-
-    def append_stats(self, val, url, retry_count=0):
-        self._backlog.append({
-            'retry_count': retry_count,
-            'url': url,
-            'data': val
-        })
-        if not self._started.is_set():
-            self.start()
+                ok = "id" in notice
+        except Exception as err:  # pylint: disable=broad-except
+            logger.error(err)
+            ok = False
+
+        with self._cond:
+            self._in_flight -= 1
+            if ok:
+                self.sent += 1
+            self._cond.notify_all()
+        self._slots.release()
+
+    def append_stats(self, val, url, retry_count=0, retry_at=None):
+        """
+        Queues a payload that failed to send on its retry_count-th attempt.
+        If the attempt was rejected by an open circuit, retry_at is the time
+        the circuit lets a request through again. The attempt then made no
+        I/O and doesn't count against max_attempts.
+        """
+        if retry_at is not None:
+            retry_count = max(retry_count - 1, 0)
+        elif retry_count >= self._max_attempts:
+            with self._cond:
+                self.dropped += 1
+            return
+
+        now = time.time()
+        delay = min(self.interval, _BASE_DELAY * 2 ** retry_count)
+        due = now + random.uniform(delay / 2, delay)
+        if retry_at is not None:
+            due = max(due, retry_at)
+        with self._cond:
+            if self._merge_pending(url, val):
+                return
+
+            item = {
+                'retry_count': retry_count,
+                'url': url,
+                'data': val,
+                'queued': now,
+                'due': due,
+            }
+            self._append(item)
+            if self._merge:
+                self._pending[url] = item
+            self._cond.notify_all()
+            self._start()
+
+    def _append(self, item):
+        backlog = self._backlog
+        if isinstance(backlog, deque) and len(backlog) == backlog.maxlen:
+            # The deque evicts its oldest item, which must not stay the
+            # merge target of its url.
+            evicted = backlog[0]
+            if self._pending.get(evicted["url"]) is evicted:
+                del self._pending[evicted["url"]]
+            self.dropped += 1
+        backlog.append(item)
+
+    def _merge_pending(self, url, val):
+        item = self._pending.get(url)
+        if item is None:
+            return False
+        try:
+            item['data'] = merge_payloads(item['data'], val)
+        except (ValueError, KeyError, TypeError) as err:
+            logger.error(err)
+            return False
+        return True
+
+    def stats(self):
+        """
+        Returns the number of queued and in-flight items, the age in seconds
+        of the oldest queued item and counters of sent and dropped items.
+        """
+        with self._cond:
+            depth = len(self._backlog)
+            oldest = self._peek().get("queued") if depth else None
+            return dict(
+                depth=depth,
+                in_flight=self._in_flight,
+                oldest_age=time.time() - oldest if oldest else 0,
+                sent=self.sent,
+                dropped=self.dropped,
+            )
+
+
+def merge_payloads(a, b):
+    """
+    Merges two encoded APM payloads ({"routes": [...]}, {"queries": [...]},
+    {"queues": [...]}). Stats with the same key fields are combined.
+    """
+    a = json.loads(a)
+    for name, stats in json.loads(b).items():
+        if not isinstance(stats, list):
+            a[name] = stats
+            continue
+
+        merged = {_stat_key(stat): stat for stat in a.get(name, [])}
+        for stat in stats:
+            key = _stat_key(stat)
+            if key in merged:
+                merge_stat_dicts(merged[key], stat)
+            else:
+                merged[key] = stat
+        a[name] = list(merged.values())
+
+    return serializer.dumps(a)
+
+
+def _stat_key(stat):
+    return tuple(sorted(
+        (k, v) for k, v in stat.items() if k not in _STAT_FIELDS
+    ))
+
+
+def make_spool(config, name):
+    """
+    Returns the Spool for the named backlog if backlog_dir is configured.
+    """
+    directory = config.get("backlog_dir")
+    if not directory:
+        return None
+
+    path = os.path.join(directory, name)
+    max_bytes = config.get("backlog_max_bytes")
+    if max_bytes:
+        return Spool(path, max_bytes=max_bytes)
+    return Spool(path)
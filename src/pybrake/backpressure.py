@@ -0,0 +1,107 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+_DEFAULT_DELAY = 60
+_MAX_FACTOR = 16
+
+
+class _Endpoint:
+    __slots__ = ("paused_until", "factor", "throttled")
+
+    def __init__(self):
+        self.paused_until = 0
+        self.factor = 1
+        self.throttled = 0
+
+
+class BackPressure:
+    """
+    BackPressure tracks rate limiting of the APM endpoints and is shared by
+    route, breakdown, query and queue stats. A 429 response pauses the
+    endpoint for the delay from the Retry-After or X-RateLimit-Delay header
+    and doubles its flush interval, up to max_factor times. Every accepted
+    payload halves the interval again.
+
+    While an endpoint is paused payloads are not sent, and the stats keep
+    aggregating in memory until the next flush.
+    """
+
+    def __init__(self, *, max_factor=_MAX_FACTOR, default_delay=_DEFAULT_DELAY):
+        self._max_factor = max_factor
+        self._default_delay = default_delay
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def throttled(self, url):
+        """Returns True if the endpoint is paused."""
+        with self._lock:
+            state = self._endpoints.get(url)
+            return state is not None and time.time() < state.paused_until
+
+    def interval(self, url, base):
+        """
+        Returns the flush interval for the endpoint: base widened by the
+        back-off factor and at least the remaining pause.
+        """
+        with self._lock:
+            state = self._endpoints.get(url)
+            if state is None:
+                return base
+            return max(base * state.factor, state.paused_until - time.time())
+
+    def update(self, url, resp):
+        """Updates the endpoint state from the response."""
+        if resp.code == 429:
+            delay = _retry_delay(resp.headers, self._default_delay)
+            with self._lock:
+                state = self._endpoints.setdefault(url, _Endpoint())
+                state.paused_until = time.time() + delay
+                state.factor = min(state.factor * 2, self._max_factor)
+                state.throttled += 1
+            return
+
+        if 200 <= resp.code < 300:
+            with self._lock:
+                state = self._endpoints.get(url)
+                if state is None:
+                    return
+                state.factor = max(state.factor // 2, 1)
+                if state.factor == 1:
+                    del self._endpoints[url]
+
+    def stats(self):
+        """
+        Returns the remaining pause in seconds, the interval factor and the
+        number of 429 responses of every throttled endpoint.
+        """
+        now = time.time()
+        with self._lock:
+            return {
+                url: dict(
+                    paused_for=max(state.paused_until - now, 0),
+                    factor=state.factor,
+                    throttled=state.throttled,
+                )
+                for url, state in self._endpoints.items()
+            }
+
+
+def _retry_delay(headers, default):
+    if headers is None:
+        return default
+
+    for name in ("Retry-After", "X-RateLimit-Delay"):
+        v = headers.get(name)
+        if v is None:
+            continue
+        try:
+            return max(float(v), 0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(v).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            pass
+
+    return default
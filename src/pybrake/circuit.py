@@ -0,0 +1,138 @@
+import threading
+import time
+import urllib.error
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+_DEFAULT_FAILURE_THRESHOLD = 5
+_DEFAULT_RESET_TIMEOUT = 30
+
+# Responses that mean the host is not reachable behind a proxy or a load
+# balancer. They count as failures like connection errors do.
+_FAILURE_STATUS_CODES = (502, 503, 504)
+
+
+class CircuitOpenError(urllib.error.URLError):
+    """
+    CircuitOpenError is raised instead of sending a request to a host whose
+    circuit is open. retry_at is the time (time.time()) at which the next
+    probe request can be sent.
+    """
+
+    def __init__(self, reason, retry_at=0):
+        super().__init__(reason)
+        self.retry_at = retry_at
+
+
+class _Circuit:
+    __slots__ = ("state", "failures", "opened_at", "rejected", "opened")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.rejected = 0
+        self.opened = 0
+
+
+class CircuitBreaker:
+    """
+    CircuitBreaker stops sending requests to a host after failure_threshold
+    consecutive connection failures, so a host that doesn't respond doesn't
+    tie up a sender thread for the whole timeout on every request. While the
+    circuit is open requests fail fast with CircuitOpenError. After
+    reset_timeout seconds a single probe request is let through (half-open):
+    if it succeeds the circuit closes, otherwise it opens again.
+
+    A failure_threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, *, failure_threshold=_DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=_DEFAULT_RESET_TIMEOUT):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._circuits = {}
+
+    def before_request(self, host):
+        """
+        Raises CircuitOpenError if a request to the host must not be sent.
+        """
+        if not self._failure_threshold:
+            return
+
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit.state == CLOSED:
+                return
+            if (circuit.state == OPEN and
+                    time.time() - circuit.opened_at >= self._reset_timeout):
+                circuit.state = HALF_OPEN
+                return
+            circuit.rejected += 1
+            retry_at = circuit.opened_at + self._reset_timeout
+
+        raise CircuitOpenError(f"circuit for {host} is open",
+                               retry_at=retry_at)
+
+    def record(self, host, code=None):
+        """
+        Records the result of a request: the response status code or None
+        if the request failed.
+        """
+        if not self._failure_threshold:
+            return
+
+        failed = code is None or code in _FAILURE_STATUS_CODES
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if not failed:
+                if circuit is not None:
+                    circuit.state = CLOSED
+                    circuit.failures = 0
+                return
+
+            if circuit is None:
+                circuit = _Circuit()
+                self._circuits[host] = circuit
+            circuit.failures += 1
+            if (circuit.state == HALF_OPEN or
+                    circuit.failures >= self._failure_threshold):
+                if circuit.state != OPEN:
+                    circuit.opened += 1
+                circuit.state = OPEN
+                circuit.opened_at = time.time()
+
+    def cancel(self, host):
+        """
+        Records that a request let through by before_request ended without
+        a result, e.g. it was cancelled. If it was the probe of a half-open
+        circuit, the next request is the probe.
+        """
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is not None and circuit.state == HALF_OPEN:
+                circuit.state = OPEN
+
+    def state(self, host):
+        with self._lock:
+            circuit = self._circuits.get(host)
+            return circuit.state if circuit is not None else CLOSED
+
+    def stats(self):
+        """
+        Returns the state, consecutive failures, number of rejected requests
+        and number of times the circuit opened for every host.
+        """
+        with self._lock:
+            return {
+                host: dict(
+                    state=circuit.state,
+                    failures=circuit.failures,
+                    rejected=circuit.rejected,
+                    opened=circuit.opened,
+                )
+                for host, circuit in self._circuits.items()
+            }
@@ -0,0 +1,66 @@
+import time
+
+
+class Clock:
+    """
+    Clock is the time source of metrics and spans. Durations are measured
+    with a monotonic high-resolution counter that NTP adjustments don't
+    affect. Wall time is read once per metric, for its minute bucket.
+    """
+
+    def wall_time(self):
+        """Returns the wall time in seconds since the epoch."""
+        return time.time()
+
+    def monotonic_ns(self):
+        """Returns a monotonic counter in nanoseconds."""
+        return time.perf_counter_ns()
+
+
+class ManualClock(Clock):
+    """
+    ManualClock is a Clock that only moves when advanced, for tests and
+    benchmarks.
+    """
+
+    def __init__(self, wall=0.0, ns=0):
+        self._wall_time = wall
+        self._monotonic_ns = ns
+
+    def wall_time(self):
+        return self._wall_time
+
+    def monotonic_ns(self):
+        return self._monotonic_ns
+
+    def advance(self, seconds):
+        self._wall_time += seconds
+        self._monotonic_ns += int(seconds * 1e9)
+
+    def set_wall_time(self, wall):
+        """Moves the wall time only, like an NTP step."""
+        self._wall_time = wall
+
+
+_clock = Clock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    """
+    Sets the clock used by metrics and spans and returns the previous one.
+    """
+    global _clock  # pylint: disable=global-statement
+    prev, _clock = _clock, clock
+    return prev
+
+
+def wall_time():
+    return _clock.wall_time()
+
+
+def monotonic_ns():
+    return _clock.monotonic_ns()
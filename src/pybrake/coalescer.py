@@ -0,0 +1,158 @@
+import collections
+import threading
+import time
+from datetime import datetime
+
+_MAX_FINGERPRINTS = 1000
+
+
+class _Occurrences:
+    __slots__ = ("count", "first_seen", "last_seen", "err", "backtrace")
+
+    def __init__(self, now):
+        self.count = 0
+        self.first_seen = now
+        self.last_seen = now
+        self.err = None
+        self.backtrace = None
+
+
+class Coalescer:
+    """
+    Coalescer folds repeated errors with the same fingerprint. The first
+    occurrence is sent right away; repeats within the window are only
+    counted and sent as a single follow-up notice carrying the occurrence
+    count and the first/last seen timestamps.
+
+    Errors are exceptions, strings or notices that were already built
+    (e.g. received by the relay).
+    """
+
+    def __init__(self, notifier, *, window=60, depth=3):
+        self._notifier = notifier
+        self._window = window
+        self._depth = depth
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._thread = None
+
+    def add(self, err):
+        """
+        Returns True if the error must be sent now and False if it was
+        folded into a pending follow-up notice.
+        """
+        key = fingerprint(err, depth=self._depth)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) < _MAX_FINGERPRINTS:
+                    self._entries[key] = _Occurrences(now)
+                    self._schedule_flush()
+                return True
+
+            first = entry.count == 0
+            if first:
+                entry.first_seen = now
+            entry.count += 1
+            entry.last_seen = now
+            entry.err = err
+
+        if first and isinstance(err, str):
+            # The follow-up notice is built on the flush thread, so the
+            # backtrace of a string error is taken at the call site.
+            backtrace = self._backtrace()
+            with self._lock:
+                entry.backtrace = backtrace
+        return False
+
+    def _backtrace(self):
+        notifier = self._notifier
+        return notifier._build_backtrace_stack(
+            notifier._walk_stack(notifier._caller_frame()))
+
+    def _schedule_flush(self):
+        if self._thread is None:
+            self._thread = threading.Timer(self._window, self._flush)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def flush(self):
+        """
+        Sends pending follow-up notices right away. Returns the number of
+        follow-up notices that were not sent.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.cancel()
+        return self._flush()
+
+    def _flush(self):
+        now = time.time()
+        pending = []
+        with self._lock:
+            self._thread = None
+            for key, entry in list(self._entries.items()):
+                if entry.count > 0:
+                    pending.append((entry.err, entry.backtrace, entry.count,
+                                    entry.first_seen, entry.last_seen))
+                    entry.count = 0
+                    entry.err = None
+                    entry.backtrace = None
+                elif now - entry.last_seen >= self._window:
+                    del self._entries[key]
+            if self._entries:
+                self._schedule_flush()
+
+        failed = 0
+        for err, backtrace, count, first_seen, last_seen in pending:
+            if isinstance(err, dict):
+                notice = dict(err, params=dict(err.get("params") or {}))
+            elif isinstance(err, str):
+                notice = self._notifier.build_notice(None)
+                notice["errors"] = [dict(message=err,
+                                         backtrace=backtrace or [])]
+            else:
+                notice = self._notifier.build_notice(err)
+            notice["params"]["occurrences"] = dict(
+                count=count,
+                firstSeen=_time_iso(first_seen),
+                lastSeen=_time_iso(last_seen),
+            )
+            notice = self._notifier.send_notice_sync(notice)
+            if "error" in notice:
+                failed += 1
+        return failed
+
+
+def fingerprint(err, *, depth=3):
+    """
+    Returns a cheap fingerprint of the error: exception type and the
+    innermost depth backtrace frames, or the message for string errors and
+    exceptions that were never raised. Notices are fingerprinted by the type
+    and the top backtrace frames of their first error.
+    """
+    if isinstance(err, str):
+        return (str, err)
+    if isinstance(err, dict):
+        errors = err.get("errors") or [{}]
+        backtrace = errors[0].get("backtrace") or []
+        return (dict, errors[0].get("type"), tuple(
+            (frame.get("file"), frame.get("line"))
+            for frame in backtrace[:depth]
+        ))
+
+    frames = collections.deque(maxlen=depth)
+    tb = err.__traceback__
+    while tb is not None:
+        frames.append((tb.tb_frame.f_code, tb.tb_lineno))
+        tb = tb.tb_next
+    if not frames:
+        return (type(err), str(err))
+    return (type(err), tuple(frames))
+
+
+def _time_iso(t):
+    return datetime.utcfromtimestamp(t).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
@@ -1,25 +1,191 @@
-from functools import lru_cache
+import array
+import os
+import threading
+from collections import OrderedDict
+from importlib.machinery import SourceFileLoader
 
+from . import clock
 
-@lru_cache(maxsize=1000)
-def get_code_hunk(filename, lineno, nlines=2, loader=None, module_name=None):
-    lines = _get_lines_from_file(filename, loader=loader, module_name=module_name)
-    if lines is None:
+_MAX_CACHE_BYTES = 4 * 1024 * 1024
+# How often the mtime of a cached file is checked.
+_MTIME_CHECK_NS = 1_000_000_000
+
+
+class _FileIndex:
+    """
+    _FileIndex stores byte offsets of the lines of a file on disk so a code
+    hunk can be read with a single seek instead of reading the whole file.
+    """
+
+    __slots__ = ("mtime", "checked", "offsets")
+
+    def __init__(self, mtime, checked, data):
+        self.mtime = mtime
+        self.checked = checked
+        self.offsets = array.array("q", [0])
+        pos = data.find(b"\n")
+        while pos != -1:
+            self.offsets.append(pos + 1)
+            pos = data.find(b"\n", pos + 1)
+        if self.offsets[-1] != len(data):
+            self.offsets.append(len(data))
+
+    def num_lines(self):
+        return len(self.offsets) - 1
+
+    def read_lines(self, filename, start, end):
+        with open(filename, "rb") as f:
+            f.seek(self.offsets[start])
+            data = f.read(self.offsets[end] - self.offsets[start])
+        return data.split(b"\n")[:end - start]
+
+    def size(self):
+        return self.offsets.itemsize * len(self.offsets)
+
+
+class _SourceLines:
+    """
+    _SourceLines stores the source returned by loader.get_source for modules
+    that can't be read from disk (zip imports, frozen or generated modules).
+    """
+
+    __slots__ = ("mtime", "checked", "lines")
+
+    def __init__(self, mtime, checked, source):
+        self.mtime = mtime
+        self.checked = checked
+        self.lines = source.splitlines()
+
+    def num_lines(self):
+        return len(self.lines)
+
+    def read_lines(self, filename, start, end):
+        return self.lines[start:end]
+
+    def size(self):
+        return sum(len(line) for line in self.lines)
+
+
+class SourceCache:
+    """
+    SourceCache is a LRU cache of source line indexes shared by all
+    notifiers. It is bounded by the approximate number of bytes held rather
+    than by the number of files, and an entry is rebuilt when the mtime of
+    the file changes. The mtime is checked at most once per second per file.
+    """
+
+    def __init__(self, max_bytes=_MAX_CACHE_BYTES):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_lines(self, filename, lineno, nlines, loader=None,
+                  module_name=None):
+        # pylint: disable=too-many-arguments
+        """
+        Returns (first line number, lines) around lineno, or None if the
+        source is not available.
+        """
+        key = (filename, module_name)
+        now = clock.monotonic_ns()
+        entry = self._get(key, filename, now)
+        if entry is None:
+            entry = _load(filename, now, loader, module_name)
+            if entry is None:
+                return None
+            self._put(key, entry)
+
+        start = max(0, lineno - 1 - nlines)
+        end = min(lineno + nlines, entry.num_lines())
+        if start >= end:
+            return start + 1, []
+
+        try:
+            return start + 1, entry.read_lines(filename, start, end)
+        except (OSError, IOError):
+            return None
+
+    def _get(self, key, filename, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if now - entry.checked < _MTIME_CHECK_NS:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        mtime = _mtime(filename)
+        with self._lock:
+            if mtime != entry.mtime:
+                self.misses += 1
+                return None
+            entry.checked = now
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def _put(self, key, entry):
+        size = entry.size()
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size()
+
+            self._entries[key] = entry
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= old.size()
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0,
+                evictions=self.evictions,
+                files=len(self._entries),
+                bytes=self._bytes,
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except (OSError, ValueError):
         return None
 
-    start = max(0, lineno - 1 - nlines)
-    end = min(lineno + nlines, len(lines))
-    hunk = {}
-    for i, line in enumerate(lines[start:end], start + 1):
-        if isinstance(line, bytes):
-            line = line.decode("utf8", "replace")
-        hunk[i] = line.rstrip("\n")
 
-    return hunk
+def _load(filename, now, loader, module_name):
+    mtime = _mtime(filename)
 
+    # The source of a plain source file loader is the file itself, which is
+    # indexed instead of kept in memory. Subclasses may override get_source,
+    # so the type is compared.
+    if type(loader) is SourceFileLoader and \
+            loader.path == filename:  # pylint: disable=unidiomatic-typecheck
+        entry = _index_file(filename, mtime, now)
+        if entry is not None:
+            return entry
 
-@lru_cache(maxsize=10)
-def _get_lines_from_file(filename, loader=None, module_name=None):
     if loader is not None and hasattr(loader, "get_source"):
         try:
             source = loader.get_source(module_name)
@@ -27,10 +193,35 @@ def _get_lines_from_file(filename, loader=None, module_name=None):
             pass
         else:
             if source:
-                return source.splitlines()
+                return _SourceLines(mtime, now, source)
+
+    return _index_file(filename, mtime, now)
+
 
+def _index_file(filename, mtime, now):
+    if mtime is None:
+        return None
     try:
         with open(filename, "rb") as f:
-            return f.read().splitlines()
+            return _FileIndex(mtime, now, f.read())
     except (OSError, IOError):
         return None
+
+
+source_cache = SourceCache()
+
+
+def get_code_hunk(filename, lineno, nlines=2, loader=None, module_name=None):
+    res = source_cache.get_lines(filename, lineno, nlines, loader=loader,
+                                 module_name=module_name)
+    if res is None:
+        return None
+
+    first, lines = res
+    hunk = {}
+    for i, line in enumerate(lines, first):
+        if isinstance(line, bytes):
+            line = line.decode("utf8", "replace")
+        hunk[i] = line.rstrip("\r\n")
+
+    return hunk
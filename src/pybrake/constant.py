@@ -11,8 +11,11 @@ AIRBRAKE_HOST = "https://api.airbrake.io"
 AIRBRAKE_CONFIG_HOST = "https://notifier-configs.airbrake.io"
 
 FLUSH_PERIOD = 15
-MaxRetryAttempt = 1
+MaxRetryAttempt = 5
 
 HTTP_HANDLER = "http.handler"
 
 QUEUE_HANDLER = "queue.handler"
+
+# Span tree node that collects spans over the depth or width limits.
+SPAN_TREE_OTHER = "other"
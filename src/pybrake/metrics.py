@@ -1,17 +1,23 @@
+import contextvars
 import json
-import threading
-import time as pytime
-import urllib.error
-import urllib.request
+from collections.abc import Mapping
 from contextlib import contextmanager
 
-from .constant import MaxRetryAttempt
+from . import clock
+from .constant import HTTP_HANDLER, QUEUE_HANDLER, SPAN_TREE_OTHER
+from .circuit import CircuitOpenError
 from .notice import jsonify_notice
+from .transport import DEFAULT_TRANSPORT
 from .utils import logger
 
-threadLocal = threading.local()
-
-_METRIC_KEY = "_ab_metric"
+# The active metric is stored in a context variable, so every asyncio task
+# (and every thread) sees its own metric. Concurrent requests served by one
+# event loop don't overwrite each other's metric. The variable holds the
+# metric with its generation: a task that outlives its request (a background
+# task, a streamed response) must not see the metric once it is released and
+# reused by another request.
+_active_metric = contextvars.ContextVar("pybrake_active_metric",
+                                        default=None)
 
 _STATUS_CODE_CRITERIA_FOR_BACKLOG = (404, 408, 409, 410, 500, 502, 504)
 
@@ -19,19 +25,91 @@ APM_Backlog = None
 Error_Backlog = None
 
 
+class _Backlogged:
+    """Result of send for payloads that were handed to the backlog."""
+
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return "BACKLOGGED"
+
+
+BACKLOGGED = _Backlogged()
+
+# Maximum depth of the span tree recorded by metrics, 0 if span trees are
+# disabled. It is process-wide because metrics are created before it is known
+# which notifier they are sent with.
+_span_tree_depth = 0
+
+
 @contextmanager
 def activated_metric(metric):
-    set_active(metric)
-    yield
-    set_active(None)
+    token = enter_metric(metric)
+    try:
+        yield
+    finally:
+        exit_metric(token)
+
+
+def enter_metric(metric):
+    """
+    Makes metric active in the current context and returns a token that
+    restores the previously active metric when passed to exit_metric.
+    """
+    return _active_metric.set(_activation(metric))
+
+
+def exit_metric(token):
+    try:
+        _active_metric.reset(token)
+    except ValueError:
+        # The token was created in another context, e.g. the metric was
+        # entered in a request hook that ran in a different task.
+        _active_metric.set(None)
 
 
 def set_active(metric):
-    setattr(threadLocal, _METRIC_KEY, metric)
+    _active_metric.set(_activation(metric))
 
 
 def get_active():
-    return getattr(threadLocal, _METRIC_KEY, None)
+    active = _active_metric.get()
+    if active is None:
+        return None
+    metric, gen = active
+    if metric._gen != gen:
+        # The metric was released since it was activated in this context.
+        return None
+    return metric
+
+
+def _activation(metric):
+    if metric is None:
+        return None
+    return metric, metric._gen
+
+
+def set_span_tree(max_depth):
+    """
+    Makes metrics record the tree of their spans, up to max_depth levels.
+    Spans nested deeper are recorded as "other" at the last level. A
+    max_depth of 0 disables span trees.
+
+    The depth is process-wide. Notifiers created with span_tree=True raise
+    it to their span_tree_max_depth and never lower it; set_span_tree(0)
+    stops recording for all of them. Notifiers without span_tree ignore
+    the recorded trees.
+    """
+    global _span_tree_depth  # pylint: disable=global-statement
+    _span_tree_depth = max_depth
+
+
+def get_span_tree():
+    """Returns the maximum depth of span trees, 0 if they are disabled."""
+    return _span_tree_depth
 
 
 def start_span(name, **kwargs):
@@ -46,24 +124,182 @@ def end_span(name, **kwargs):
         metric.end_span(name, **kwargs)
 
 
+# Groups that almost every metric has are stored in a fixed-size list
+# instead of a dict.
+_GROUP_NAMES = (HTTP_HANDLER, QUEUE_HANDLER, "sql", "template", "cache")
+_GROUP_INDEX = {name: i for i, name in enumerate(_GROUP_NAMES)}
+_NO_GROUPS = (None,) * len(_GROUP_NAMES)
+
+# Released metrics are kept for reuse, per class.
+_POOL_SIZE = 256
+_metric_pools = {}
+# A released metric keeps its spans for reuse unless it has more than this.
+_MAX_KEPT_SPANS = 16
+
+
+class _Groups(Mapping):
+    """
+    _Groups maps span names to the total milliseconds spent in them.
+    """
+
+    __slots__ = ("_values", "_other")
+
+    def __init__(self):
+        self._values = list(_NO_GROUPS)
+        self._other = None
+
+    def __getitem__(self, name):
+        v = self.get(name)
+        if v is None:
+            raise KeyError(name)
+        return v
+
+    def __setitem__(self, name, ms):
+        i = _GROUP_INDEX.get(name)
+        if i is not None:
+            self._values[i] = ms
+            return
+        if self._other is None:
+            self._other = {}
+        self._other[name] = ms
+
+    def __iter__(self):
+        for name, v in zip(_GROUP_NAMES, self._values):
+            if v is not None:
+                yield name
+        if self._other:
+            yield from self._other
+
+    def __len__(self):
+        n = len(_NO_GROUPS) - self._values.count(None)
+        if self._other:
+            n += len(self._other)
+        return n
+
+    def get(self, key, default=None):
+        i = _GROUP_INDEX.get(key)
+        if i is not None:
+            v = self._values[i]
+            return default if v is None else v
+        if self._other is None:
+            return default
+        return self._other.get(key, default)
+
+    def clear(self):
+        self._values[:] = _NO_GROUPS
+        self._other = None
+
+
 class Metric:
+    """
+    Metric measures a request or a job and the time spent in its spans.
+    Durations use the monotonic clock; wall time is read once, when the
+    metric starts, for the minute bucket of its stats.
+
+    With span trees enabled (set_span_tree) the metric also records the
+    call count, total time and self time of every span path, e.g.
+    http.handler > template > sql.
+
+    Ended spans are kept and restarted when a span with the same name
+    starts again. A metric that is no longer used can be released, and is
+    then reused with its spans by the next metric of the same class. Spans
+    started on a released metric, or through a context it was active in,
+    are ignored.
+    """
+
+    __slots__ = (
+        "start_time", "end_time", "_start_ns", "_end_ns",
+        "_spans", "_curr_span", "_groups", "_tree", "_gen",
+    )
+
+    def __new__(cls, *args, **kwargs):  # pylint: disable=unused-argument
+        pool = _metric_pools.get(cls)
+        if pool:
+            try:
+                return pool.pop()
+            except IndexError:
+                pass
+        return super().__new__(cls)
+
     def __init__(self):
-        self.start_time = pytime.time()
+        self.start_time = clock.wall_time()
         self.end_time = None
+        self._start_ns = clock.monotonic_ns()
+        self._end_ns = None
+        self._curr_span = None
 
-        self._spans = {}
+        # A released metric keeps its (empty) containers.
+        if getattr(self, "_spans", None) is None:
+            self._spans = {}
+            self._groups = _Groups()
+            self._gen = 0
+        if not _span_tree_depth:
+            self._tree = None
+        elif getattr(self, "_tree", None) is None:
+            self._tree = {}
+
+    def release(self):
+        """
+        Resets the metric for reuse. The metric must not be used after it
+        is released.
+        """
+        if self._start_ns is None:
+            return
+        self._start_ns = None
+        # Contexts that still hold the metric no longer see it as active.
+        self._gen += 1
+
+        if len(self._spans) > _MAX_KEPT_SPANS:
+            self._spans.clear()
+        for span in self._spans.values():
+            span._metric = None
+            span._parent = None
         self._curr_span = None
 
-        self._groups = {}
+        if isinstance(self._groups, _Groups):
+            self._groups.clear()
+        else:
+            self._groups = _Groups()
+        if self._tree is not None:
+            self._tree.clear()
+
+        pool = _metric_pools.setdefault(type(self), [])
+        if len(pool) < _POOL_SIZE:
+            pool.append(self)
 
     def end(self):
+        if self._end_ns is not None:
+            return
         if self.end_time is None:
-            self.end_time = pytime.time()
+            self._end_ns = clock.monotonic_ns()
+            self.end_time = self._wall_time(self._end_ns)
+        else:
+            # end_time was set by the caller.
+            self._end_ns = self._monotonic_ns(self.end_time)
+
+    def duration_ms(self):
+        """Returns the duration of the ended metric in milliseconds."""
+        self.end()
+        return (self._end_ns - self._start_ns) / 1e6
+
+    def elapsed_ms(self):
+        """Returns the time since the metric started in milliseconds."""
+        return (clock.monotonic_ns() - self._start_ns) / 1e6
+
+    def _monotonic_ns(self, wall_time):
+        # Maps wall time to the monotonic clock using the start of the
+        # metric, without reading the clock again.
+        return self._start_ns + int((wall_time - self.start_time) * 1e9)
+
+    def _wall_time(self, ns):
+        return self.start_time + (ns - self._start_ns) / 1e9
 
     def _new_span(self, name, **kwargs):
         return Span(metric=self, name=name, **kwargs)
 
     def start_span(self, name, *, start_time=None):
+        if self._start_ns is None:
+            return  # released
         if self._curr_span is not None:
             if self._curr_span.name == name:
                 self._curr_span._level += 1
@@ -71,9 +307,15 @@ class Metric:
             self._curr_span._pause()
 
         span = self._spans.get(name)
-        if span is None:
-            span = self._new_span(name, start_time=start_time)
-            self._spans[name] = span
+        if span is None or span._ended():
+            start_ns = None
+            if start_time is not None:
+                start_ns = self._monotonic_ns(start_time)
+            if span is None:
+                span = self._new_span(name, start_ns=start_ns)
+                self._spans[name] = span
+            else:
+                span._start(self, start_ns)
         else:
             span._resume()
 
@@ -81,140 +323,238 @@ class Metric:
         self._curr_span = span
 
     def end_span(self, name, *, end_time=None):
+        if self._start_ns is None:
+            return  # released
+        end_ns = None
+        if end_time is not None:
+            end_ns = self._monotonic_ns(end_time)
+
         if self._curr_span is not None and self._curr_span.name == name:
-            if self._end_span(self._curr_span):
+            if self._end_span(self._curr_span, end_ns=end_ns):
                 self._curr_span = self._curr_span._parent
                 if self._curr_span is not None:
                     self._curr_span._resume()
             return
 
         span = self._spans.get(name)
-        if span is None:
+        if span is None or span._ended():
             logger.error("pybrake: span=%s does not exist", name)
             return
-        self._end_span(span, end_time=end_time)
+        self._end_span(span, end_ns=end_ns)
 
-    def _end_span(self, span, *, end_time=None):
+    def _end_span(self, span, *, end_ns=None):
         if span._level > 0:
             span._level -= 1
             return False
 
-        span.end(end_time=end_time)
-        self._spans.pop(span.name)
+        span.end(end_ns=end_ns)
         return True
 
     def _inc_group(self, name, ms):
-        self._groups[name] = self._groups.get(name, 0) + ms
+        groups = self._groups
+        groups[name] = groups.get(name, 0) + ms
+
+    def _add_tree_span(self, span, total_ms):
+        path = [span.name]
+        parent = span._parent
+        # A valid chain has no more spans than the metric, which stops the
+        # walk if a restarted span made the chain circular.
+        while parent is not None and len(path) <= len(self._spans):
+            path.append(parent.name)
+            parent = parent._parent
+        path.reverse()
+        if len(path) > _span_tree_depth:
+            path[_span_tree_depth - 1:] = [SPAN_TREE_OTHER]
+
+        key = tuple(path)
+        node = self._tree.get(key)
+        if node is None:
+            self._tree[key] = [1, total_ms, span._dur]
+        else:
+            node[0] += 1
+            node[1] += total_ms
+            node[2] += span._dur
 
 
 class Span:
-    def __init__(self, *, metric=None, name="", start_time=None):
-        self._metric = metric
-        self._parent = None
+    __slots__ = (
+        "_metric", "_parent", "name", "_start_ns", "_begin_ns", "_dur",
+        "_level",
+    )
 
+    def __init__(self, *, metric=None, name="", start_ns=None):
         self.name = name
-        if start_time is not None:
-            self.start_time = start_time
-        else:
-            self.start_time = pytime.time()
-        self.end_time = None
+        self._start(metric, start_ns)
+
+    def _start(self, metric, start_ns):
+        self._metric = metric
+        self._parent = None
+        if start_ns is None:
+            start_ns = clock.monotonic_ns()
+        self._start_ns = start_ns
+        self._begin_ns = start_ns
 
         self._dur = 0
         self._level = 0
 
-    def end(self, end_time=None):
-        if end_time is not None:
-            self.end_time = end_time
-        else:
-            self.end_time = pytime.time()
-        self._dur += (self.end_time - self.start_time) * 1000
-        self._metric._inc_group(self.name, self._dur)
+    def end(self, end_ns=None):
+        if end_ns is None:
+            end_ns = clock.monotonic_ns()
+        if not self._paused():
+            self._dur += (end_ns - self._start_ns) / 1e6
+        metric = self._metric
+        metric._inc_group(self.name, self._dur)
+        if metric._tree is not None:
+            metric._add_tree_span(self, (end_ns - self._begin_ns) / 1e6)
         self._metric = None
 
     def _pause(self):
         if self._paused():
             return
-        self._dur += (pytime.time() - self.start_time) * 1000
-        self.start_time = 0
+        self._dur += (clock.monotonic_ns() - self._start_ns) / 1e6
+        self._start_ns = None
 
     def _paused(self):
-        return self.start_time == 0
+        return self._start_ns is None
+
+    def _ended(self):
+        return self._metric is None
 
     def _resume(self):
         if not self._paused():
             return
-        self.start_time = pytime.time()
-
-
-def send(url, headers, payload=None, method=None, retry_count=0):
+        self._start_ns = clock.monotonic_ns()
+
+
+def send(url, headers, payload=None, method=None, retry_count=0,
+         transport=None, backpressure=None):
+    # pylint: disable=too-many-arguments,too-many-return-statements
+    # pylint: disable=too-many-branches
+    """
+    Sends APM payload and returns True if it was accepted by Airbrake,
+    BACKLOGGED (which is false) if it was handed to the backlog and False
+    otherwise. The payload is not sent while backpressure pauses the
+    endpoint.
+    """
     if payload is None:
         payload = {}
-
-    req = urllib.request.Request(
-        url, data=payload, headers=headers, method=method
-    )
+    if transport is None:
+        transport = DEFAULT_TRANSPORT
+    if backpressure is not None and backpressure.throttled(url):
+        return False
 
     try:
-        resp = urllib.request.urlopen(req, timeout=5)
-    except urllib.error.HTTPError as err:
-        resp = err
+        resp = transport.request(
+            url, data=payload, headers=headers, method=method
+        )
+    except CircuitOpenError as err:
+        # The host is down, keep the payload for later without logging
+        # every rejected request.
+        if APM_Backlog is not None:
+            APM_Backlog.append_stats(
+                val=payload, url=url, retry_count=retry_count,
+                retry_at=err.retry_at)
+            return BACKLOGGED
+        return False
     except Exception as err:  # pylint: disable=broad-except
         logger.error(err)
-        return
+        return False
 
     try:
         body = resp.read()
     except IOError as err:
         logger.error(err)
-        return
+        return False
+
+    if backpressure is not None:
+        backpressure.update(url, resp)
 
     if 200 <= resp.code < 300:
-        return
+        return True
 
-    if resp.code in _STATUS_CODE_CRITERIA_FOR_BACKLOG and APM_Backlog is not\
-            None and retry_count < MaxRetryAttempt:
+    failed = False
+    if resp.code in _STATUS_CODE_CRITERIA_FOR_BACKLOG and \
+            APM_Backlog is not None:
         APM_Backlog.append_stats(val=payload, url=url, retry_count=retry_count)
+        failed = BACKLOGGED
 
     if not 400 <= resp.code < 500:
         err = f"airbrake: unexpected response status_code={resp.code}"
         logger.error(err)
-        return
+        return failed
 
     if resp.code == 429:
-        return
+        return failed
 
     try:
         body = body.decode("utf-8")
     except UnicodeDecodeError as err:
         logger.error(err)
-        return
+        return failed
 
     try:
         in_data = json.loads(body)
     except ValueError as err:  # json.JSONDecodeError requires Python 3.5+
         logger.error(err)
-        return
+        return failed
 
     if "message" in in_data:
         logger.error(in_data["message"])
-        return
+    return failed
+
+
+def send_notice(notifier, notice, url, headers, method=None, retry_count=0,
+                transport=None):  # pylint: disable=too-many-arguments
+    if transport is None:
+        transport = DEFAULT_TRANSPORT
+
+    try:
+        payload = jsonify_notice(notice)
+        resp = transport.request(
+            url, data=payload, headers=headers, method=method
+        )
+    except CircuitOpenError as err:
+        if Error_Backlog is not None:
+            Error_Backlog.append_stats(
+                val=notice, url=url, retry_count=retry_count,
+                retry_at=err.retry_at)
+        notice["error"] = err
+        return notice
+    except Exception as err:  # pylint: disable=broad-except
+        notice["error"] = err
+        logger.error(notice["error"])
+
+        return notice
 
+    return _handle_notice_response(notifier, notice, url, resp, retry_count)
 
-def send_notice(notifier, notice, url, headers, method=None, retry_count=0):
-    payload = jsonify_notice(notice)
-    req = urllib.request.Request(
-        url, data=payload, headers=headers, method=method)
 
+async def send_notice_async(notifier, notice, url, headers, method=None,
+                            retry_count=0, transport=None):
+    # pylint: disable=too-many-arguments
     try:
-        resp = urllib.request.urlopen(req, timeout=5)
-    except urllib.error.HTTPError as err:
-        resp = err
+        payload = jsonify_notice(notice)
+        resp = await transport.request(
+            url, data=payload, headers=headers, method=method
+        )
+    except CircuitOpenError as err:
+        if Error_Backlog is not None:
+            Error_Backlog.append_stats(
+                val=notice, url=url, retry_count=retry_count,
+                retry_at=err.retry_at)
+        notice["error"] = err
+        return notice
     except Exception as err:  # pylint: disable=broad-except
         notice["error"] = err
         logger.error(notice["error"])
 
         return notice
 
+    return _handle_notice_response(notifier, notice, url, resp, retry_count)
+
+
+def _handle_notice_response(notifier, notice, url, resp, retry_count):
+    # pylint: disable=too-many-return-statements
     try:
         body = resp.read()
     except IOError as err:
@@ -222,8 +562,8 @@ def send_notice(notifier, notice, url, headers, method=None, retry_count=0):
         logger.error(notice["error"])
         return notice
 
-    if resp.code in _STATUS_CODE_CRITERIA_FOR_BACKLOG and Error_Backlog is \
-            not None and retry_count < MaxRetryAttempt:
+    if resp.code in _STATUS_CODE_CRITERIA_FOR_BACKLOG and \
+            Error_Backlog is not None:
         Error_Backlog.append_stats(val=notice, url=url, retry_count=retry_count)
 
     if not (200 <= resp.code < 300 or 400 <= resp.code < 500):
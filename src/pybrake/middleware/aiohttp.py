@@ -1,13 +1,13 @@
 import asyncio
 import inspect
-import time
 import traceback
 import typing as t
 
 from aiohttp import web
 
 from ..metrics import (
-    set_active as set_active_metric,
+    enter_metric,
+    exit_metric,
     get_active as get_active_metric,
     start_span, end_span)
 from ..notifier import Notifier
@@ -70,7 +70,7 @@ def _after_sql_cursor(notifier):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
@@ -88,10 +88,11 @@ def pybrake_middleware(overrides=None, sqlEngine=None):
 
         async def middleware(request: web.Request):
             resp = None
+            token = None
             notifier = app["pybrake"]
             if notifier.config.get("performance_stats"):
                 metric = RouteMetric(method=request.method, route=request.path)
-                set_active_metric(metric)
+                token = enter_metric(metric)
             try:
                 resp = await handler(request)
                 override = overrides.get(resp.status)
@@ -115,15 +116,16 @@ def pybrake_middleware(overrides=None, sqlEngine=None):
                     resp = await override(request)
                 raise err
             finally:
-                if notifier.config.get("performance_stats"):
+                if token is not None:
                     metric = get_active_metric()
                     if metric is not None:
                         metric.status_code = resp.status if resp else 500
                         metric.content_type = \
                             resp.content_type if resp else request.content_type
-                        metric.end_time = time.time()
+                        metric.end()
                         notifier.routes.notify(metric)
-                        set_active_metric(None)
+                        metric.release()
+                    exit_metric(token)
 
         return middleware
 
@@ -146,7 +148,7 @@ def handle_exception(ex, notifier, request):
     notice = notifier.build_notice(ex)
     notice["context"].update(additional_context(request))
     notice["params"].update(get_headers(request))
-    notifier.send_notice(notice)
+    notifier.spawn_async(notifier.send_notice_async(notice))
 
 
 def additional_context(request):
@@ -1,5 +1,4 @@
 import sys
-import time
 import traceback
 
 try:
@@ -103,9 +102,10 @@ def after_request_middleware():
     if metric is not None:
         metric.status_code = bottle_response.status_code
         metric.content_type = bottle_response.content_type
-        metric.end_time = time.time()
+        metric.end()
         notifier.routes.notify(metric)
         set_active_metrics(None)
+        metric.release()
 
     return bottle_response
 
@@ -183,7 +183,7 @@ def _after_cursor():
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
@@ -204,7 +204,7 @@ def init_app(app):
 
     notifier = Notifier(**app.config["PYBRAKE"])
 
-    notifier.add_filter(request_filter)
+    notifier.add_request_filter(request_filter)
 
     app.config["pybrake"] = notifier
 
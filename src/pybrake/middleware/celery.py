@@ -41,5 +41,6 @@ def _wrap_task_call(task, fn, *, notifier=None):
         finally:
             notifier.queues.notify(metric)
             set_active(None)
+            metric.release()
 
     return wrapper
@@ -1,4 +1,3 @@
-import time
 import traceback
 import typing as t
 from sys import exc_info as _exc_info
@@ -94,9 +93,10 @@ class PybrakeAPM(cherrypy.Tool):
                 isinstance(cherrypy.response.status, str) \
                 else cherrypy.response.status
             metric.content_type = cherrypy.response.headers.get("Content-Type")
-            metric.end_time = time.time()
+            metric.end()
             notifier.routes.notify(metric)
             set_active_metrics(None)
+            metric.release()
 
 
 cherrypy.tools.pybrake_apm = PybrakeAPM()
@@ -175,7 +175,7 @@ def _after_sql_cursor(config):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
@@ -212,7 +212,7 @@ class PybrakePlugin(plugins.SimplePlugin):
             project_key=self.project_key,
             **self.kwargs
         )
-        self.notifier.add_filter(request_filter)
+        self.notifier.add_request_filter(request_filter)
 
         # Patch of route breakdown
         if _jinja_available:
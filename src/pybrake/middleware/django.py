@@ -1,4 +1,3 @@
-import time
 import functools
 import traceback
 import threading
@@ -11,6 +10,7 @@ from django.core import cache
 from django.core.cache import CacheHandler
 from django.middleware import cache as middleware_cache
 
+from .. import clock
 from ..global_notifier import get_global_notifier
 from ..route_metric import RouteMetric
 from ..metrics import get_active, start_span, end_span, activated_metric
@@ -68,7 +68,7 @@ class AirbrakeMiddleware:
         self._config = self._notifier.config
         self.get_response = get_response
 
-        self._notifier.add_filter(request_filter)
+        self._notifier.add_request_filter(request_filter)
 
     def __call__(self, request):
         if not self._config.get("performance_stats"):
@@ -86,8 +86,9 @@ class AirbrakeMiddleware:
         metric.status_code = response.status_code
         if "Content-Type" in response:
             metric.content_type = response["Content-Type"]
-        metric.end_time = time.time()
+        metric.end()
         self._notifier.routes.notify(metric)
+        metric.release()
 
         return response
 
@@ -179,13 +180,15 @@ class CursorWrapper:
     def _record(self, method, sql, params):
         metric = get_active()
 
-        start_time = time.time()
-        start_span("sql", start_time=start_time)
+        # The wall time is read once per query, for its minute bucket.
+        start_time = clock.wall_time()
+        start_ns = clock.monotonic_ns()
+        start_span("sql")
         try:
             return method(sql, params)
         finally:
-            end_time = time.time()
-            end_span("sql", end_time=end_time)
+            duration_ms = (clock.monotonic_ns() - start_ns) / 1e6
+            end_span("sql")
             if hasattr(sql, "as_string"):
                 sql = sql.as_string(self._cursor.cursor)
             try:
@@ -197,7 +200,7 @@ class CursorWrapper:
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=start_time,
-                end_time=end_time,
+                duration_ms=duration_ms,
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
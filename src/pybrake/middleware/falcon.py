@@ -1,4 +1,3 @@
-import time
 import traceback
 import typing as t
 
@@ -11,6 +10,13 @@ from ..metrics import (
 from ..notifier import Notifier
 from ..route_metric import RouteMetric
 
+try:
+    from falcon.asgi import App as AsyncApp
+except ImportError:
+    _falcon_asgi_available = False
+else:
+    _falcon_asgi_available = True
+
 try:
     from sqlalchemy import event
 except ImportError:
@@ -66,9 +72,10 @@ def after_request_middleware(notifier, req, resp):
         metric.status_code = int(resp.status.split(" ")[0]) if isinstance(
             resp.status, str) else resp.status
         metric.content_type = resp.content_type
-        metric.end_time = time.time()
+        metric.end()
         notifier.routes.notify(metric)
         set_active_metric(None)
+        metric.release()
 
 
 class PybrakeMiddleware:
@@ -122,7 +129,7 @@ def _after_sql_cursor(notifier):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
@@ -193,6 +200,19 @@ def init_app(app: App, config: dict, sqlEngine=None) -> (App, dict):
 
     App._handle_exception = _patch_handle_exception
 
+    if _falcon_asgi_available and isinstance(app, AsyncApp):
+        old_async_handle_exception = AsyncApp._handle_exception
+
+        async def _patch_async_handle_exception(self, req, resp, ex, params,
+                                                **kwargs):
+            notice = notifier.build_notice(ex)
+            notice = request_filter(req, notice)
+            notifier.spawn_async(notifier.send_notice_async(notice))
+            return await old_async_handle_exception(self, req, resp, ex,
+                                                    params, **kwargs)
+
+        AsyncApp._handle_exception = _patch_async_handle_exception
+
     # Patch of route stats
     app.add_middleware(PybrakeMiddleware(notifier=notifier))
 
@@ -1,4 +1,3 @@
-import time
 import traceback
 
 from flask import (
@@ -77,7 +76,7 @@ def init_app(app):
     notifier = Notifier(**app.config["PYBRAKE"])
     config = notifier.config
 
-    notifier.add_filter(request_filter)
+    notifier.add_request_filter(request_filter)
 
     app.extensions["pybrake"] = notifier
     got_request_exception.connect(_handle_exception, sender=app)
@@ -119,9 +118,10 @@ def _after_request(config, notifier):
         if metric is not None:
             metric.status_code = response.status_code
             metric.content_type = response.headers.get("Content-Type")
-            metric.end_time = time.time()
+            metric.end()
             notifier.routes.notify(metric)
             set_active(None)
+            metric.release()
 
         return response
 
@@ -185,7 +185,7 @@ def _after_cursor(config):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
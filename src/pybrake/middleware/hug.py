@@ -1,4 +1,3 @@
-import time
 import traceback
 import hug  # pylint: disable=import-error
 from ..metrics import (
@@ -76,9 +75,10 @@ def after_request_middleware(notifier, req, resp):
         metric.status_code = int(resp.status.split(" ")[0]) if isinstance(
             resp.status, str) else resp.status
         metric.content_type = resp.content_type
-        metric.end_time = time.time()
+        metric.end()
         notifier.routes.notify(metric)
         set_active_metric(None)
+        metric.release()
 
 
 def _before_sql_cursor(notifier):
@@ -110,7 +110,7 @@ def _after_sql_cursor(notifier):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
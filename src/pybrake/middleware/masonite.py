@@ -1,6 +1,5 @@
 import functools
 import traceback
-import time
 
 from masonite.middleware import Middleware
 from masonite.views import View
@@ -101,7 +100,7 @@ class PybrakeNotifier:
                             method=getattr(metric, "method", ""),
                             route=getattr(metric, "route", ""),
                             start_time=metric.start_time,
-                            end_time=time.time(),
+                            duration_ms=metric.elapsed_ms(),
                             function=traceback_frm.name if traceback_frm else '',
                             file=traceback_frm.filename if traceback_frm else '',
                             line=traceback_frm.lineno if traceback_frm else 0,
@@ -152,9 +151,10 @@ class PybrakeRouteMiddleware(Middleware):
             metric.status_code = response.get_status() or 500
             metric.content_type = response.header_bag.to_dict().get(
                 'Content-Type')
-            metric.end_time = time.time()
+            metric.end()
             notifier.routes.notify(metric)
             set_active_metric(None)
+            metric.release()
 
 
 # Queue Stats
@@ -178,6 +178,7 @@ def schedule_task(fn):
             finally:
                 notifier.queues.notify(metric)
                 set_active_metric(None)
+                metric.release()
         else:
             return fn(*args, **kwargs)
 
@@ -1,5 +1,4 @@
 import logging
-import time
 import traceback
 
 from morepath.authentication import NoIdentity
@@ -82,9 +81,10 @@ def after_request(notifier, resp):
     if metric is not None:
         metric.status_code = resp.status_code
         metric.content_type = resp.content_type
-        metric.end_time = time.time()
+        metric.end()
         notifier.routes.notify(metric)
         set_active_metric(None)
+        metric.release()
 
 
 # Error Handler
@@ -203,7 +203,7 @@ def _after_cursor(notifier):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
@@ -1,4 +1,3 @@
-import time
 import traceback
 
 from pycnic.core import WSGI
@@ -55,9 +54,10 @@ def after_request(handler):
     if metric is not None:
         metric.status_code = handler.response.status_code
         metric.content_type = handler.response.header_dict.get('Content-Type')
-        metric.end_time = time.time()
+        metric.end()
         handler.notifier.routes.notify(metric)
         set_active_metric(None)
+        metric.release()
 
 
 def _before_sql_cursor(notifier):
@@ -89,7 +89,7 @@ def _after_sql_cursor(notifier):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
@@ -1,7 +1,6 @@
 import logging
 import traceback
 import sys
-import time
 
 from .. import Notifier
 from .. import RouteMetric
@@ -116,7 +115,7 @@ def _after_cursor(notifier):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
@@ -143,9 +142,10 @@ def route_stats_tween_factory(handler, registry):
                 if metric is not None and response:
                     metric.status_code = response.status_code
                     metric.content_type = response.headers.get("Content-Type")
-                    metric.end_time = time.time()
+                    metric.end()
                     notifier.routes.notify(metric)
                     set_active_metrics(None)
+                    metric.release()
             return response
 
         return stats_tween
@@ -162,7 +162,7 @@ def init_pybrake_config(config):
 
     notifier = Notifier(**config.registry.settings["PYBRAKE"])
 
-    notifier.add_filter(request_filter)
+    notifier.add_request_filter(request_filter)
     config.registry.settings.update({"pybrake": notifier})
 
     # Error Notification Patch
@@ -1,4 +1,3 @@
-import time
 from typing import (
     Dict,
     Optional,
@@ -76,7 +75,7 @@ class PybrakeErrorHandler(ErrorHandler):
         notice = notifier.build_notice(exception)
         if request:
             notice = request_filter(request, notice)
-        notifier.send_notice(notice)
+        notifier.spawn_async(notifier.send_notice_async(notice))
         return super().default(request, exception)
 
 
@@ -111,9 +110,10 @@ def init_app(app, sqlEngine=None) -> Sanic:
         if metric is not None:
             metric.status_code = resp.status
             metric.content_type = resp.content_type
-            metric.end_time = time.time()
+            metric.end()
             notifier.routes.notify(metric)
             set_active_metric(None)
+            metric.release()
 
     # Query Stats Monitoring
 
@@ -176,7 +176,7 @@ def _after_cursor(notifier):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
             )
 
     return _sqla_after_cursor_execute
@@ -1,6 +1,5 @@
 import contextvars
 import logging
-import time
 import traceback
 import types
 
@@ -11,7 +10,8 @@ from starlette.routing import Match
 from starlette.types import Receive, Scope, Send
 
 from ..metrics import (
-    set_active as set_active_metrics,
+    enter_metric,
+    exit_metric,
     get_active as get_active_metrics,
     start_span,
     end_span,
@@ -88,17 +88,18 @@ def _before_request(request):
         route = _UNKNOWN_ROUTE
 
     metric = RouteMetric(method=request.method, route=route)
-    set_active_metrics(metric)
+    return enter_metric(metric)
 
 
-def _after_request(response, notifier):
+def _after_request(response, notifier, token):
     metric = get_active_metrics()
     if metric is not None:
         metric.status_code = response.status_code
         metric.content_type = response.headers.get("Content-Type")
-        metric.end_time = time.time()
+        metric.end()
         notifier.routes.notify(metric)
-        set_active_metrics(None)
+        metric.release()
+    exit_metric(token)
 
 
 def _before_cursor(notifier):
@@ -130,7 +131,7 @@ def _after_cursor(notifier):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
@@ -167,7 +168,7 @@ def init_pybrake(app, config, sqlEngine=None):
     notifier = Notifier(**config)
     config = notifier.config
 
-    notifier.add_filter(request_filter)
+    notifier.add_request_filter(request_filter)
 
     # Error notification patch
     old_exception_error_call = ExceptionMiddleware.__call__
@@ -177,7 +178,7 @@ def init_pybrake(app, config, sqlEngine=None):
         try:
             await old_exception_error_call(self, scope, receive, send)
         except Exception as exc:
-            notifier.notify(exc)
+            notifier.spawn_async(notifier.notify_async(exc))
             raise exc
 
     ExceptionMiddleware.__call__ = patch_exception_error_call
@@ -185,16 +186,17 @@ def init_pybrake(app, config, sqlEngine=None):
     # Route Stats monitoring
     @app.middleware("http")
     async def process_route_stats(request, call_next):
+        token = None
         if config.get("performance_stats"):
-            _before_request(request)
+            token = _before_request(request)
         try:
             response = await call_next(request)
         except Exception as e:  # pylint: disable=broad-except
             logger.exception(e)
             response = Response(content=traceback.format_exc(),
                                 status_code=500)
-        if config.get("performance_stats"):
-            _after_request(response, notifier)
+        if token is not None:
+            _after_request(response, notifier, token)
         return response
 
     # Route breakdown stats monitoring
@@ -1,10 +1,10 @@
-import time
 import traceback
 
 from tornado.web import RequestHandler, HTTPError
 
 from ..metrics import (
-    set_active as set_active_metrics,
+    enter_metric,
+    exit_metric,
     get_active as get_active_metrics,
     start_span,
     end_span,
@@ -81,11 +81,12 @@ def init_app(app):
     old_execute = RequestHandler._execute
 
     async def _patch_execute(self, transforms, *args, **kwargs):
+        token = None
         if config.get("performance_stats"):
-            _before_request(self.request, self)
+            token = _before_request(self.request, self)
         res = await old_execute(self, transforms, *args, **kwargs)
-        if config.get("performance_stats"):
-            _after_request(self, notifier)
+        if token is not None:
+            _after_request(self, notifier, token)
         return res
 
     RequestHandler._execute = _patch_execute
@@ -128,18 +129,19 @@ def _before_request(request, app):
     else:
         route = _UNKNOWN_ROUTE
     metric = RouteMetric(method=request.method, route=route)
-    set_active_metrics(metric)
+    return enter_metric(metric)
 
 
-def _after_request(response, notifier):
+def _after_request(response, notifier, token):
     metric = get_active_metrics()
     if metric is not None:
         metric.status_code = response.get_status()
         if 'Content-Type' in response._headers:
             metric.content_type = response._headers.get('Content-Type')
-        metric.end_time = time.time()
+        metric.end()
         notifier.routes.notify(metric)
-        set_active_metrics(None)
+        metric.release()
+    exit_metric(token)
 
 
 def _before_render_template(sender, template, context, **extra):
@@ -192,7 +194,7 @@ def _after_cursor(config, app):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
@@ -1,4 +1,3 @@
-import time
 import traceback
 from urllib.parse import quote as urllib_quote
 
@@ -149,7 +148,7 @@ def _after_cursor(notifier):
                 method=getattr(metric, "method", ""),
                 route=getattr(metric, "route", ""),
                 start_time=metric.start_time,
-                end_time=time.time(),
+                duration_ms=metric.elapsed_ms(),
                 function=traceback_frm.name if traceback_frm else '',
                 file=traceback_frm.filename if traceback_frm else '',
                 line=traceback_frm.lineno if traceback_frm else 0,
@@ -174,9 +173,10 @@ def _after_request(notifier):
     if metric is not None:
         metric.status_code = response.status_code
         metric.content_type = response.content_type
-        metric.end_time = time.time()
+        metric.end()
         notifier.routes.notify(metric)
         set_active_metrics(None)
+        metric.release()
 
 
 def get_host(environ):
@@ -1,99 +1,175 @@
-import json
 import collections
 
+from . import serializer
+
 
 _MAX_JSON_SIZE = 64000  # 64kb
 _NOTICE_KEYS = ["context", "params", "session", "environment"]
 
 
+class NoticeTooLargeError(ValueError):
+    """
+    NoticeTooLargeError is raised when a notice is over the size limit even
+    with errors and the keys in _NOTICE_KEYS truncated.
+    """
+
+
 def jsonify_notice(notice):
     """
     Convert error notice object from the python dictionary to the json object.
+
+    This is a bounded two-pass encoding. Every top level key is encoded once
+    with the JSON backend. If the notice is over the size limit, errors and
+    the keys in _NOTICE_KEYS are encoded a second time with the Truncator,
+    from the smallest to the largest: smaller keys take what they need and
+    the rest of the budget is shared by the larger ones. So an oversized key
+    is encoded twice, but never more, whatever its size. Truncated values are
+    written back to the notice.
     :param notice: Dictionary object of error notice
     :return: json encode error notice.
+    :raises NoticeTooLargeError: if the other keys alone are over the limit.
     """
-    b = _jsonify(notice)
-    if len(b) < _MAX_JSON_SIZE:
-        return b.encode("utf8")
+    if not isinstance(notice, dict):
+        return serializer.dumps(notice)
+
+    keys = {k: _encode_key(k) for k in notice}
+    encoded = {k: serializer.dumps(v) for k, v in notice.items()}
+    if _joined_size(keys, encoded) < _MAX_JSON_SIZE:
+        return _join(keys, encoded)
 
-    if "errors" in notice:
-        t = Truncator(0)
-        for i, error in enumerate(notice["errors"]):
-            notice["errors"][i] = t.truncate_dict(error)
+    truncatable = [k for k in notice if k == "errors" or k in _NOTICE_KEYS]
+    budget = _MAX_JSON_SIZE - 1 - _joined_size(
+        keys, {k: v for k, v in encoded.items() if k not in truncatable})
+    budget -= sum(len(keys[k]) + 2 for k in truncatable)
+    # Truncated values take at least 2 bytes ({}, [] or "").
+    if budget < 2 * len(truncatable):
+        raise NoticeTooLargeError(
+            f"notice is over {_MAX_JSON_SIZE} bytes even if truncated")
 
-    for level in range(10):
-        b = _jsonify(notice)
-        if len(b) < _MAX_JSON_SIZE:
-            break
+    t = Truncator(0)
+    truncatable.sort(key=lambda k: len(encoded[k]))
+    for i, key in enumerate(truncatable):
+        share = budget // (len(truncatable) - i)
+        notice[key], encoded[key] = t.encode(notice[key], share)
+        budget -= len(encoded[key])
 
-        t = Truncator(level)
-        for key in _NOTICE_KEYS:
-            if key in notice:
-                notice[key] = t.truncate_dict(notice[key])
+    return _join(keys, encoded)
 
-    return b.encode("utf8")
 
+def _joined_size(keys, encoded):
+    if not encoded:
+        return 2
+    return 2 + sum(len(keys[k]) + 2 + len(v) for k, v in encoded.items()) - 1
 
-def _jsonify(obj):
-    return json.dumps(obj, default=_set_default)
 
+def _join(keys, encoded):
+    return b"{" + b",".join(keys[k] + b":" + v for k, v in encoded.items()) \
+        + b"}"
 
-def _set_default(obj):
-    if isinstance(obj, set):
-        return list(obj)
-    if isinstance(obj, (bytes, bytearray)):
-        return obj.decode("utf8", "replace")
-    if isinstance(
-        obj, (collections.UserDict, collections.UserList, collections.UserString)
-    ):
-        return obj.data
-    return str(obj)
+
+def _encode_key(k):
+    if isinstance(k, str):
+        return serializer.dumps(k)
+    # json converts int, float, bool and None keys to strings.
+    return serializer.dumps(serializer.dumps(k).decode("utf8"))
 
 
 class Truncator:
+    """
+    Truncator limits the number of dict items, list items and string length
+    while encoding a value to json, and stops adding items once the encoded
+    size reaches the byte budget.
+    """
+
     def __init__(self, level=0):
         self._max_dict_len = _scale(128, level)
         self._max_list_len = _scale(128, level)
         self._max_str_len = _scale(1024, level)
 
-    def truncate_dict(self, d):
-        res = {}
-        i = 0
-        for k, v in d.items():
-            res[k] = self.truncate(v)
-            i += 1
-            if i >= self._max_dict_len:
-                break
-        return res
-
-    def truncate_list(self, l):
-        res = []
-        for i, v in enumerate(l):
-            res.append(self.truncate(v))
-            if i >= self._max_list_len:
-                break
-        return res
+    def encode(self, v, budget):
+        """
+        Returns the truncated value and its json encoding that is at most
+        budget bytes long.
+        """
+        res = self._encode(v, budget)
+        if res is not None:
+            return res
+        if isinstance(v, collections.abc.Mapping):
+            return {}, b"{}"
+        return "", b'""'
 
-    def truncate_str(self, s):
-        if len(s) <= self._max_str_len:
-            return s
-        return s[: self._max_str_len]
+    def _encode(self, v, budget):
+        if isinstance(v, (bytes, bytearray)):
+            v = v.decode("utf8", "replace")
+        elif isinstance(v, collections.UserString):
+            v = v.data
 
-    def truncate(self, v):
         if isinstance(v, str):
-            return self.truncate_str(v)
-        if isinstance(v, (bytes, bytearray)):
-            return self.truncate_str(v.decode("utf8", "replace"))
-        if isinstance(v, collections.UserString):
-            return self.truncate_str(v.data)
+            return self._encode_str(v, budget)
+
+        if v is None or isinstance(v, (bool, int, float)):
+            s = serializer.dumps(v)
+            return (v, s) if len(s) <= budget else None
 
         if isinstance(v, collections.abc.Mapping):
-            return self.truncate_dict(v)
+            return self._encode_dict(v, budget)
 
         if isinstance(v, collections.abc.Iterable):
-            return self.truncate_list(v)
+            return self._encode_list(v, budget)
+
+        return self._encode_str(str(v), budget)
+
+    def _encode_dict(self, d, budget):
+        if budget < 2:
+            return None
+
+        res = {}
+        parts = []
+        size = 2
+        for k, v in d.items():
+            key = _encode_key(k)
+            overhead = len(key) + 1 + (1 if parts else 0)
+            r = self._encode(v, budget - size - overhead)
+            if r is None:
+                break
+            res[k] = r[0]
+            parts.append(key + b":" + r[1])
+            size += overhead + len(r[1])
+            if len(parts) >= self._max_dict_len:
+                break
+        return res, b"{" + b",".join(parts) + b"}"
 
-        return v
+    def _encode_list(self, l, budget):
+        if budget < 2:
+            return None
+
+        res = []
+        parts = []
+        size = 2
+        for i, v in enumerate(l):
+            overhead = 1 if parts else 0
+            r = self._encode(v, budget - size - overhead)
+            if r is None:
+                break
+            res.append(r[0])
+            parts.append(r[1])
+            size += overhead + len(r[1])
+            if i >= self._max_list_len:
+                break
+        return res, b"[" + b",".join(parts) + b"]"
+
+    def _encode_str(self, s, budget):
+        if budget < 2:
+            return None
+
+        s = s[: self._max_str_len]
+        encoded = serializer.dumps(s)
+        while len(encoded) > budget:
+            # Escaped and non-ASCII characters take more than one byte, so
+            # cut at least by the excess and try again.
+            s = s[: max(0, len(s) - (len(encoded) - budget))]
+            encoded = serializer.dumps(s)
+        return s, encoded
 
 
 def _scale(num, level):
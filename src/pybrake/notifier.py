@@ -1,16 +1,24 @@
+import asyncio
+import atexit
 import json
 import os
 import platform
 import re
+import signal
 import socket
 import sys
+import threading
 import time
 import warnings
 from concurrent import futures
 from pathlib import Path
 
-from .backlog import Backlog
+from .aggregator import Aggregator
+from .backlog import Backlog, make_spool
+from .backpressure import BackPressure
 from .blocklist_filter import make_blocklist_filter
+from .circuit import CircuitBreaker
+from .coalescer import Coalescer
 from .code_hunks import get_code_hunk
 from .constant import (
     AIRBRAKE_HOST, AIRBRAKE_CONFIG_HOST, notifier_name, version
@@ -22,8 +30,16 @@ from .queries import QueryStats
 from .queues import QueueStats
 from .remote_settings import RemoteSettings
 from .routes import _Routes
+from .sender import DROP_NEWEST, Sender
+from .transport import AsyncTransport, Transport
+from .utils import logger
 
 _ERR_IP_RATE_LIMITED = "IP is rate limited"
+_ERR_COALESCED = "notice is coalesced"
+
+_MAX_CACHED_FRAMES = 1000
+# Frames of these files are skipped in the backtrace of string errors.
+_INTERNAL_FILES = ("pybrake/notifier.py", "pybrake/coalescer.py")
 
 _AB_URL_FORMAT = "{}/api/v3/projects/{}/notices"
 
@@ -35,9 +51,19 @@ _CONTEXT = dict(
     os=platform.platform(),
     language=f"Python/{platform.python_version()}",
     hostname=socket.gethostname(),
-    versions=dict(python=platform.python_version()),
 )
 
+# (len(sys.modules), versions) of the last module versions snapshot.
+_versions_snapshot = (0, {})
+
+
+def _frame_from_record(record):
+    file, function, line, code = record
+    frame = dict(file=file, function=function, line=line)
+    if code is not None:
+        frame["code"] = dict(code)
+    return frame
+
 
 class Notifier:
     """
@@ -60,10 +86,16 @@ class Notifier:
                 default: True.
         :param queue_stats: Enable/disable queue stats monitoring,
                 default: True.
-        :param max_queue_size: Maximum number for thread pool queue size,
+        :param max_queue_size: Maximum number of notices queued for sending
+                and of notices in flight sent by send_notice_async,
                 default value 1000.
-        :param max_workers: Maximum number of thread pool can make by
-                Notifier, default value number CPU count * 5.
+        :param max_workers: Number of sender threads, default value 2.
+        :param queue_drop_policy: What to do when the notice queue is full:
+                "drop_newest", "drop_oldest" or "block" (wait up to
+                queue_block_timeout seconds, then drop the new notice),
+                default value "drop_newest".
+        :param queue_block_timeout: Number of seconds to wait for free
+                space with the "block" drop policy, default value 1.
         :param root_directory: Root directory path of project.
         :param environment: Project running environment, Like: development,
                 testing, production. Can make own environment.
@@ -76,6 +108,65 @@ class Notifier:
         :param backlog_enabled: If backlog_enabled set as true then
                 pybrake will manage failed stats and error notification and
                 try to send it again. Default value: False
+        :param backlog_dir: Directory where the backlog keeps failed stats
+                and error notices (in the apm and errors subdirectories), so
+                they survive restarts and are replayed on the next start.
+                Default value None (the backlog is kept in memory).
+        :param backlog_max_bytes: Maximum size of each backlog directory,
+                oldest items are dropped first, default value 16MB.
+        :param backlog_max_attempts: Number of times the backlog retries a
+                failed item, with exponential backoff and jitter, default
+                value 5.
+        :param backlog_max_parallel: Number of backlog items that are sent
+                at once, default value 4.
+        :param max_connections: Maximum number of keep-alive connections
+                per Airbrake host shared by error notices, performance
+                stats and backlog, default value 10.
+        :param coalesce_window: Number of seconds during which repeated
+                errors with the same fingerprint (exception type and top
+                backtrace frames) are folded into one follow-up notice
+                with an occurrence count, default 0 (disabled).
+        :param coalesce_depth: Number of innermost backtrace frames used
+                to fingerprint errors, default value 3.
+        :param deferred_notices: If set as true then notify only captures
+                the exception and a request snapshot (filters added with
+                add_request_filter) on the calling thread. Backtrace, code
+                hunks, context, filters and JSON encoding run on the
+                background sender. Default value: False
+        :param compression: Compress request bodies of error notices and
+                performance stats with "gzip" or "deflate", default None
+                (disabled). Compression runs on the sender threads.
+        :param compression_threshold: Minimum request body size in bytes
+                that is compressed, default value 1024.
+        :param span_tree: If set as true then route breakdowns include the
+                call count, total time and self time of every span path
+                (e.g. http.handler/template/sql). Default value: False
+        :param span_tree_max_depth: Maximum depth of span paths, deeper
+                spans are recorded as "other", default value 4.
+        :param span_tree_max_width: Maximum number of children of a span
+                path in a route breakdown, later children are recorded as
+                "other", default value 16.
+        :param aggregate_socket: Path of a Unix socket shared by the worker
+                processes of a pre-fork server. One worker merges the
+                route, breakdown, query and queue stats of all workers and
+                sends one payload per endpoint per flush. Default value
+                None (every process sends its own stats).
+        :param circuit_failure_threshold: Number of consecutive connection
+                failures after which requests to an Airbrake host fail fast
+                without I/O (payloads go to the backlog if it is enabled),
+                default value 5. 0 disables the circuit breaker.
+        :param circuit_reset_timeout: Number of seconds after which a single
+                probe request is sent to a host with an open circuit,
+                default value 30.
+        :param close_on_exit: If set as true then pending stats and notices
+                are flushed by close at interpreter exit. Default value:
+                False
+        :param close_on_sigterm: If set as true then pending stats and
+                notices are flushed by close when the process receives
+                SIGTERM, before the previous SIGTERM handler runs. Default
+                value: False
+        :param close_timeout: Number of seconds close waits for pending
+                stats and notices on exit or SIGTERM, default value 5.
         """
 
         self.config = {
@@ -85,10 +176,27 @@ class Notifier:
             "queue_stats": kwargs.get("queue_stats", True),
             "max_backlog_size": kwargs.get("max_backlog_size", 100),
             "backlog_enabled": kwargs.get("backlog_enabled", False),
+            "backlog_dir": kwargs.get("backlog_dir"),
+            "backlog_max_bytes": kwargs.get("backlog_max_bytes"),
+            "backlog_max_attempts": kwargs.get("backlog_max_attempts"),
+            "backlog_max_parallel": kwargs.get("backlog_max_parallel"),
+            "span_tree": kwargs.get("span_tree", False),
+            "span_tree_max_depth": kwargs.get("span_tree_max_depth", 4),
+            "span_tree_max_width": kwargs.get("span_tree_max_width", 16),
             "error_host": host,
             "apm_host": host,
         }
         kwargs["config"] = self.config
+        if self.config["span_tree"]:
+            # Metrics record the deepest tree any notifier needs, and every
+            # notifier bounds the trees by its own options.
+            metrics.set_span_tree(max(metrics.get_span_tree(),
+                                      self.config["span_tree_max_depth"]))
+
+        self._init_transports(kwargs)
+        self.backpressure = BackPressure()
+        kwargs["backpressure"] = self.backpressure
+        self._init_aggregator(kwargs, project_key)
 
         self.routes = _Routes(
             project_id=project_id, project_key=project_key, **kwargs
@@ -107,10 +215,20 @@ class Notifier:
         )
 
         self._filters = []
+        self._frames = {}
+        self._frames_lock = threading.Lock()
+        self._request_filters = []
+        self._deferred = kwargs.get("deferred_notices", False)
         self._rate_limit_reset = 0
         self._max_queue_size = kwargs.get("max_queue_size", 1000)
-        self._thread_pool = None
-        self._max_workers = kwargs.get('max_workers')
+        self._sender = None
+        self._sender_lock = threading.Lock()
+        self._sender_options = dict(
+            max_queue_size=self._max_queue_size,
+            workers=kwargs.get("max_workers", 2),
+            drop_policy=kwargs.get("queue_drop_policy", DROP_NEWEST),
+            block_timeout=kwargs.get("queue_block_timeout", 1),
+        )
 
         self._ab_url = _AB_URL_FORMAT.format(host, project_id)
         self._ab_headers = {
@@ -121,6 +239,14 @@ class Notifier:
         self._context = _CONTEXT.copy()
         self._context["rootDirectory"] = kwargs.get("root_directory",
                                                     os.getcwd())
+        self._coalescer = None
+        if kwargs.get("coalesce_window"):
+            self._coalescer = Coalescer(
+                self,
+                window=kwargs["coalesce_window"],
+                depth=kwargs.get("coalesce_depth", 3),
+            )
+
         self._backlog = None
         if self.config.get('backlog_enabled'):
             if metrics.Error_Backlog is None:
@@ -130,6 +256,10 @@ class Notifier:
                     maxlen=self.config.get('max_backlog_size'),
                     error_notice=True,
                     notifier=self,
+                    transport=self.transport,
+                    spool=make_spool(self.config, "errors"),
+                    max_attempts=self.config.get('backlog_max_attempts'),
+                    max_parallel=self.config.get('backlog_max_parallel'),
                 )
             self._backlog = metrics.Error_Backlog
 
@@ -148,6 +278,18 @@ class Notifier:
         if "environment" in kwargs:
             self._context["environment"] = kwargs["environment"]
 
+        self._add_default_filters(kwargs)
+
+        self._install_close_hooks(kwargs)
+
+        if kwargs.get("remote_config"):
+            RemoteSettings(
+                project_id,
+                AIRBRAKE_CONFIG_HOST,
+                self.config,
+            ).poll()
+
+    def _add_default_filters(self, kwargs):
         self.add_filter(pybrake_error_filter)
 
         keys_blacklist = kwargs.get("keys_blacklist")
@@ -169,44 +311,169 @@ class Notifier:
         if "filter" in kwargs:
             self.add_filter(kwargs["filter"])
 
-        if kwargs.get("remote_config"):
-            RemoteSettings(
-                project_id,
-                AIRBRAKE_CONFIG_HOST,
-                self.config,
-            ).poll()
+    def flush(self, timeout=None):
+        """
+        Sends aggregated route, route breakdown, query and queue stats,
+        pending coalesced notices and queued notices right away, in
+        parallel, and waits up to timeout seconds for them.
+
+        Returns a report: dropped maps each kind to the number of stats or
+        notices that were not sent (None if flushing failed), backlogged
+        maps each kind of stats to the number of stats handed to the backlog
+        for a later retry and timed_out lists the kinds that were still being
+        sent when the timeout expired.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        tasks = dict(
+            routes=self.routes.stats.flush,
+            breakdowns=self.routes.breakdowns.flush,
+            queries=self.queries.flush,
+            queues=self.queues.flush,
+        )
+        if self._coalescer is not None:
+            tasks["coalesced"] = lambda timeout: (self._coalescer.flush(), 0)
+        join = _start_flush_tasks(tasks, timeout)
+
+        # Sender.flush returns by the deadline, so wait for queued notices
+        # on this thread while the stats are sent in parallel.
+        notices = 0
+        if self._sender is not None:
+            notices = self._sender.flush(timeout)
+
+        report = join(deadline)
+        report["dropped"] = dict(notices=notices, **report["dropped"])
+        if self.aggregator is not None:
+            # Stats of this process were merged by the flushes above.
+            report["dropped"]["aggregated"] = self.aggregator.flush(
+                _remaining(deadline))
+        return report
+
+    def close(self, timeout=None):
+        """
+        Flushes pending stats and notices (see flush), stops the notice
+        sender and closes idle connections within timeout seconds. Returns
+        the flush report.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        report = self.flush(timeout)
+        if self._sender is not None:
+            self._sender.shutdown(timeout=_remaining(deadline))
+        if self.aggregator is not None:
+            self.aggregator.close()
+        self.transport.close()
+        self.async_transport.close()
+
+        if report["timed_out"] or any(report["dropped"].values()):
+            logger.warning("pybrake: close did not send everything: %s",
+                           report)
+        return report
+
+    def _init_transports(self, kwargs):
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=kwargs.get("circuit_failure_threshold", 5),
+            reset_timeout=kwargs.get("circuit_reset_timeout", 30),
+        )
+        transport_options = dict(
+            max_connections=kwargs.get("max_connections", 10),
+            compression=kwargs.get("compression"),
+            compression_threshold=kwargs.get("compression_threshold", 1024),
+            circuit_breaker=self.circuit_breaker,
+        )
+        self.transport = Transport(**transport_options)
+        kwargs["transport"] = self.transport
+        self.async_transport = AsyncTransport(
+            fallback=self.transport, **transport_options
+        )
+        self._async_in_flight = 0
+        self._async_tasks = set()
+
+    def _init_aggregator(self, kwargs, project_key):
+        self.aggregator = None
+        if kwargs.get("aggregate_socket"):
+            self.aggregator = Aggregator(
+                kwargs["aggregate_socket"],
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": "Bearer " + project_key,
+                },
+                transport=self.transport,
+                backpressure=self.backpressure,
+            )
+        kwargs["aggregator"] = self.aggregator
+
+    def _install_close_hooks(self, kwargs):
+        self._close_timeout = kwargs.get("close_timeout", 5)
+        if kwargs.get("close_on_exit"):
+            atexit.register(self.close, self._close_timeout)
+        if kwargs.get("close_on_sigterm"):
+            self._install_sigterm_handler()
 
-    def close(self):
-        if self._thread_pool is not None:
-            self._thread_pool.shutdown()
+    def _install_sigterm_handler(self):
+        if threading.current_thread() is not threading.main_thread():
+            logger.warning("pybrake: SIGTERM handler can only be installed "
+                           "from the main thread")
+            return
+
+        prev = signal.getsignal(signal.SIGTERM)
+
+        def handler(signum, frame):
+            self.close(self._close_timeout)
+            if callable(prev):
+                prev(signum, frame)
+            elif prev != signal.SIG_IGN:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, handler)
 
     def add_filter(self, filter_fn):
         """Appends filter to the list.
 
         Filter is a function that accepts notice. Filter can modify passed
-        notice or return None if notice must be ignored.
+        notice or return None if notice must be ignored. Backtrace frames
+        are shared read-only records and must be replaced, not modified.
+        """
+        self._filters.append(filter_fn)
+
+    def add_request_filter(self, filter_fn):
+        """Appends filter that collects data of the current request.
+
+        It works like add_filter, but with deferred_notices enabled it is
+        called on the thread that raised the error, with a notice snapshot
+        that only has empty context and params. What it adds is merged into
+        the notice once it is built on the background sender.
         """
         self._filters.append(filter_fn)
+        self._request_filters.append(filter_fn)
 
     def notify_sync(self, err):
         """Notifies Airbrake about exception.
 
         Under the hood notify is a shortcut for build_notice and send_notice.
         """
+        notice = self._coalesced(err)
+        if notice is not None:
+            return notice
+
         notice = self.build_notice(err)
         return self.send_notice_sync(notice)
 
     def build_notice(self, err):
         """Builds Airbrake notice from the exception."""
+        return self._build_notice(err)
+
+    def _build_notice(self, err, stack=None):
         notice = dict(
-            errors=self._build_errors(err),
+            errors=self._build_errors(err, stack=stack),
             context=self._build_context(),
             params=dict(sys_executable=sys.executable, sys_path=sys.path),
         )
         return notice
 
-    def _filter_notice(self, notice):
+    def _filter_notice(self, notice, skip=()):
         for fn in self._filters[::-1]:
+            if fn in skip:
+                continue
             r = fn(notice)
             if r is None:
                 notice["error"] = "notice is filtered out"
@@ -238,7 +505,7 @@ class Notifier:
 
         return metrics.send_notice(
             notifier=self, notice=notice, url=self._ab_url,
-            headers=self._ab_headers, method="POST"
+            headers=self._ab_headers, method="POST", transport=self.transport
         )
 
     def _rate_limited(self, notice, resp):
@@ -258,55 +525,153 @@ class Notifier:
         notice["error"] = data['message']
         return notice
 
-    def notify(self, err):
+    def notify(self, err, *, future=True):
         """
         Asynchronously notifies Airbrake about exception from separate thread.
 
-        Returns concurrent.futures.Future.
+        Returns concurrent.futures.Future, or None if future is false.
         """
+        notice = self._coalesced(err)
+        if notice is not None:
+            return _done(notice, future)
+
+        if self._deferred:
+            return self._send_deferred(err, future=future)
+
         notice = self.build_notice(err)
-        return self.send_notice(notice)
+        return self.send_notice(notice, future=future)
+
+    def _send_deferred(self, err, *, future=True):
+        snapshot = dict(context={}, params={})
+        if not self.config.get("error_notifications"):
+            snapshot["error"] = "error notifications are disabled"
+            return _done(snapshot, future)
+
+        snapshot, ok = self._filter_request(snapshot)
+        if not ok:
+            return _done(snapshot, future)
+
+        stack = None
+        if isinstance(err, str):
+            stack = list(self._walk_stack(self._caller_frame()))
+
+        return self._get_sender().submit(
+            self._build_and_send, snapshot, err, stack, future=future)
+
+    def _filter_request(self, notice):
+        for fn in self._request_filters[::-1]:
+            r = fn(notice)
+            if r is None:
+                notice["error"] = "notice is filtered out"
+                return notice, False
+            notice = r
+
+        return notice, True
+
+    def _build_and_send(self, snapshot, err, stack):
+        notice = self._build_notice(err, stack=stack)
+        for key, value in snapshot.items():
+            if isinstance(value, dict) and isinstance(notice.get(key), dict):
+                notice[key].update(value)
+            else:
+                notice[key] = value
+
+        notice, ok = self._filter_notice(notice, skip=self._request_filters)
+        if not ok:
+            return notice
 
-    def send_notice(self, notice):
+        return self._send_notice_sync(notice)
+
+    def send_notice(self, notice, *, future=True):
         """
         Asynchronously sends notice to Airbrake from separate thread.
 
-        Returns concurrent.futures.Future.
+        Returns concurrent.futures.Future, or None if future is false.
+        """
+        if not self.config.get("error_notifications"):
+            notice["error"] = "error notifications are disabled"
+            return _done(notice, future)
+
+        notice, ok = self._filter_notice(notice)
+        if not ok:
+            return _done(notice, future)
+
+        return self._get_sender().submit(
+            self._send_notice_sync, notice, future=future)
+
+    async def notify_async(self, err):
+        """
+        Notifies Airbrake about exception on the running event loop using
+        a non-blocking HTTP client.
+
+        Returns notice like notify_sync.
+        """
+        notice = self._coalesced(err)
+        if notice is not None:
+            return notice
+
+        notice = self.build_notice(err)
+        return await self.send_notice_async(notice)
+
+    def spawn_async(self, coro):
+        """
+        Runs coro, e.g. notify_async(err), as a task on the running event
+        loop without waiting for it. The loop only keeps weak references to
+        tasks, so the notifier holds the task until it is done.
+        """
+        task = asyncio.ensure_future(coro)
+        self._async_tasks.add(task)
+        task.add_done_callback(self._async_tasks.discard)
+        return task
+
+    async def send_notice_async(self, notice):
+        """
+        Sends notice to Airbrake on the running event loop. The number of
+        notices in flight is bounded by max_queue_size.
+
+        Returns notice like send_notice_sync.
         """
         if not self.config.get("error_notifications"):
             notice["error"] = "error notifications are disabled"
-            f = futures.Future()
-            f.set_result(notice)
-            return f
+            return notice
 
         notice, ok = self._filter_notice(notice)
         if not ok:
-            f = futures.Future()
-            f.set_result(notice)
-            return f
+            return notice
 
-        pool = self._get_thread_pool()
-        if pool._work_queue.qsize() >= self._max_queue_size:
+        if self._async_in_flight >= self._max_queue_size:
             notice["error"] = "queue is full"
-            f = futures.Future()
-            f.set_result(notice)
-            return f
+            return notice
+
+        if time.time() < self._rate_limit_reset:
+            notice["error"] = _ERR_IP_RATE_LIMITED
+            return notice
+
+        self._async_in_flight += 1
+        try:
+            return await metrics.send_notice_async(
+                notifier=self, notice=notice, url=self._ab_url,
+                headers=self._ab_headers, method="POST",
+                transport=self.async_transport,
+            )
+        finally:
+            self._async_in_flight -= 1
 
-        return pool.submit(self._send_notice_sync, notice)
+    def _coalesced(self, err):
+        if self._coalescer is None or err is None:
+            return None
+        if self._coalescer.add(err):
+            return None
+        return dict(error=_ERR_COALESCED)
 
-    def _build_errors(self, err):
+    def _build_errors(self, err, stack=None):
         if err is None:
             return []
 
         if isinstance(err, str):
-            frame = sys._getframe()
-            while frame is not None:
-                if frame.f_code.co_filename.endswith("pybrake/notifier.py"):
-                    frame = frame.f_back
-                else:
-                    break
-
-            backtrace = self._build_backtrace_frame(frame)
+            if stack is None:
+                stack = self._walk_stack(self._caller_frame())
+            backtrace = self._build_backtrace_stack(stack)
             return [{"message": err, "backtrace": backtrace}]
 
         errors = []
@@ -326,7 +691,8 @@ class Notifier:
         for frame, lineno in self._walk_tb(tb):
             f = self._build_frame(frame, lineno)
             if f:
-                backtrace.insert(0, f)
+                backtrace.append(f)
+        backtrace.reverse()
         return backtrace
 
     def _walk_tb(self, tb):
@@ -334,9 +700,18 @@ class Notifier:
             yield tb.tb_frame, tb.tb_lineno
             tb = tb.tb_next
 
-    def _build_backtrace_frame(self, f):
+    def _caller_frame(self):
+        frame = sys._getframe()
+        while frame is not None:
+            if frame.f_code.co_filename.endswith(_INTERNAL_FILES):
+                frame = frame.f_back
+            else:
+                break
+        return frame
+
+    def _build_backtrace_stack(self, stack):
         backtrace = []
-        for frame, lineno in self._walk_stack(f):
+        for frame, lineno in stack:
             f = self._build_frame(frame, lineno)
             if f:
                 backtrace.append(f)
@@ -351,14 +726,30 @@ class Notifier:
         if f.f_locals.get("__traceback_hide__"):
             return None
 
+        # Rendered frames are cached as immutable records, and every notice
+        # gets its own copy that filters can change.
+        key = (f.f_code, line)
+        record = self._frames.get(key)
+        if record is not None:
+            return _frame_from_record(record)
+
         filename = f.f_code.co_filename
         func = f.f_code.co_name
 
         loader = f.f_globals.get("__loader__")
         module_name = f.f_globals.get("__name__")
-        return self._frame_with_code(
+        frame = self._frame_with_code(
             filename, func, line, loader=loader, module_name=module_name
         )
+        code = frame.get("code")
+        record = (frame["file"], frame["function"], frame["line"],
+                  None if code is None else tuple(code.items()))
+
+        with self._frames_lock:
+            if len(self._frames) >= _MAX_CACHED_FRAMES:
+                del self._frames[next(iter(self._frames))]
+            self._frames[key] = record
+        return frame
 
     def _frame_with_code(
             self, filename, func, line, loader=None, module_name=None
@@ -386,23 +777,101 @@ class Notifier:
 
     def _build_context(self):
         ctx = self._context.copy()
+        ctx["notifier"] = ctx["notifier"].copy()
+        ctx["versions"] = module_versions().copy()
+        return ctx
 
-        versions = ctx["versions"]
-        for name, mod in sys.modules.copy().items():
-            if name.startswith("_"):
-                continue
-            if hasattr(mod, "__version__"):
-                versions[name] = mod.__version__
+    def _get_sender(self):
+        if self._sender is None:
+            with self._sender_lock:
+                if self._sender is None:
+                    self._sender = Sender(**self._sender_options)
+        return self._sender
 
-        return ctx
+    def sender_stats(self):
+        """
+        Returns counters of enqueued, dropped, sent and failed notices.
+        """
+        if self._sender is None:
+            return dict(enqueued=0, dropped=0, sent=0, failed=0, queued=0)
+        return self._sender.stats()
+
+
+def _start_flush_tasks(tasks, timeout):
+    """
+    Runs every task(timeout) in its own thread and returns a function that
+    waits for them until the deadline and returns the flush report. Tasks
+    return the number of dropped and of backlogged items.
+    """
+    results = {}
+
+    def run(name, fn):
+        try:
+            results[name] = fn(timeout)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.error(err)
+            results[name] = (None, None)
+
+    threads = []
+    for name, fn in tasks.items():
+        t = threading.Thread(target=run, args=(name, fn),
+                             name=f"pybrake-flush-{name}")
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    def join(deadline):
+        for t in threads:
+            t.join(_remaining(deadline))
+        done = [name for name in tasks if name in results]
+        return dict(
+            dropped={name: results[name][0] for name in done},
+            backlogged={name: results[name][1] for name in done
+                        if name != "coalesced"},
+            timed_out=[name for name in tasks if name not in results],
+        )
+
+    return join
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+def _done(notice, future):
+    if not future:
+        return None
+    f = futures.Future()
+    f.set_result(notice)
+    return f
+
+
+def module_versions():
+    """
+    Returns versions of the loaded modules that define __version__.
+
+    Walking sys.modules is expensive in large applications, so the result is
+    cached and shared by all notifiers. It is rebuilt only when the number of
+    loaded modules changes. The returned dict must not be modified.
+    """
+    global _versions_snapshot  # pylint: disable=global-statement
+
+    num_modules, versions = _versions_snapshot
+    if num_modules == len(sys.modules):
+        return versions
+
+    modules = sys.modules.copy()
+    versions = dict(python=platform.python_version())
+    for name, mod in modules.items():
+        if name.startswith("_"):
+            continue
+        if hasattr(mod, "__version__"):
+            versions[name] = mod.__version__
 
-    def _get_thread_pool(self):
-        if self._thread_pool is None:
-            if self._max_workers is None:
-                self._max_workers = (os.cpu_count() or 1) * 5
-            self._thread_pool = futures.ThreadPoolExecutor(
-                max_workers=self._max_workers)
-        return self._thread_pool
+    _versions_snapshot = (len(modules), versions)
+    return versions
 
 
 def pybrake_error_filter(notice):
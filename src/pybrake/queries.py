@@ -1,10 +1,9 @@
 import base64
-import json
-import threading
 
 from . import metrics
-from . import constant
-from .backlog import Backlog
+from . import serializer
+from .backlog import Backlog, make_spool
+from .shards import ShardedStats
 from .tdigest import TDigestStat, as_bytes
 from .utils import time_trunc_minute
 
@@ -38,7 +37,7 @@ class QueryStat(TDigestStat):
         self.time = time_trunc_minute(time)
 
 
-class QueryStats:
+class QueryStats(ShardedStats):
     """
     Query stats are transmitted to the Airbrake site using QueryStats.
     QueryStat will collect query execution statistics such as query start time,
@@ -46,6 +45,7 @@ class QueryStats:
     """
 
     def __init__(self, *, project_id=0, project_key="", **kwargs):
+        super().__init__(backpressure=kwargs.get("backpressure"))
         self._config = kwargs["config"]
 
         self._project_id = project_id
@@ -54,10 +54,9 @@ class QueryStats:
             "Authorization": "Bearer " + project_key,
         }
         self._env = kwargs.get("environment")
+        self._transport = kwargs.get("transport")
+        self._aggregator = kwargs.get("aggregator")
 
-        self._thread = None
-        self._lock = threading.Lock()
-        self._stats = None
         self._backlog = None
         if self._config.get('backlog_enabled'):
             if not metrics.APM_Backlog:
@@ -65,13 +64,24 @@ class QueryStats:
                     header=self._ab_headers,
                     method="POST",
                     maxlen=self._config.get('max_backlog_size'),
+                    transport=self._transport,
+                    spool=make_spool(self._config, "apm"),
+                    max_attempts=self._config.get('backlog_max_attempts'),
+                    max_parallel=self._config.get('backlog_max_parallel'),
                 )
             self._backlog = metrics.APM_Backlog
 
     def notify(
             self, *, query="", method="", route="", start_time=None,
-            function="",  file="", line=0, end_time=None
+            function="",  file="", line=0, end_time=None, duration_ms=None
     ):
+        # pylint: disable=too-many-arguments
+        """
+        Records a query. start_time is the wall time used for the minute
+        bucket. The duration is duration_ms if it is given (measured with a
+        monotonic clock), otherwise the difference of end_time and
+        start_time.
+        """
         if not self._config.get("performance_stats"):
             return
         if not self._config.get("query_stats"):
@@ -81,46 +91,37 @@ class QueryStats:
             query=query, method=method, route=route, time=start_time,
             function=function, file=file, line=line
         )
-        ms = (end_time - start_time) * 1000
-
-        with self._lock:
-            if self._stats is None:
-                self._stats = {}
-                self._thread = threading.Timer(
-                    constant.FLUSH_PERIOD, self._flush)
-                self._thread.start()
-
-            if key in self._stats:
-                stat = self._stats[key]
-            else:
+        if duration_ms is not None:
+            ms = duration_ms
+        else:
+            ms = (end_time - start_time) * 1000
+
+        shard = self._shards.get()
+        with shard.lock:
+            stat = shard.stats.get(key)
+            if stat is None:
                 stat = QueryStat(
                     query=query, method=method, route=route, time=start_time,
                     function=function, file=file, line=line
                 )
-                self._stats[key] = stat
+                shard.stats[key] = stat
             stat.add(ms)
+        self._ensure_timer()
 
-    def _flush(self):
-        """
-        TODO: Below disabled pylint will remove in refactoring
-        """
-        # pylint: disable=too-many-branches
-        stats = None
-        with self._lock:
-            stats = self._stats
-            self._stats = None
-
-        if not stats:
-            raise ValueError("stats is empty")
-
+    def _send(self, stats):
         out = {"queries": [v.__dict__ for v in stats.values()]}
         if self._env:
             out["environment"] = self._env
 
-        out = json.dumps(out).encode("utf8")
-        metrics.send(
+        out = serializer.dumps(out)
+        if self._aggregator is not None and \
+                self._aggregator.submit(self._ab_url(), out):
+            return True
+        return metrics.send(
             url=self._ab_url(), payload=out,
             headers=self._ab_headers, method="POST",
+            transport=self._transport,
+            backpressure=self._backpressure,
         )
 
     def _ab_url(self):
@@ -1,21 +1,25 @@
 import base64
-import json
-import threading
 
 from . import constant
 from . import metrics
-from .backlog import Backlog
+from . import serializer
+from .backlog import Backlog, make_spool
+from .shards import ShardedStats
 from .tdigest import as_bytes, TDigestStatGroups
 from .utils import time_trunc_minute
 
 
 class QueueMetric(metrics.Metric):
+    __slots__ = ("queue",)
+
     def __init__(self, *, queue=""):
         super().__init__()
         self.queue = queue
         self.start_span(constant.QUEUE_HANDLER, start_time=self.start_time)
 
     def end(self):
+        if self._end_ns is not None:
+            return
         super().end()
         self.end_span(constant.QUEUE_HANDLER, end_time=self.end_time)
 
@@ -51,7 +55,7 @@ class _QueueStat(TDigestStatGroups):
         return d
 
 
-class QueueStats:
+class QueueStats(ShardedStats):
     """
     Queue (background task, cron task) stats are transmitted to the Airbrake
     site using QueueStats.
@@ -60,6 +64,7 @@ class QueueStats:
     """
 
     def __init__(self, *, project_id=0, project_key="", **kwargs):
+        super().__init__(backpressure=kwargs.get("backpressure"))
         self._config = kwargs["config"]
 
         self._project_id = project_id
@@ -68,10 +73,9 @@ class QueueStats:
             "Authorization": "Bearer " + project_key,
         }
         self._env = kwargs.get("environment")
+        self._transport = kwargs.get("transport")
+        self._aggregator = kwargs.get("aggregator")
 
-        self._thread = None
-        self._lock = threading.Lock()
-        self._stats = None
         self._backlog = None
         if self._config.get('backlog_enabled'):
             if not metrics.APM_Backlog:
@@ -79,6 +83,10 @@ class QueueStats:
                     header=self._ab_headers,
                     method="POST",
                     maxlen=self._config.get('max_backlog_size'),
+                    transport=self._transport,
+                    spool=make_spool(self._config, "apm"),
+                    max_attempts=self._config.get('backlog_max_attempts'),
+                    max_parallel=self._config.get('backlog_max_parallel'),
                 )
             self._backlog = metrics.APM_Backlog
 
@@ -93,43 +101,30 @@ class QueueStats:
         metric.end()
 
         key = metric._key()
-        with self._lock:
-            if self._stats is None:
-                self._stats = {}
-                self._thread = threading.Timer(constant.FLUSH_PERIOD,
-                                               self._flush)
-                self._thread.start()
-
-            if key in self._stats:
-                stat = self._stats[key]
-            else:
+        total_ms = metric.duration_ms()
+        shard = self._shards.get()
+        with shard.lock:
+            stat = shard.stats.get(key)
+            if stat is None:
                 stat = _QueueStat(queue=metric.queue, time=metric.start_time)
-                self._stats[key] = stat
-
-            total_ms = (metric.end_time - metric.start_time) * 1000
+                shard.stats[key] = stat
             stat.add_groups(total_ms, metric._groups)
+        self._ensure_timer()
 
-    def _flush(self):
-        """
-        TODO: Below disabled pylint will remove in refactoring
-        """
-        # pylint: disable=too-many-branches
-        stats = None
-        with self._lock:
-            stats = self._stats
-            self._stats = None
-
-        if not stats:
-            raise ValueError("stats is empty")
-
+    def _send(self, stats):
         out = {"queues": [v.__dict__ for v in stats.values()]}
         if self._env:
             out["environment"] = self._env
 
-        out_json = json.dumps(out).encode("utf8")
-        metrics.send(
+        out_json = serializer.dumps(out)
+        if self._aggregator is not None and \
+                self._aggregator.submit(self._ab_url(), out_json):
+            return True
+        return metrics.send(
             url=self._ab_url(), headers=self._ab_headers,
             payload=out_json, method="POST",
+            transport=self._transport,
+            backpressure=self._backpressure,
         )
 
     def _ab_url(self):
@@ -0,0 +1,293 @@
+"""
+pybrake relay: receives notices and timing samples from local processes
+over a Unix datagram socket or UDP, aggregates them and sends them to
+Airbrake.
+
+    python -m pybrake.relay --project-id 123 \\
+        --project-key "$AIRBRAKE_PROJECT_KEY" \\
+        --socket /run/pybrake.sock --udp 127.0.0.1:8125
+
+Every datagram holds one or more JSON messages separated by newlines:
+
+    {"type": "route", "method": "GET", "route": "/users/:id",
+     "status_code": 200, "content_type": "application/json",
+     "time": 1673352000.5, "ms": 12.3, "groups": {"sql": 4.1}}
+    {"type": "query", "query": "SELECT ...", "method": "GET",
+     "route": "/users/:id", "function": "", "file": "", "line": 0,
+     "time": 1673352000.5, "ms": 1.2}
+    {"type": "queue", "queue": "send_email", "time": 1673352000.5,
+     "ms": 250.0, "groups": {"sql": 30.0}}
+    {"type": "notice", "notice": {"errors": [...], "context": {...}}}
+
+time is the start time in seconds since the epoch and defaults to the time
+the message is received. ms is the duration in milliseconds and groups the
+time spent in spans (the rest is the handler's own time).
+"""
+import argparse
+import json
+import os
+import selectors
+import signal
+import socket
+import threading
+import time
+
+from . import constant
+from . import serializer
+from .coalescer import Coalescer
+from .notifier import Notifier
+from .queues import QueueMetric
+from .route_metric import RouteMetric
+from .utils import logger
+
+# The largest UDP payload. Unix datagrams are read with the same limit.
+_MAX_DATAGRAM = 65507
+
+
+class _RouteSample:
+    """A request measured by another process, used like a RouteMetric."""
+
+    __slots__ = ("method", "route", "status_code", "content_type",
+                 "start_time", "_ms", "_groups", "_tree")
+
+    _key = RouteMetric._key
+    response_type = RouteMetric.response_type
+
+    def __init__(self, msg, now):
+        self.method = msg.get("method", "")
+        self.route = msg["route"]
+        self.status_code = int(msg.get("status_code", 200))
+        self.content_type = msg.get("content_type", "")
+        self.start_time = float(msg.get("time") or now)
+        self._ms = float(msg["ms"])
+        self._groups = _groups(msg, constant.HTTP_HANDLER, self._ms)
+        self._tree = None
+
+    def end(self):
+        pass
+
+    def duration_ms(self):
+        return self._ms
+
+
+class _QueueSample:
+    """A job measured by another process, used like a QueueMetric."""
+
+    __slots__ = ("queue", "start_time", "_ms", "_groups")
+
+    _key = QueueMetric._key
+
+    def __init__(self, msg, now):
+        self.queue = msg["queue"]
+        self.start_time = float(msg.get("time") or now)
+        self._ms = float(msg["ms"])
+        self._groups = _groups(msg, constant.QUEUE_HANDLER, self._ms)
+
+    def end(self):
+        pass
+
+    def duration_ms(self):
+        return self._ms
+
+
+def _groups(msg, handler, ms):
+    groups = {name: float(v) for name, v in (msg.get("groups") or {}).items()}
+    groups[handler] = max(ms - sum(groups.values()), 0)
+    return groups
+
+
+class Relay:
+    """
+    Relay feeds received messages to a Notifier: route, query and queue
+    samples are aggregated by its stats (the same t-digests as in-process
+    stats) and notices are coalesced by fingerprint and sent by its
+    pooled transport.
+    """
+
+    def __init__(self, notifier, *, coalesce_window=60):
+        self._notifier = notifier
+        self._coalescer = None
+        if coalesce_window:
+            self._coalescer = Coalescer(notifier, window=coalesce_window)
+        self._handlers = dict(
+            route=self._route,
+            query=self._query,
+            queue=self._queue,
+            notice=self._notice,
+        )
+
+        self.received = 0
+        self.errors = 0
+
+    def ingest(self, data):
+        """Handles the messages of a datagram."""
+        now = time.time()
+        for line in data.splitlines():
+            if not line:
+                continue
+            self.received += 1
+            try:
+                msg = json.loads(line)
+                self._handlers[msg["type"]](msg, now)
+            except (ValueError, KeyError, TypeError, AttributeError) as err:
+                self.errors += 1
+                logger.debug("pybrake: relay: bad message: %s", err)
+
+    def serve(self, socks, stop):
+        """Reads datagrams from socks until stop is set."""
+        sel = selectors.DefaultSelector()
+        for sock in socks:
+            sock.setblocking(False)
+            sel.register(sock, selectors.EVENT_READ)
+
+        try:
+            while not stop.is_set():
+                for key, _ in sel.select(timeout=0.5):
+                    self._drain(key.fileobj)
+        finally:
+            sel.close()
+
+    def _drain(self, sock):
+        while True:
+            try:
+                data = sock.recv(_MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.ingest(data)
+
+    def stats(self):
+        return dict(received=self.received, errors=self.errors)
+
+    def close(self, timeout=None):
+        """Sends pending stats and notices."""
+        if self._coalescer is not None:
+            self._coalescer.flush()
+        return self._notifier.close(timeout)
+
+    def _route(self, msg, now):
+        self._notifier.routes.notify(_RouteSample(msg, now))
+
+    def _queue(self, msg, now):
+        self._notifier.queues.notify(_QueueSample(msg, now))
+
+    def _query(self, msg, now):
+        self._notifier.queries.notify(
+            query=msg["query"],
+            method=msg.get("method", ""),
+            route=msg.get("route", ""),
+            function=msg.get("function", ""),
+            file=msg.get("file", ""),
+            line=int(msg.get("line", 0)),
+            start_time=float(msg.get("time") or now),
+            duration_ms=float(msg["ms"]),
+        )
+
+    def _notice(self, msg, now):  # pylint: disable=unused-argument
+        notice = msg["notice"]
+        if not isinstance(notice, dict):
+            raise TypeError("notice must be an object")
+        if self._coalescer is None or self._coalescer.add(notice):
+            self._notifier.send_notice(notice, future=False)
+
+
+class RelayClient:
+    """
+    RelayClient sends messages to a relay with non-blocking datagram
+    writes. Messages that can't be written right away are dropped and
+    counted, so the application never waits for the relay.
+    """
+
+    def __init__(self, *, path=None, udp=None):
+        if path:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._addr = path
+        else:
+            self._addr = _parse_address(udp)
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self.dropped = 0
+
+    def send(self, kind, **fields):
+        """Sends a message of the kind (route, query, queue or notice)."""
+        fields["type"] = kind
+        try:
+            self._sock.sendto(serializer.dumps(fields), self._addr)
+        except OSError:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self):
+        self._sock.close()
+
+
+def _parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def bind_sockets(*, path=None, udp=None):
+    """Returns the Unix datagram and UDP sockets the relay listens on."""
+    socks = []
+    if path:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        socks.append(sock)
+    if udp:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(_parse_address(udp))
+        socks.append(sock)
+    return socks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pybrake.relay",
+        description="Aggregates notices and stats of local processes and "
+                    "sends them to Airbrake.",
+    )
+    parser.add_argument("--project-id", type=int,
+                        default=os.environ.get("AIRBRAKE_PROJECT_ID", 0))
+    parser.add_argument("--project-key",
+                        default=os.environ.get("AIRBRAKE_PROJECT_KEY", ""))
+    parser.add_argument("--host", default=constant.AIRBRAKE_HOST)
+    parser.add_argument("--environment")
+    parser.add_argument("--socket", help="path of the Unix datagram socket")
+    parser.add_argument("--udp", help="UDP address, host:port")
+    parser.add_argument("--coalesce-window", type=float, default=60,
+                        help="seconds repeated notices are folded, 0 "
+                             "disables coalescing")
+    args = parser.parse_args(argv)
+    if not args.socket and not args.udp:
+        parser.error("one of --socket and --udp is required")
+
+    options = {}
+    if args.environment:
+        options["environment"] = args.environment
+    notifier = Notifier(project_id=args.project_id,
+                        project_key=args.project_key,
+                        host=args.host, **options)
+    relay = Relay(notifier, coalesce_window=args.coalesce_window)
+    socks = bind_sockets(path=args.socket, udp=args.udp)
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    try:
+        relay.serve(socks, stop)
+    finally:
+        for sock in socks:
+            sock.close()
+        if args.socket:
+            os.unlink(args.socket)
+        relay.close(timeout=5)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,29 +1,62 @@
 import base64
-import json
-import threading
 
 from . import constant
 from . import metrics
-from .backlog import Backlog
+from . import serializer
+from .backlog import Backlog, make_spool
+from .shards import ShardedStats
+from .constant import SPAN_TREE_OTHER
 from .tdigest import as_bytes, TDigestStatGroups
 from .utils import time_trunc_minute
 
+_DEFAULT_SPAN_TREE_DEPTH = 4
+_DEFAULT_SPAN_TREE_WIDTH = 16
+
+
+class _SpanPathStat:
+    __slots__ = ("count", "total", "self_time")
+
+    def __init__(self, count=0, total=0, self_time=0):
+        self.count = count
+        self.total = total
+        self.self_time = self_time
+
+    @property
+    def __dict__(self):
+        return dict(count=self.count, total=self.total, self=self.self_time)
+
+    def add(self, count, total, self_time):
+        self.count += count
+        self.total += total
+        self.self_time += self_time
+
 
 class _RouteBreakdown(TDigestStatGroups):
 
-    def __new__(cls, *, method="", route="", responseType="", time=None):
+    def __new__(cls, *, method="", route="", responseType="", time=None,
+                max_depth=_DEFAULT_SPAN_TREE_DEPTH,
+                max_width=_DEFAULT_SPAN_TREE_WIDTH):
+        # pylint: disable=unused-argument,too-many-arguments
         instance = super(_RouteBreakdown, cls).__new__(cls)
         instance.__slots__ = instance.__slots__ + (
-            "method", "route", "responseType", "time"
+            "method", "route", "responseType", "time", "spans"
         )
         return instance
 
-    def __init__(self, *, method="", route="", responseType="", time=None):
+    def __init__(self, *, method="", route="", responseType="", time=None,
+                 max_depth=_DEFAULT_SPAN_TREE_DEPTH,
+                 max_width=_DEFAULT_SPAN_TREE_WIDTH):
+        # pylint: disable=too-many-arguments
         super().__init__()
         self.method = method
         self.route = route
         self.responseType = responseType
         self.time = time_trunc_minute(time)
+        # Span paths (tuples of names) and the child names of every path.
+        self.spans = {}
+        self._children = {}
+        self._max_depth = max_depth
+        self._max_width = max_width
 
     @property
     def __dict__(self):
@@ -35,10 +68,54 @@ class _RouteBreakdown(TDigestStatGroups):
         for k, v in groups.items():
             groups[k] = v.__dict__
 
-        return d
+        if self.spans:
+            d["spans"] = {
+                "/".join(path): stat.__dict__
+                for path, stat in self.spans.items()
+            }
+        else:
+            del d["spans"]
 
+        return d
 
-class RouteBreakdowns:
+    def add_span_tree(self, tree):
+        """
+        Adds the span tree of a metric: call count, total time and self
+        time by span path. Paths deeper than max_depth end with "other" at
+        the last level. A path gets at most max_width children, later
+        children are added to an "other" child.
+        """
+        for path, (count, total, self_time) in tree.items():
+            # Metrics record the deepest tree of all notifiers.
+            if len(path) > self._max_depth:
+                path = path[:self._max_depth - 1] + (SPAN_TREE_OTHER,)
+            path = self._bound_width(path)
+            stat = self.spans.get(path)
+            if stat is None:
+                stat = _SpanPathStat()
+                self.spans[path] = stat
+            stat.add(count, total, self_time)
+
+    def _bound_width(self, path):
+        for i, name in enumerate(path):
+            children = self._children.setdefault(path[:i], set())
+            if name in children:
+                continue
+            if len(children) >= self._max_width:
+                children.add(SPAN_TREE_OTHER)
+                return path[:i] + (SPAN_TREE_OTHER,)
+            children.add(name)
+        return path
+
+    def merge(self, other):
+        super().merge(other)
+        self.add_span_tree({
+            path: (stat.count, stat.total, stat.self_time)
+            for path, stat in other.spans.items()
+        })
+
+
+class RouteBreakdowns(ShardedStats):
     """
     RouteBreakdowns will collect request execution with breakdown statistics
     such as execution statistics of template rendering time and sql/nosql
@@ -46,6 +123,7 @@ class RouteBreakdowns:
     """
 
     def __init__(self, *, project_id=0, project_key="", **kwargs):
+        super().__init__(backpressure=kwargs.get("backpressure"))
         self._config = kwargs["config"]
 
         self._project_id = project_id
@@ -54,10 +132,9 @@ class RouteBreakdowns:
             "Authorization": "Bearer " + project_key,
         }
         self._env = kwargs.get("environment")
+        self._transport = kwargs.get("transport")
+        self._aggregator = kwargs.get("aggregator")
 
-        self._thread = None
-        self._lock = threading.Lock()
-        self._stats = None
         self._backlog = None
         if self._config.get('backlog_enabled'):
             if not metrics.APM_Backlog:
@@ -65,6 +142,10 @@ class RouteBreakdowns:
                     header=self._ab_headers,
                     method="POST",
                     maxlen=self._config.get('max_backlog_size'),
+                    transport=self._transport,
+                    spool=make_spool(self._config, "apm"),
+                    max_attempts=self._config.get('backlog_max_attempts'),
+                    max_parallel=self._config.get('backlog_max_parallel'),
                 )
             self._backlog = metrics.APM_Backlog
 
@@ -80,48 +161,43 @@ class RouteBreakdowns:
         ):
             return
 
-        if self._stats is None:
-            self._stats = {}
-            self._thread = threading.Timer(constant.FLUSH_PERIOD, self._flush)
-            self._thread.start()
-
         key = metric._key()
-        with self._lock:
-            if key in self._stats:
-                stat = self._stats[key]
-            else:
+        total_ms = metric.duration_ms()
+        shard = self._shards.get()
+        with shard.lock:
+            stat = shard.stats.get(key)
+            if stat is None:
                 stat = _RouteBreakdown(
                     method=metric.method,
                     route=metric.route,
                     responseType=metric.response_type,
                     time=metric.start_time,
+                    max_depth=self._config.get(
+                        "span_tree_max_depth", _DEFAULT_SPAN_TREE_DEPTH),
+                    max_width=self._config.get(
+                        "span_tree_max_width", _DEFAULT_SPAN_TREE_WIDTH),
                 )
-                self._stats[key] = stat
-
-            total_ms = (metric.end_time - metric.start_time) * 1000
+                shard.stats[key] = stat
             stat.add_groups(total_ms, metric._groups)
+            tree = getattr(metric, "_tree", None)
+            if tree and self._config.get("span_tree"):
+                stat.add_span_tree(tree)
+        self._ensure_timer()
 
-    def _flush(self):
-        """
-        TODO: Below disabled pylint will remove in refactoring
-        """
-        # pylint: disable=too-many-branches
-        stats = None
-        with self._lock:
-            stats = self._stats
-            self._stats = None
-
-        if not stats:
-            raise ValueError("stats is empty")
-
+    def _send(self, stats):
         out = {"routes": [v.__dict__ for v in stats.values()]}
         if self._env:
             out["environment"] = self._env
 
-        out_json = json.dumps(out).encode("utf8")
-        metrics.send(
+        out_json = serializer.dumps(out)
+        if self._aggregator is not None and \
+                self._aggregator.submit(self._ab_url(), out_json):
+            return True
+        return metrics.send(
             url=self._ab_url(), payload=out_json,
             headers=self._ab_headers, method="POST",
+            transport=self._transport,
+            backpressure=self._backpressure,
         )
 
     def _ab_url(self):
@@ -130,6 +206,8 @@ class RouteBreakdowns:
 
 
 class RouteMetric(metrics.Metric):
+    __slots__ = ("method", "route", "status_code", "content_type")
+
     def __init__(self, *, method="", route="", status_code=0, content_type=""):
         super().__init__()
         self.method = method
@@ -139,6 +217,8 @@ class RouteMetric(metrics.Metric):
         self.start_span(constant.HTTP_HANDLER, start_time=self.start_time)
 
     def end(self):
+        if self._end_ns is not None:
+            return
         super().end()
         self.end_span(constant.HTTP_HANDLER, end_time=self.end_time)
 
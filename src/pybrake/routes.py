@@ -1,11 +1,10 @@
 import base64
-import json
-from threading import Lock, Timer
 
 from . import metrics
-from . import constant
-from .backlog import Backlog
+from . import serializer
+from .backlog import Backlog, make_spool
 from .route_metric import RouteBreakdowns
+from .shards import ShardedStats
 from .tdigest import as_bytes, TDigestStat
 from .utils import time_trunc_minute
 
@@ -58,8 +57,9 @@ class RouteStat(TDigestStat):
         self.time = time_trunc_minute(time)
 
 
-class RouteStats:
+class RouteStats(ShardedStats):
     def __init__(self, *, project_id=0, project_key="", **kwargs):
+        super().__init__(backpressure=kwargs.get("backpressure"))
         self._config = kwargs["config"]
 
         self._project_id = project_id
@@ -68,10 +68,9 @@ class RouteStats:
             "Authorization": "Bearer " + project_key,
         }
         self._env = kwargs.get("environment")
+        self._transport = kwargs.get("transport")
+        self._aggregator = kwargs.get("aggregator")
 
-        self._thread = None
-        self._lock = Lock()
-        self._stats = None
         self._backlog = None
         if self._config.get('backlog_enabled'):
             if not metrics.APM_Backlog:
@@ -79,6 +78,10 @@ class RouteStats:
                     header=self._ab_headers,
                     method="POST",
                     maxlen=self._config.get('max_backlog_size'),
+                    transport=self._transport,
+                    spool=make_spool(self._config, "apm"),
+                    max_attempts=self._config.get('backlog_max_attempts'),
+                    max_parallel=self._config.get('backlog_max_parallel'),
                 )
             self._backlog = metrics.APM_Backlog
 
@@ -92,47 +95,35 @@ class RouteStats:
             status_code=metric.status_code,
             time=metric.start_time,
         )
-        with self._lock:
-            if self._stats is None:
-                self._stats = {}
-                self._thread = Timer(constant.FLUSH_PERIOD, self._flush)
-                self._thread.start()
-
-            if key in self._stats:
-                stat = self._stats[key]
-            else:
+        ms = metric.duration_ms()
+        shard = self._shards.get()
+        with shard.lock:
+            stat = shard.stats.get(key)
+            if stat is None:
                 stat = RouteStat(
                     method=metric.method,
                     route=metric.route,
                     status_code=metric.status_code,
                     time=metric.start_time,
                 )
-                self._stats[key] = stat
-
-            ms = (metric.end_time - metric.start_time) * 1000
+                shard.stats[key] = stat
             stat.add(ms)
+        self._ensure_timer()
 
-    def _flush(self):
-        """
-        TODO: Below disabled pylint will remove in refactoring
-        """
-        # pylint: disable=too-many-branches
-        stats = None
-        with self._lock:
-            stats = self._stats
-            self._stats = None
-
-        if not stats:
-            raise ValueError("stats is empty")
-
+    def _send(self, stats):
         out = {"routes": [v.__dict__ for v in stats.values()]}
         if self._env:
             out["environment"] = self._env
 
-        out = json.dumps(out).encode("utf8")
-        metrics.send(
+        out = serializer.dumps(out)
+        if self._aggregator is not None and \
+                self._aggregator.submit(self._ab_url(), out):
+            return True
+        return metrics.send(
             url=self._ab_url(), headers=self._ab_headers,
             method="POST", payload=out,
+            transport=self._transport,
+            backpressure=self._backpressure,
         )
 
     def _ab_url(self):
@@ -0,0 +1,205 @@
+import atexit
+import collections
+import threading
+import time
+import weakref
+from concurrent import futures
+
+from .utils import logger
+
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+
+_ERR_QUEUE_FULL = "queue is full"
+
+_senders = weakref.WeakSet()
+
+
+class Sender:
+    """
+    Sender sends notices from a bounded queue using a small, fixed number of
+    worker threads.
+
+    When the queue is full the drop policy decides what happens:
+    - drop_newest - the new notice is dropped,
+    - drop_oldest - the oldest queued notice is dropped to make room,
+    - block - the caller waits up to block_timeout seconds for free space
+      and the new notice is dropped after that.
+
+    Dropped notices get notice["error"] set to "queue is full".
+    """
+
+    def __init__(self, *, max_queue_size=1000, workers=2,
+                 drop_policy=DROP_NEWEST, block_timeout=1):
+        if drop_policy not in (DROP_NEWEST, DROP_OLDEST, BLOCK):
+            raise ValueError(f"unknown drop policy: {drop_policy}")
+
+        self._max_queue_size = max_queue_size
+        self._num_workers = workers
+        self._drop_policy = drop_policy
+        self._block_timeout = block_timeout
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._queue = collections.deque()
+        self._active = 0
+        self._workers = []
+        self._shutdown = False
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+
+        _senders.add(self)
+
+    def submit(self, fn, notice, *args, future=True):
+        """
+        Queues fn(notice, *args) to be called by a worker. fn must return
+        the notice.
+
+        Returns concurrent.futures.Future resolved with the notice, or None
+        if future is false.
+        """
+        f = futures.Future() if future else None
+
+        with self._lock:
+            if self._shutdown:
+                return _dropped(notice, f, "sender is closed")
+
+            if len(self._queue) >= self._max_queue_size:
+                if not self._make_room():
+                    self.dropped += 1
+                    return _dropped(notice, f, _ERR_QUEUE_FULL)
+
+            self._queue.append((fn, notice, args, f))
+            self.enqueued += 1
+            self._not_empty.notify()
+
+            if len(self._workers) < self._num_workers:
+                self._start_worker()
+
+        return f
+
+    def _make_room(self):
+        if self._drop_policy == DROP_OLDEST and self._queue:
+            _, notice, _, f = self._queue.popleft()
+            self.dropped += 1
+            _dropped(notice, f, _ERR_QUEUE_FULL)
+            return True
+
+        if self._drop_policy == BLOCK:
+            return self._not_full.wait_for(
+                lambda: len(self._queue) < self._max_queue_size,
+                timeout=self._block_timeout,
+            )
+
+        return False
+
+    def _start_worker(self):
+        t = threading.Thread(target=self._run, name="pybrake-sender")
+        t.daemon = True
+        t.start()
+        self._workers.append(t)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    if self._shutdown:
+                        return
+                    self._not_empty.wait()
+                fn, notice, args, f = self._queue.popleft()
+                self._not_full.notify()
+                self._active += 1
+
+            try:
+                self._call(fn, notice, args, f)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    if not self._queue and self._active == 0:
+                        self._idle.notify_all()
+
+    def _call(self, fn, notice, args, f):
+        if f is not None and not f.set_running_or_notify_cancel():
+            return
+
+        try:
+            notice = fn(notice, *args)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.error(err)
+            with self._lock:
+                self.failed += 1
+            if f is not None:
+                f.set_exception(err)
+            return
+
+        with self._lock:
+            self.sent += 1
+        if f is not None:
+            f.set_result(notice)
+
+    def flush(self, timeout=None):
+        """
+        Waits up to timeout seconds until all queued notices are sent.
+        Returns the number of notices that are still queued or being sent.
+        """
+        with self._lock:
+            self._idle.wait_for(
+                lambda: not self._queue and self._active == 0, timeout=timeout)
+            return len(self._queue) + self._active
+
+    def qsize(self):
+        with self._lock:
+            return len(self._queue)
+
+    def stats(self):
+        """
+        Returns counters of enqueued, dropped, sent and failed notices and
+        the current queue size.
+        """
+        with self._lock:
+            return dict(
+                enqueued=self.enqueued,
+                dropped=self.dropped,
+                sent=self.sent,
+                failed=self.failed,
+                queued=len(self._queue),
+            )
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stops accepting notices. Queued notices are still sent and, if wait
+        is true, it waits up to timeout seconds for the workers to finish.
+        """
+        with self._lock:
+            self._shutdown = True
+            self._not_empty.notify_all()
+            workers = list(self._workers)
+
+        if not wait:
+            return
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for t in workers:
+            if deadline is None:
+                t.join()
+            else:
+                t.join(max(0, deadline - time.monotonic()))
+
+
+def _dropped(notice, f, reason):
+    notice["error"] = reason
+    if f is not None:
+        f.set_result(notice)
+    return f
+
+
+@atexit.register
+def _shutdown_senders():
+    for sender in list(_senders):
+        sender.shutdown()
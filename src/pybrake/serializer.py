@@ -0,0 +1,186 @@
+# pylint: disable=no-member,c-extension-no-member
+import collections
+import decimal
+import enum
+import json
+import math
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+_CONTAINERS = (collections.UserDict, collections.UserList, collections.UserString)
+_KEY_TYPES = (str, int, float, bool, type(None))
+
+
+def _default(obj):
+    if isinstance(obj, set):
+        return list(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode("utf8", "replace")
+    if isinstance(obj, _CONTAINERS):
+        return obj.data
+    # orjson encodes enums as their value and ujson decimals as numbers.
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    return str(obj)
+
+
+def _sanitize(obj, seen=None):
+    """
+    Returns a copy of obj where keys of other types than str, int, float,
+    bool and None are converted with str and NaN and Infinity are replaced
+    with None, the way ujson and orjson encode them.
+    """
+    if isinstance(obj, (float, decimal.Decimal)):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, (set, collections.UserDict, collections.UserList)):
+        obj = _default(obj)
+    if not isinstance(obj, (dict, list, tuple)):
+        return obj
+
+    if seen is None:
+        seen = set()
+    ident = id(obj)
+    if ident in seen:
+        raise ValueError("Circular reference detected")
+    seen.add(ident)
+    if isinstance(obj, dict):
+        obj = {
+            (k if isinstance(k, _KEY_TYPES) else str(k)): _sanitize(v, seen)
+            for k, v in obj.items()
+        }
+    else:
+        obj = [_sanitize(v, seen) for v in obj]
+    seen.discard(ident)
+    return obj
+
+
+class StdlibBackend:
+    """
+    StdlibBackend encodes payloads with the json module from the standard
+    library. Output is compact and UTF-8 encoded, the same as orjson.
+    Dict keys json rejects are encoded as strings and NaN and Infinity,
+    which aren't valid JSON, as null.
+    """
+
+    name = "json"
+
+    def dumps(self, obj):
+        try:
+            return self._dumps(obj)
+        except (TypeError, ValueError):
+            return self._dumps(_sanitize(obj))
+
+    def _dumps(self, obj):
+        try:
+            return json.dumps(
+                obj, default=_default, ensure_ascii=False,
+                separators=(",", ":"), allow_nan=False,
+            ).encode("utf8")
+        except UnicodeEncodeError:
+            # Lone surrogates can't be encoded to UTF-8, so escape them.
+            return json.dumps(
+                obj, default=_default, separators=(",", ":"), allow_nan=False,
+            ).encode("utf8")
+
+
+class OrjsonBackend:
+    """
+    OrjsonBackend encodes payloads with orjson. Values orjson can't encode
+    (integers over 64 bits, strings with surrogates, tuple keys) are encoded
+    with the stdlib backend instead.
+
+    Int, float, bool and None keys, like the line numbers of code hunks,
+    are encoded as strings the way json does. Enum and datetime keys are
+    encoded as their value and ISO format, while the other backends use
+    str.
+    """
+
+    name = "orjson"
+    _options = (
+        orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+        if orjson is not None else 0
+    )
+
+    def __init__(self):
+        self._fallback = StdlibBackend()
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj, default=_default, option=self._options)
+        except TypeError:
+            return self._fallback.dumps(obj)
+
+
+class UjsonBackend:
+    """
+    UjsonBackend encodes payloads with ujson. Values ujson can't encode
+    (including NaN and Infinity) are encoded with the stdlib backend
+    instead.
+    """
+
+    name = "ujson"
+
+    def __init__(self):
+        self._fallback = StdlibBackend()
+
+    def dumps(self, obj):
+        try:
+            return ujson.dumps(
+                obj, default=_default, ensure_ascii=False,
+                escape_forward_slashes=False, allow_nan=False,
+            ).encode("utf8")
+        except (TypeError, ValueError, OverflowError):
+            return self._fallback.dumps(obj)
+
+
+_BACKENDS = dict(orjson=OrjsonBackend, ujson=UjsonBackend, json=StdlibBackend)
+_AVAILABLE = dict(orjson=orjson is not None, ujson=ujson is not None, json=True)
+
+
+def available_backends():
+    return [name for name, ok in _AVAILABLE.items() if ok]
+
+
+def get_backend(name=None):
+    """
+    Returns the named JSON backend or, if name is None, the fastest
+    installed one.
+    """
+    if name is None:
+        name = available_backends()[0]
+    if name not in _BACKENDS:
+        raise ValueError(f"unknown JSON backend: {name}")
+    if not _AVAILABLE[name]:
+        raise ValueError(f"JSON backend is not installed: {name}")
+    return _BACKENDS[name]()
+
+
+backend = get_backend()
+
+
+def set_backend(name=None):
+    """
+    Sets the JSON backend used for all payloads. Backends produce the same
+    bytes, except for the spelling of floats in exponent notation and of
+    Enum and datetime dict keys.
+    """
+    global backend  # pylint: disable=global-statement
+    backend = get_backend(name)
+    return backend
+
+
+def dumps(obj):
+    return backend.dumps(obj)
@@ -0,0 +1,180 @@
+import abc
+import threading
+
+from . import constant
+from . import metrics
+from .backpressure import BackPressure
+
+
+class _Shard:
+    __slots__ = ("lock", "stats", "thread")
+
+    def __init__(self, thread):
+        # The lock is only shared with collect, so it is uncontended while
+        # the owner thread aggregates.
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.thread = thread
+
+
+class StatShards:
+    """
+    StatShards gives every thread its own dict of stats, so threads that
+    record requests, queries or jobs at the same time don't wait for one
+    lock. The shards are merged (t-digests combined) by collect when the
+    stats are flushed.
+
+    Usage:
+
+        shard = shards.get()
+        with shard.lock:
+            stat = shard.stats.get(key)
+            ...
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+
+    def get(self):
+        """Returns the shard of the current thread."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+
+        shard = _Shard(threading.current_thread())
+        self._local.shard = shard
+        with self._lock:
+            self._shards.append(shard)
+        return shard
+
+    def collect(self, stats=None):
+        """
+        Takes the stats of all shards and merges them into stats. Returns
+        the merged stats, an empty dict if there are none.
+        """
+        if stats is None:
+            stats = {}
+
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            with shard.lock:
+                taken, shard.stats = shard.stats, {}
+            for key, stat in taken.items():
+                if key in stats:
+                    stats[key].merge(stat)
+                else:
+                    stats[key] = stat
+
+        with self._lock:
+            # Shards of threads that exited can't get new stats.
+            self._shards = [
+                shard for shard in self._shards
+                if shard.thread.is_alive() or shard.stats
+            ]
+        return stats
+
+    def __len__(self):
+        with self._lock:
+            return len(self._shards)
+
+
+class ShardedStats(abc.ABC):
+    """
+    ShardedStats is the base of route, breakdown, query and queue stats.
+    Stats are aggregated in per-thread shards and sent by a timer that the
+    first stat after a flush starts. Subclasses implement _ab_url and
+    _send.
+    """
+
+    def __init__(self, *, backpressure=None):
+        self._backpressure = backpressure or BackPressure()
+        self._thread = None
+        self._lock = threading.Lock()
+        # Stats that were not sent because the endpoint is rate limited.
+        self._stats = None
+        self._shards = StatShards()
+
+    def flush(self, timeout=None):
+        """
+        Sends pending stats right away instead of waiting for the flush
+        timer. Returns the number of stats that were dropped and the number
+        of stats that were handed to the backlog, which sends them later.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            stats, self._stats = self._stats, None
+
+        if thread is not None:
+            thread.cancel()
+            # Wait for the timer in case it is already sending stats.
+            thread.join(timeout)
+
+        stats = self._shards.collect(stats)
+        if not stats:
+            return 0, 0
+        sent = self._send(stats)
+        if sent:
+            return 0, 0
+        if sent is metrics.BACKLOGGED:
+            return 0, len(stats)
+        return len(stats), 0
+
+    def _flush(self):
+        with self._lock:
+            self._thread = None
+            stats, self._stats = self._stats, None
+
+        stats = self._shards.collect(stats)
+        if not stats:
+            raise ValueError("stats is empty")
+
+        sent = self._send(stats)
+        if not sent and sent is not metrics.BACKLOGGED and \
+                self._backpressure.throttled(self._ab_url()):
+            self._restore(stats)
+
+    @abc.abstractmethod
+    def _send(self, stats):
+        """
+        Sends stats and returns the result of metrics.send: True if they
+        were accepted, BACKLOGGED or False.
+        """
+
+    @abc.abstractmethod
+    def _ab_url(self):
+        """Returns the URL stats are sent to."""
+
+    def _ensure_timer(self):
+        # Called after a stat is added to a shard: a flush that collected
+        # the shards before that has already cleared _thread, so the stat is
+        # sent by a new timer. Only the first stat after a flush takes the
+        # lock.
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._start_timer()
+
+    def _start_timer(self):
+        interval = self._backpressure.interval(
+            self._ab_url(), constant.FLUSH_PERIOD)
+        self._thread = threading.Timer(interval, self._flush)
+        self._thread.start()
+
+    def _restore(self, stats):
+        """
+        Merges stats that were not sent because the endpoint is rate limited
+        back into the pending stats, so they are sent with the next flush.
+        """
+        with self._lock:
+            if self._stats is None:
+                self._stats = {}
+            if self._thread is None:
+                self._start_timer()
+            for key, stat in stats.items():
+                if key in self._stats:
+                    stat.merge(self._stats[key])
+                self._stats[key] = stat
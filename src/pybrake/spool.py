@@ -0,0 +1,242 @@
+import json
+import os
+import struct
+import threading
+import zlib
+
+from . import serializer
+from .utils import logger
+
+_MAX_SPOOL_BYTES = 16 * 1024 * 1024
+_SEGMENT_SUFFIX = ".seg"
+_CURSOR_FILE = "cursor"
+
+# Every record is prefixed with its length and CRC32.
+_HEADER = struct.Struct(">II")
+
+
+class _Segment:
+    __slots__ = ("id", "size", "count")
+
+    def __init__(self, segment_id, size=0, count=0):
+        self.id = segment_id
+        self.size = size
+        self.count = count
+
+
+class Spool:
+    """
+    Spool is a durable FIFO queue of backlog items stored as an append-only
+    log of segment files in a directory. It has the subset of the deque
+    interface used by Backlog (append, popleft, peek and len).
+
+    Records are written with their length and checksum and synced to disk,
+    and the read position is saved atomically, so after a crash or restart
+    the remaining items are replayed and a torn last record is discarded.
+    When the spool grows over max_bytes the oldest segments are dropped.
+    """
+
+    def __init__(self, directory, *, max_bytes=_MAX_SPOOL_BYTES,
+                 segment_bytes=None):
+        os.makedirs(directory, exist_ok=True)
+        self._dir = directory
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes or max(max_bytes // 8, 1)
+
+        self._lock = threading.Lock()
+        self._segments = []
+        self._read_offset = 0
+        self._writer = None
+
+        self.dropped = 0
+        self.corrupted = 0
+
+        self._open()
+
+    def append(self, item):
+        data = _encode_item(item)
+        if _HEADER.size + len(data) > self._max_bytes:
+            logger.error("pybrake: backlog item is larger than the spool")
+            with self._lock:
+                self.dropped += 1
+            return
+
+        record = _HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self._lock:
+            self._make_room(len(record))
+            if (self._writer is None or
+                    self._segments[-1].size >= self._segment_bytes):
+                self._roll()
+
+            self._writer.write(record)
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+
+            segment = self._segments[-1]
+            segment.size += len(record)
+            segment.count += 1
+
+    def popleft(self):
+        with self._lock:
+            head = self._head()
+            data, size = self._read(head)
+            self._read_offset += size
+            head.count -= 1
+            self._save_cursor()
+            return _decode_item(data)
+
+    def peek(self):
+        """Returns the first item without removing it."""
+        with self._lock:
+            data, _ = self._read(self._head())
+            return _decode_item(data)
+
+    def __len__(self):
+        with self._lock:
+            return sum(s.count for s in self._segments)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                items=sum(s.count for s in self._segments),
+                bytes=self._size(),
+                segments=len(self._segments),
+                dropped=self.dropped,
+                corrupted=self.corrupted,
+            )
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def _open(self):
+        ids = sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)])
+            for name in os.listdir(self._dir)
+            if name.endswith(_SEGMENT_SUFFIX) and
+            name[:-len(_SEGMENT_SUFFIX)].isdigit()
+        )
+        read_id, read_offset = self._load_cursor()
+
+        for segment_id in ids:
+            if read_id is not None and segment_id < read_id:
+                os.remove(self._path(segment_id))
+                continue
+            offset = read_offset if segment_id == read_id else 0
+            self._segments.append(self._scan(segment_id, offset))
+
+        if self._segments and self._segments[0].id == read_id:
+            self._read_offset = min(read_offset, self._segments[0].size)
+
+    def _scan(self, segment_id, start):
+        """
+        Counts unread records and truncates a torn or corrupted tail.
+        """
+        path = self._path(segment_id)
+        with open(path, "rb") as f:
+            buf = f.read()
+
+        pos = 0
+        count = 0
+        while pos + _HEADER.size <= len(buf):
+            length, crc = _HEADER.unpack_from(buf, pos)
+            end = pos + _HEADER.size + length
+            if end > len(buf) or zlib.crc32(buf[pos + _HEADER.size:end]) != crc:
+                break
+            if pos >= start:
+                count += 1
+            pos = end
+
+        if pos < len(buf):
+            self.corrupted += 1
+            with open(path, "r+b") as f:
+                f.truncate(pos)
+        return _Segment(segment_id, pos, count)
+
+    def _head(self):
+        while self._segments:
+            head = self._segments[0]
+            if self._read_offset < head.size:
+                return head
+            if len(self._segments) == 1:
+                break
+            self._remove_head()
+        raise IndexError("pop from an empty spool")
+
+    def _read(self, head):
+        with open(self._path(head.id), "rb") as f:
+            f.seek(self._read_offset)
+            length, _ = _HEADER.unpack(f.read(_HEADER.size))
+            data = f.read(length)
+        return data, _HEADER.size + length
+
+    def _roll(self):
+        if self._writer is not None:
+            self._writer.close()
+        next_id = self._segments[-1].id + 1 if self._segments else 0
+        self._writer = open(  # pylint: disable=consider-using-with
+            self._path(next_id), "ab")
+        self._segments.append(_Segment(next_id))
+        if len(self._segments) == 1:
+            self._read_offset = 0
+            self._save_cursor()
+
+    def _make_room(self, size):
+        while self._segments and self._size() + size > self._max_bytes:
+            if len(self._segments) == 1:
+                # Never delete the segment that is being written.
+                self._roll()
+            self.dropped += self._segments[0].count
+            self._remove_head()
+
+    def _remove_head(self):
+        head = self._segments.pop(0)
+        try:
+            os.remove(self._path(head.id))
+        except OSError as err:
+            logger.error(err)
+        self._read_offset = 0
+        self._save_cursor()
+
+    def _size(self):
+        return sum(s.size for s in self._segments) - self._read_offset
+
+    def _path(self, segment_id):
+        return os.path.join(self._dir, f"{segment_id:010d}{_SEGMENT_SUFFIX}")
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self._dir, _CURSOR_FILE),
+                      encoding="ascii") as f:
+                read_id, read_offset = f.read().split()
+            return int(read_id), int(read_offset)
+        except (OSError, ValueError):
+            return None, 0
+
+    def _save_cursor(self):
+        if not self._segments:
+            return
+        path = os.path.join(self._dir, _CURSOR_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="ascii") as f:
+            f.write(f"{self._segments[0].id} {self._read_offset}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+
+def _encode_item(item):
+    data = item.get("data")
+    if isinstance(data, (bytes, bytearray)):
+        # APM payloads are already encoded JSON.
+        item = dict(item, data=data.decode("utf8"), raw=True)
+    return serializer.dumps(item)
+
+
+def _decode_item(data):
+    item = json.loads(data)
+    if item.pop("raw", False):
+        item["data"] = item["data"].encode("utf8")
+    return item
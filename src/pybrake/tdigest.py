@@ -1,6 +1,132 @@
 import base64
 import struct
-import tdigest
+
+# Values added to a digest are buffered and merged into the centroids in
+# batches of this size.
+_BUFFER_SIZE = 128
+
+
+class TDigest:
+    """
+    TDigest is a merging t-digest. Centroids are kept sorted by mean in two
+    flat lists (means and counts). Added values are appended to a buffer
+    that is sorted and merged into the centroids in one pass when it is
+    full or when the digest is read, so adding a value is a list append.
+
+    The size of a centroid at quantile q is bounded by 4 * n * q * (1 - q)
+    / K, where K is the compression, so the number of centroids grows with
+    K * log(n) and the tails are the most precise. K is also the
+    compression in the encoding (as_bytes).
+    """
+
+    __slots__ = ("K", "n", "_means", "_counts", "_buf", "_wbuf")
+
+    def __init__(self, K=10):  # pylint: disable=invalid-name
+        self.K = K  # pylint: disable=invalid-name
+        self.n = 0
+        self._means = []
+        self._counts = []
+        self._buf = []
+        self._wbuf = []
+
+    def update(self, x, w=1):
+        """Adds value x with weight w."""
+        self.n += w
+        if w == 1:
+            self._buf.append(x)
+            if len(self._buf) >= _BUFFER_SIZE:
+                self._compress()
+        else:
+            self._wbuf.append((x, w))
+            if len(self._wbuf) >= _BUFFER_SIZE:
+                self._compress()
+
+    def batch_update(self, values):
+        """Adds values with weight 1."""
+        self._buf.extend(values)
+        self.n += len(values)
+        if len(self._buf) >= _BUFFER_SIZE:
+            self._compress()
+
+    def __add__(self, other):
+        digest = TDigest(K=self.K)
+        digest.n = self.n + other.n
+        digest._wbuf = (
+            list(zip(self._means, self._counts)) + self._wbuf +
+            list(zip(other._means, other._counts)) + other._wbuf
+        )
+        digest._buf = self._buf + other._buf
+        digest._compress()
+        return digest
+
+    def __len__(self):
+        self._compress()
+        return len(self._means)
+
+    def centroids(self):
+        """Returns the means and the counts of the centroids."""
+        self._compress()
+        return self._means, self._counts
+
+    def percentile(self, p):
+        """Returns the estimated value at percentile p (0 to 100)."""
+        self._compress()
+        means, counts = self._means, self._counts
+        if not means:
+            raise ValueError("digest is empty")
+
+        target = p / 100 * self.n
+        # Each centroid is centered at its cumulative weight minus half its
+        # count; values between two centers are interpolated.
+        center = counts[0] / 2
+        if target <= center:
+            return means[0]
+        for i in range(1, len(means)):
+            nxt = center + (counts[i - 1] + counts[i]) / 2
+            if target <= nxt:
+                frac = (target - center) / (nxt - center)
+                return means[i - 1] + frac * (means[i] - means[i - 1])
+            center = nxt
+        return means[-1]
+
+    def _set_centroids(self, means, counts):
+        self._means = means
+        self._counts = counts
+        self.n = sum(counts)
+
+    def _compress(self):
+        if not self._buf and not self._wbuf:
+            return
+
+        items = self._wbuf
+        items.extend(zip(self._means, self._counts))
+        items.extend((x, 1) for x in self._buf)
+        items.sort()
+        self._buf = []
+        self._wbuf = []
+
+        total = self.n
+        limit = 4 * total / self.K
+        means = []
+        counts = []
+        cur_mean, cur_count = items[0]
+        cum = 0  # weight of the centroids before the current one
+        for x, w in items[1:]:
+            count = cur_count + w
+            q = (cum + count / 2) / total
+            if count <= limit * q * (1 - q):
+                cur_mean += (x - cur_mean) * w / count
+                cur_count = count
+            else:
+                means.append(cur_mean)
+                counts.append(cur_count)
+                cum += cur_count
+                cur_mean, cur_count = x, w
+        means.append(cur_mean)
+        counts.append(cur_count)
+
+        self._means = means
+        self._counts = counts
 
 
 class TDigestStat:
@@ -10,7 +136,7 @@ class TDigestStat:
         self.count = 0
         self.sum = 0
         self.sumsq = 0
-        self.td = tdigest.TDigest(K=10)
+        self.td = TDigest(K=10)
         self.tdigest = None
 
     @property
@@ -25,6 +151,13 @@ class TDigestStat:
         self.sumsq += ms * ms
         self.td.update(ms)
 
+    def merge(self, other):
+        """Adds the values of other to this stat."""
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        self.td = self.td + other.td
+
 
 class TDigestStatGroups(TDigestStat):
 
@@ -52,6 +185,44 @@ class TDigestStatGroups(TDigestStat):
             self.groups[name] = stat
         stat.add(ms)
 
+    def merge(self, other):
+        super().merge(other)
+        for name, stat in other.groups.items():
+            if name in self.groups:
+                self.groups[name].merge(stat)
+            else:
+                self.groups[name] = stat
+
+
+def merge_stat_dicts(a, b):
+    """
+    Merges TDigestStat dict b (count, sum, sumsq, base64 tdigest and
+    optional groups and span paths) into a.
+    """
+    a["count"] += b["count"]
+    a["sum"] += b["sum"]
+    a["sumsq"] += b["sumsq"]
+    td = (from_bytes(base64.b64decode(a["tdigest"])) +
+          from_bytes(base64.b64decode(b["tdigest"])))
+    a["tdigest"] = base64.b64encode(as_bytes(td)).decode("ascii")
+
+    if "groups" in b:
+        groups = a.setdefault("groups", {})
+        for name, stat in b["groups"].items():
+            if name in groups:
+                merge_stat_dicts(groups[name], stat)
+            else:
+                groups[name] = stat
+
+    if "spans" in b:
+        spans = a.setdefault("spans", {})
+        for path, stat in b["spans"].items():
+            if path in spans:
+                for k, v in stat.items():
+                    spans[path][k] += v
+            else:
+                spans[path] = stat
+
 
 _SMALL_ENCODING = 2
 
@@ -66,40 +237,38 @@ def from_bytes(b):
     if num_centroids < 0 or num_centroids > 1 << 22:
         raise ValueError("bad number of centroids")
 
-    b = b[16:]
-    digest = tdigest.TDigest(K=int(compression))
+    if len(b) < 16 + 4 * num_centroids:
+        raise ValueError("truncated digest")
+    digest = TDigest(K=int(compression))
 
     x = 0
     means = []
-    for i in range(num_centroids):
-        delta = struct.unpack(">f", b[:4])[0]
-        b = b[4:]
+    for (delta,) in struct.iter_unpack(">f", b[16:16 + 4 * num_centroids]):
         x += delta
         means.append(x)
 
-    stream = decode_varint_stream(b)
-    for i in range(num_centroids):
-        count = next(stream)
-        digest.update(means[i], count)
+    stream = decode_varint_stream(b[16 + 4 * num_centroids:])
+    counts = [next(stream) for _ in range(num_centroids)]
+    digest._set_centroids(means, counts)
 
     return digest
 
 
 def as_bytes(digest):
+    means, counts = digest.centroids()
     b = bytearray()
 
     b += _SMALL_ENCODING.to_bytes(4, byteorder="big")
     b += struct.pack(">d", digest.K)
-    b += len(digest).to_bytes(4, byteorder="big")
+    b += len(means).to_bytes(4, byteorder="big")
 
     x = 0
-    for key in digest.C.keys():
-        delta = key - x
-        x = key
-        b += struct.pack(">f", delta)
+    for mean in means:
+        b += struct.pack(">f", mean - x)
+        x = mean
 
-    for value in digest.C.values():
-        encode_varint(b, int(value.count))
+    for count in counts:
+        encode_varint(b, int(count))
 
     return b
 
@@ -0,0 +1,609 @@
+import asyncio
+import functools
+import gzip
+import http.client
+import io
+import ssl
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import weakref
+import zlib
+
+from .circuit import CircuitBreaker
+
+_DEFAULT_TIMEOUT = 5
+_DEFAULT_MAX_CONNECTIONS = 10
+_DEFAULT_COMPRESSION_THRESHOLD = 1024
+_COMPRESSION_LEVEL = 6
+
+GZIP = "gzip"
+DEFLATE = "deflate"
+
+# Errors that mean a kept-alive connection was closed by the server while
+# it was idle. The request is retried once on a fresh connection.
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+class _ConnectionFailed(urllib.error.URLError):
+    """
+    _ConnectionFailed is raised when a request fails on the connection to
+    the host. Only these failures are recorded by the circuit breaker.
+    """
+
+
+class Response:
+    """
+    Response is a fully read HTTP response. It mimics the subset of the
+    urllib response interface used by pybrake (code, headers and read()).
+    """
+
+    def __init__(self, code, headers, body):
+        self.code = code
+        self.headers = headers
+        self._body = body
+
+    def read(self):
+        return self._body
+
+    def getcode(self):
+        return self.code
+
+
+class _Compressor:
+    """
+    _Compressor compresses request bodies that are at least threshold bytes
+    long and counts the bytes before and after compression.
+    """
+
+    def __init__(self, compression, threshold):
+        if compression not in (None, GZIP, DEFLATE):
+            raise ValueError(f"unknown compression: {compression}")
+
+        self._compression = compression
+        self._threshold = threshold
+        self._lock = threading.Lock()
+
+        self.compressed = 0
+        self.payload_bytes = 0
+        self.sent_bytes = 0
+
+    def wants(self, data):
+        return (
+            self._compression is not None and data is not None and
+            len(data) >= self._threshold
+        )
+
+    def compress(self, data, headers):
+        """
+        Returns the request body and headers to send.
+        """
+        size = len(data) if data else 0
+        if self.wants(data):
+            if self._compression == GZIP:
+                data = gzip.compress(
+                    data, compresslevel=_COMPRESSION_LEVEL, mtime=0)
+            else:
+                data = zlib.compress(data, _COMPRESSION_LEVEL)
+            headers = dict(headers, **{"Content-Encoding": self._compression})
+            compressed = 1
+        else:
+            compressed = 0
+
+        with self._lock:
+            self.compressed += compressed
+            self.payload_bytes += size
+            self.sent_bytes += len(data) if data else 0
+        return data, headers
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                requests_compressed=self.compressed,
+                payload_bytes=self.payload_bytes,
+                sent_bytes=self.sent_bytes,
+                compression_ratio=(
+                    self.sent_bytes / self.payload_bytes
+                    if self.payload_bytes else 1.0
+                ),
+            )
+
+
+class _HostPool:
+    """
+    _HostPool keeps idle keep-alive connections to a single scheme://host
+    and bounds the number of connections that can be open at once.
+    """
+
+    def __init__(self, scheme, netloc, *, max_connections, timeout):
+        self._scheme = scheme
+        self._netloc = netloc
+        self._timeout = timeout
+        self._proxy = _find_proxy(scheme, netloc)
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._idle = []
+
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+        self.errors = 0
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise urllib.error.URLError(
+                f"connection pool for {self._netloc} is exhausted")
+
+        with self._lock:
+            self.requests += 1
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop(), True
+
+        try:
+            return self.new_connection(), False
+        except Exception:
+            self._slots.release()
+            raise
+
+    def new_connection(self):
+        if self._proxy is not None:
+            proxy = urllib.parse.urlsplit(self._proxy)
+            if self._scheme == "https":
+                # TLS is negotiated with the target inside the CONNECT
+                # tunnel, whatever the scheme of the proxy is.
+                conn = http.client.HTTPSConnection(
+                    proxy.hostname, proxy.port, timeout=self._timeout)
+                conn.set_tunnel(self._netloc)
+            else:
+                conn = self._connection_class(proxy.scheme)(
+                    proxy.hostname, proxy.port, timeout=self._timeout)
+        else:
+            conn = self._connection_class(self._scheme)(
+                self._netloc, timeout=self._timeout)
+
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def release(self, conn, reusable):
+        if reusable:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def discard(self, conn):
+        with self._lock:
+            self.errors += 1
+        self.release(conn, False)
+
+    def path(self, parts):
+        if self._proxy is not None and self._scheme == "http":
+            return urllib.parse.urlunsplit(parts)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        return path
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                requests=self.requests,
+                connections_created=self.created,
+                connections_reused=self.reused,
+                connections_idle=len(self._idle),
+                errors=self.errors,
+            )
+
+    @staticmethod
+    def _connection_class(scheme):
+        if scheme == "https":
+            return http.client.HTTPSConnection
+        return http.client.HTTPConnection
+
+
+class Transport:
+    """
+    Transport sends HTTP requests to Airbrake over pooled keep-alive
+    connections. A single Transport is shared by the notifier, the APM
+    stats (routes, breakdowns, queries, queues) and the backlog, so
+    repeated payloads to the same host reuse an open TCP/TLS connection
+    instead of paying a handshake per request.
+
+    If compression is "gzip" or "deflate", request bodies of at least
+    compression_threshold bytes are compressed before they are sent.
+
+    Requests to a host that keeps failing are rejected by the circuit
+    breaker with CircuitOpenError until a probe request succeeds.
+    """
+
+    def __init__(self, *, max_connections=_DEFAULT_MAX_CONNECTIONS,
+                 timeout=_DEFAULT_TIMEOUT, compression=None,
+                 compression_threshold=_DEFAULT_COMPRESSION_THRESHOLD,
+                 circuit_breaker=None):
+        # pylint: disable=too-many-arguments
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self.compressor = _Compressor(compression, compression_threshold)
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def request(self, url, *, data=None, headers=None, method=None):
+        """
+        Sends the request and returns a fully read Response. Connection
+        level failures are raised as urllib.error.URLError, like urlopen.
+        """
+        parts = urllib.parse.urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+        self.circuit_breaker.before_request(host)
+        try:
+            resp = self._request(parts, data, headers, method)
+        except _ConnectionFailed as err:
+            self.circuit_breaker.record(host)
+            # Callers get the URLError urlopen would raise.
+            raise urllib.error.URLError(err.reason) from err.reason
+        except BaseException:
+            # An exhausted pool or an interrupt says nothing about the host.
+            self.circuit_breaker.cancel(host)
+            raise
+        self.circuit_breaker.record(host, resp.code)
+        return resp
+
+    def _request(self, parts, data, headers, method):
+        pool = self._get_pool(parts.scheme, parts.netloc)
+        path = pool.path(parts)
+        if method is None:
+            method = "GET" if data is None else "POST"
+        data, headers = self.compressor.compress(data, headers or {})
+
+        conn, reused = pool.acquire()
+        try:
+            try:
+                resp, will_close = _roundtrip(
+                    conn, method, path, data, headers)
+            except _STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                conn.close()
+                conn = pool.new_connection()
+                resp, will_close = _roundtrip(
+                    conn, method, path, data, headers)
+        except (OSError, http.client.HTTPException) as err:
+            pool.discard(conn)
+            raise _ConnectionFailed(err) from err
+        except BaseException:
+            pool.discard(conn)
+            raise
+
+        pool.release(conn, not will_close)
+        return resp
+
+    def stats(self):
+        """
+        Returns connection reuse statistics, in total and per host, and
+        request body compression statistics.
+        """
+        with self._lock:
+            pools = dict(self._pools)
+
+        hosts = {}
+        total = dict(requests=0, connections_created=0,
+                     connections_reused=0, connections_idle=0, errors=0)
+        for (scheme, netloc), pool in pools.items():
+            stats = pool.stats()
+            hosts[f"{scheme}://{netloc}"] = stats
+            for k, v in stats.items():
+                total[k] += v
+
+        total.update(self.compressor.stats())
+        total["hosts"] = hosts
+        total["circuits"] = self.circuit_breaker.stats()
+        return total
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.close()
+
+    def _get_pool(self, scheme, netloc):
+        key = (scheme, netloc)
+        pool = self._pools.get(key)
+        if pool is not None:
+            return pool
+
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = _HostPool(
+                    scheme, netloc,
+                    max_connections=self._max_connections,
+                    timeout=self._timeout,
+                )
+                self._pools[key] = pool
+            return pool
+
+
+class _AsyncHostPool:
+    """
+    _AsyncHostPool is the asyncio counterpart of _HostPool. It belongs to a
+    single event loop because asyncio streams can't be shared between loops.
+    """
+
+    def __init__(self, scheme, netloc, *, max_connections):
+        parts = urllib.parse.urlsplit(f"{scheme}://{netloc}")
+        self._host = parts.hostname
+        self._port = parts.port or (443 if scheme == "https" else 80)
+        self._ssl = ssl.create_default_context() if scheme == "https" else None
+
+        self.slots = asyncio.Semaphore(max_connections)
+        self._idle = []
+
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+        self.errors = 0
+
+    async def open(self):
+        self.requests += 1
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+            self.reused += 1
+            return reader, writer, True
+
+        reader, writer = await asyncio.open_connection(
+            self._host, self._port, ssl=self._ssl)
+        self.created += 1
+        return reader, writer, False
+
+    def release(self, reader, writer, reusable):
+        if reusable:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+    def stats(self):
+        return dict(
+            requests=self.requests,
+            connections_created=self.created,
+            connections_reused=self.reused,
+            connections_idle=len(self._idle),
+            errors=self.errors,
+        )
+
+
+class AsyncTransport:
+    """
+    AsyncTransport is a non-blocking HTTP/1.1 client for asyncio
+    applications. It keeps keep-alive connections per event loop and host,
+    and bounds the number of connections open at once.
+
+    Requests that have to go through an HTTP proxy are delegated to the
+    fallback (blocking) Transport in the loop's default executor. Request
+    bodies are compressed in the default executor too, so compression never
+    blocks the event loop.
+    """
+
+    def __init__(self, *, max_connections=_DEFAULT_MAX_CONNECTIONS,
+                 timeout=_DEFAULT_TIMEOUT, fallback=None, compression=None,
+                 compression_threshold=_DEFAULT_COMPRESSION_THRESHOLD,
+                 circuit_breaker=None):
+        # pylint: disable=too-many-arguments
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._fallback = fallback
+        self.compressor = _Compressor(compression, compression_threshold)
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._pools = weakref.WeakKeyDictionary()
+
+    async def request(self, url, *, data=None, headers=None, method=None):
+        """
+        Sends the request and returns a fully read Response. Connection
+        level failures are raised as urllib.error.URLError.
+        """
+        parts = urllib.parse.urlsplit(url)
+        if _find_proxy(parts.scheme, parts.netloc) is not None:
+            fallback = self._fallback or DEFAULT_TRANSPORT
+            return await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(
+                    fallback.request, url, data=data, headers=headers,
+                    method=method))
+
+        host = f"{parts.scheme}://{parts.netloc}"
+        self.circuit_breaker.before_request(host)
+        try:
+            resp = await self._request(parts, data, headers, method)
+        except _ConnectionFailed as err:
+            self.circuit_breaker.record(host)
+            # Callers get the URLError urlopen would raise.
+            raise urllib.error.URLError(err.reason) from err.reason
+        except BaseException:
+            # A cancelled task says nothing about the host.
+            self.circuit_breaker.cancel(host)
+            raise
+        self.circuit_breaker.record(host, resp.code)
+        return resp
+
+    async def _request(self, parts, data, headers, method):
+        pool = self._get_pool(parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        if method is None:
+            method = "GET" if data is None else "POST"
+        if self.compressor.wants(data):
+            data, headers = await asyncio.get_running_loop().run_in_executor(
+                None, self.compressor.compress, data, headers or {})
+        else:
+            data, headers = self.compressor.compress(data, headers or {})
+        head = _request_head(method, path, parts.netloc, data, headers)
+
+        async with pool.slots:
+            try:
+                return await asyncio.wait_for(
+                    self._roundtrip(pool, head, data), self._timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError, ValueError) as err:
+                pool.errors += 1
+                raise _ConnectionFailed(err) from err
+
+    async def _roundtrip(self, pool, head, data):
+        reader, writer, reused = await pool.open()
+        try:
+            try:
+                resp, will_close = await _async_roundtrip(
+                    reader, writer, head, data)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                writer.close()
+                reader, writer, _ = await pool.open()
+                resp, will_close = await _async_roundtrip(
+                    reader, writer, head, data)
+        except BaseException:
+            writer.close()
+            raise
+
+        pool.release(reader, writer, not will_close)
+        return resp
+
+    def stats(self):
+        """
+        Returns connection reuse statistics for the running event loop,
+        in total and per host, and request body compression statistics.
+        """
+        try:
+            pools = self._pools.get(asyncio.get_running_loop(), {})
+        except RuntimeError:
+            pools = {}
+
+        hosts = {}
+        total = dict(requests=0, connections_created=0,
+                     connections_reused=0, connections_idle=0, errors=0)
+        for (scheme, netloc), pool in pools.items():
+            stats = pool.stats()
+            hosts[f"{scheme}://{netloc}"] = stats
+            for k, v in stats.items():
+                total[k] += v
+
+        total.update(self.compressor.stats())
+        total["hosts"] = hosts
+        total["circuits"] = self.circuit_breaker.stats()
+        return total
+
+    def close(self):
+        """Closes all idle connections."""
+        for pools in list(self._pools.values()):
+            for pool in pools.values():
+                pool.close()
+
+    def _get_pool(self, scheme, netloc):
+        loop = asyncio.get_running_loop()
+        pools = self._pools.get(loop)
+        if pools is None:
+            pools = {}
+            self._pools[loop] = pools
+
+        key = (scheme, netloc)
+        pool = pools.get(key)
+        if pool is None:
+            pool = _AsyncHostPool(
+                scheme, netloc, max_connections=self._max_connections)
+            pools[key] = pool
+        return pool
+
+
+def _request_head(method, path, netloc, data, headers):
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {netloc}"]
+    for k, v in headers.items():
+        lines.append(f"{k}: {v}")
+    lines.append(f"Content-Length: {len(data) if data else 0}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def _async_roundtrip(reader, writer, head, data):
+    writer.write(head)
+    if data:
+        writer.write(data)
+    await writer.drain()
+
+    raw = await reader.readuntil(b"\r\n\r\n")
+    status_line, _, raw_headers = raw.partition(b"\r\n")
+    version, status = status_line.split(b" ", 2)[:2]
+    headers = http.client.parse_headers(io.BytesIO(raw_headers))
+    code = int(status)
+
+    will_close = (
+        version == b"HTTP/1.0" or
+        headers.get("Connection", "").lower() == "close"
+    )
+
+    if code in (204, 304) or 100 <= code < 200:
+        body = b""
+    elif headers.get("Transfer-Encoding", "").lower() == "chunked":
+        body = await _read_chunked(reader)
+    elif headers.get("Content-Length") is not None:
+        body = await reader.readexactly(int(headers["Content-Length"]))
+    else:
+        body = await reader.read()
+        will_close = True
+
+    return Response(code, headers, body), will_close
+
+
+async def _read_chunked(reader):
+    chunks = []
+    while True:
+        line = await reader.readuntil(b"\r\n")
+        size = int(line.split(b";", 1)[0], 16)
+        if size == 0:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+    # Skip trailers.
+    while await reader.readuntil(b"\r\n") != b"\r\n":
+        pass
+    return b"".join(chunks)
+
+
+def _roundtrip(conn, method, path, data, headers):
+    conn.request(method, path, body=data, headers=headers)
+    r = conn.getresponse()
+    body = r.read()
+    return Response(r.status, r.headers, body), r.will_close
+
+
+def _find_proxy(scheme, netloc):
+    host = netloc.rsplit(":", 1)[0]
+    if urllib.request.proxy_bypass(host):
+        return None
+    return urllib.request.getproxies().get(scheme)
+
+
+DEFAULT_TRANSPORT = Transport()
@@ -0,0 +1,142 @@
+import fcntl
+import json
+import socket
+import time
+
+import pytest
+
+from pybrake import serializer
+from pybrake.aggregator import Aggregator, CLIENT, OWNER
+from pybrake.routes import RouteStat, RouteStats
+
+URL = "http://localhost:5000/api/v5/projects/0/routes-stats"
+
+
+def _payload(*values):
+    stat = RouteStat(method="GET", route="/a", status_code=200,
+                     time=1673352000)
+    for ms in values:
+        stat.add(ms)
+    return serializer.dumps(dict(routes=[stat.__dict__]))
+
+
+def _wait(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "agg.sock")
+
+
+def test_aggregator_merges_workers(mocker, path):
+    send = mocker.patch("pybrake.metrics.send", return_value=True)
+    owner = Aggregator(path)
+    worker = Aggregator(path)
+    try:
+        assert owner.submit(URL, _payload(10, 20))
+        assert owner.role == OWNER
+        assert worker.submit(URL, _payload(30))
+        assert worker.role == CLIENT
+        _wait(lambda: owner.stats()["received"] == 1)
+
+        assert worker.flush() == 0
+        send.assert_not_called()
+
+        assert owner.flush() == 0
+        send.assert_called_once()
+        assert send.call_args.kwargs["url"] == URL
+        routes = json.loads(send.call_args.kwargs["payload"])["routes"]
+        assert len(routes) == 1
+        assert routes[0]["count"] == 3
+        assert routes[0]["sum"] == 60
+    finally:
+        owner.close()
+        worker.close()
+
+
+def test_aggregator_takeover(mocker, path):
+    mocker.patch("pybrake.metrics.send", return_value=True)
+    owner = Aggregator(path)
+    worker = Aggregator(path)
+    try:
+        owner.submit(URL, _payload(10))
+        worker.submit(URL, _payload(10))
+        assert worker.role == CLIENT
+
+        owner.close()
+        assert worker.submit(URL, _payload(10))
+        assert worker.role == OWNER
+    finally:
+        owner.close()
+        worker.close()
+
+
+def test_aggregator_keeps_payloads_while_throttled(mocker, path):
+    mocker.patch("pybrake.metrics.send", return_value=False)
+    backpressure = mocker.Mock()
+    backpressure.throttled.return_value = True
+    owner = Aggregator(path, backpressure=backpressure)
+    try:
+        owner.submit(URL, _payload(10))
+        assert owner.flush() == 0
+        assert owner.stats()["pending"] == 1
+    finally:
+        owner.close()
+
+
+def test_aggregator_client_does_not_block(path):
+    # Another process owns the socket and doesn't read it.
+    with open(path + ".lock", "ab") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        owner = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        owner.bind(path)
+        worker = Aggregator(path)
+        try:
+            payload = _payload(*range(1000))
+            for _ in range(10000):
+                if not worker.submit(URL, payload):
+                    break
+            else:
+                pytest.fail("owner socket never filled up")
+            assert worker.role == CLIENT
+        finally:
+            worker.close()
+            owner.close()
+
+
+def test_aggregator_keeps_unmergeable_payloads(mocker, path):
+    send = mocker.patch("pybrake.metrics.send", return_value=True)
+    owner = Aggregator(path)
+    try:
+        assert owner.submit(URL, _payload(10))
+        assert owner.submit(URL, b"not json")
+        assert owner.stats()["pending"] == 2
+
+        assert owner.flush() == 0
+        assert [c.kwargs["payload"] for c in send.call_args_list] == \
+            [_payload(10), b"not json"]
+    finally:
+        owner.close()
+
+
+def test_route_stats_submit_to_aggregator(mocker):
+    send = mocker.patch("pybrake.metrics.send", return_value=True)
+    aggregator = mocker.Mock()
+    aggregator.submit.return_value = True
+    stats = RouteStats(config=dict(apm_host="http://localhost:5000"),
+                       aggregator=aggregator)
+    stat = RouteStat(method="GET", route="/a", time=1673352000)
+    stat.add(10)
+
+    assert stats._send({"key": stat})
+    aggregator.submit.assert_called_once()
+    assert aggregator.submit.call_args[0][0] == URL
+    send.assert_not_called()
+
+    aggregator.submit.return_value = False
+    assert stats._send({"key": stat})
+    send.assert_called_once()
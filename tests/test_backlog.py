@@ -0,0 +1,277 @@
+import base64
+import json
+import threading
+import time
+
+from pybrake import metrics
+from pybrake import serializer
+from pybrake.backlog import Backlog, make_spool, merge_payloads
+from pybrake.circuit import CircuitOpenError
+from pybrake.routes import RouteStat
+from pybrake.tdigest import TDigestStat, from_bytes
+from .test_helper import MockResponse
+
+
+def _wait_for(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_backlog_sends_concurrently(mocker):
+    lock = threading.Lock()
+    active = []
+    max_active = []
+
+    def send(**kwargs):
+        with lock:
+            active.append(1)
+            max_active.append(len(active))
+        time.sleep(0.1)
+        with lock:
+            active.pop()
+        return True
+
+    mocker.patch("pybrake.metrics.send", side_effect=send)
+    backlog = Backlog(method="POST", header={}, interval=0.01,
+                      max_parallel=4)
+    for i in range(8):
+        backlog.append_stats(b"{}", f"http://localhost/{i}")
+
+    start = time.monotonic()
+    assert _wait_for(lambda: backlog.stats()["sent"] == 8)
+    assert time.monotonic() - start < 0.8
+    assert max(max_active) == 4
+    assert backlog.stats()["depth"] == 0
+
+
+def test_backlog_backoff():
+    backlog = Backlog(method="POST", header={}, interval=60)
+    backlog._running = True  # don't start sending
+
+    now = time.time()
+    backlog.append_stats(b"{}", "http://localhost/", retry_count=3)
+
+    item = backlog._peek()
+    assert now + 4 <= item["due"] <= time.time() + 8
+    stats = backlog.stats()
+    assert stats["depth"] == 1
+    assert stats["oldest_age"] >= 0
+
+
+def test_backlog_backoff_is_capped_by_interval():
+    backlog = Backlog(method="POST", header={}, interval=2, max_attempts=100)
+    backlog._running = True  # don't start sending
+
+    backlog.append_stats(b"{}", "http://localhost/", retry_count=20)
+
+    assert backlog._peek()["due"] <= time.time() + 2
+
+
+def test_backlog_max_attempts():
+    backlog = Backlog(method="POST", header={}, max_attempts=2)
+
+    backlog.append_stats(b"{}", "http://localhost/", retry_count=2)
+
+    assert backlog.stats()["dropped"] == 1
+    assert backlog.stats()["depth"] == 0
+
+
+def test_backlog_replays_spool(tmp_path, mocker):
+    send = mocker.patch("pybrake.metrics.send", return_value=True)
+    config = dict(backlog_dir=str(tmp_path))
+
+    spool = make_spool(config, "apm")
+    spool.append(dict(retry_count=0, url="http://localhost/", data=b"{}"))
+    spool.close()
+
+    backlog = Backlog(method="POST", header={},
+                      spool=make_spool(config, "apm"))
+
+    assert _wait_for(lambda: backlog.stats()["sent"] == 1)
+    assert send.call_args[1]["payload"] == b"{}"
+    assert send.call_args[1]["retry_count"] == 1
+
+
+class _DownTransport:
+    """Rejects requests like an open circuit until up_at."""
+
+    def __init__(self, up_at):
+        self.up_at = up_at
+        self.requests = 0
+
+    def request(self, url, **kwargs):
+        self.requests += 1
+        if time.time() < self.up_at:
+            raise CircuitOpenError("circuit is open", retry_at=self.up_at)
+        return MockResponse(resp_data=b"", code=201)
+
+
+def test_backlog_waits_for_open_circuit(monkeypatch):
+    monkeypatch.setattr("pybrake.backlog._BASE_DELAY", 0.01)
+    # The circuit stays open much longer than the backoff schedule.
+    transport = _DownTransport(up_at=time.time() + 0.5)
+    backlog = Backlog(method="POST", header={}, interval=0.02,
+                      max_attempts=2, transport=transport)
+    monkeypatch.setattr(metrics, "APM_Backlog", backlog)
+
+    backlog.append_stats(b"{}", "http://localhost/")
+    assert _wait_for(lambda: transport.requests >= 1)
+    time.sleep(0.1)
+    assert backlog.stats()["dropped"] == 0
+    assert backlog.stats()["depth"] == 1
+
+    assert _wait_for(lambda: backlog.stats()["sent"] == 1)
+    assert backlog.stats()["dropped"] == 0
+    # Rejected items wait for the circuit instead of polling it.
+    assert transport.requests == 2
+
+
+def test_backlog_spool_keeps_items_while_host_is_down(tmp_path, monkeypatch):
+    monkeypatch.setattr("pybrake.backlog._BASE_DELAY", 0.01)
+    config = dict(backlog_dir=str(tmp_path))
+    spool = make_spool(config, "apm")
+    spool.append(dict(retry_count=0, url="http://localhost/", data=b"{}"))
+    spool.close()
+
+    transport = _DownTransport(up_at=time.time() + 60)
+    spool = make_spool(config, "apm")
+    backlog = Backlog(method="POST", header={}, interval=0.02,
+                      max_attempts=1, transport=transport, spool=spool)
+    monkeypatch.setattr(metrics, "APM_Backlog", backlog)
+
+    assert _wait_for(lambda: transport.requests == 1)
+    assert _wait_for(lambda: backlog.stats()["depth"] == 1)
+    assert backlog.stats()["dropped"] == 0
+    spool.close()
+
+    spool = make_spool(config, "apm")
+    assert len(spool) == 1
+    assert spool.peek()["data"] == b"{}"
+    assert spool.peek()["due"] >= transport.up_at
+
+
+def _route_payload(route, *values):
+    stat = RouteStat(method="GET", route=route, status_code=200,
+                     time=1673352000)
+    for ms in values:
+        stat.add(ms)
+    return serializer.dumps(dict(routes=[stat.__dict__]))
+
+
+def test_backlog_merges_apm_payloads():
+    backlog = Backlog(method="POST", header={})
+    backlog._running = True  # don't start sending
+    url = "http://localhost/routes-stats"
+
+    backlog.append_stats(_route_payload("/a", 10, 20), url)
+    backlog.append_stats(_route_payload("/a", 30), url, retry_count=1)
+    backlog.append_stats(_route_payload("/b", 5), url)
+    backlog.append_stats(_route_payload("/a", 1), "http://localhost/other")
+
+    assert backlog.stats()["depth"] == 2
+    item = backlog._peek()
+    assert item["retry_count"] == 0
+
+    routes = {r["route"]: r for r in json.loads(item["data"])["routes"]}
+    assert routes["/a"]["count"] == 3
+    assert routes["/a"]["sum"] == 60
+    assert routes["/a"]["sumsq"] == 1400
+    td = from_bytes(base64.b64decode(routes["/a"]["tdigest"]))
+    assert td.n == 3
+    assert routes["/b"]["count"] == 1
+
+
+def test_backlog_spool_does_not_merge_apm_payloads(tmp_path):
+    backlog = Backlog(method="POST", header={},
+                      spool=make_spool(dict(backlog_dir=str(tmp_path)), "apm"))
+    backlog._running = True  # don't start sending
+    url = "http://localhost/routes-stats"
+
+    backlog.append_stats(_route_payload("/a", 10), url)
+    backlog.append_stats(_route_payload("/a", 20), url)
+
+    assert backlog.stats()["depth"] == 2
+    assert backlog._pending == {}
+
+
+def test_backlog_eviction_drops_merge_target():
+    backlog = Backlog(method="POST", header={}, maxlen=2)
+    backlog._running = True  # don't start sending
+    url = "http://localhost/routes-stats"
+
+    backlog.append_stats(_route_payload("/a", 10), url)
+    backlog.append_stats(_route_payload("/a", 1), "http://localhost/b")
+    backlog.append_stats(_route_payload("/a", 1), "http://localhost/c")
+    assert backlog.stats()["dropped"] == 1
+
+    # The evicted item is no longer merged into.
+    backlog.append_stats(_route_payload("/a", 20), url)
+    assert backlog.stats()["dropped"] == 2
+    assert [item["url"] for item in backlog._backlog] == \
+        ["http://localhost/c", url]
+
+
+def test_merge_payloads_groups():
+    a = dict(count=1, sum=10, sumsq=100, tdigest=_digest(10),
+             groups=dict(db=dict(count=1, sum=4, sumsq=16, tdigest=_digest(4))))
+    b = dict(count=1, sum=20, sumsq=400, tdigest=_digest(20),
+             groups=dict(db=dict(count=1, sum=6, sumsq=36, tdigest=_digest(6)),
+                         http=dict(count=1, sum=2, sumsq=4,
+                                   tdigest=_digest(2))))
+    key = dict(queue="jobs", time="2023-01-10T12:00:00Z")
+
+    merged = json.loads(merge_payloads(
+        serializer.dumps(dict(queues=[dict(key, **a)], environment="prod")),
+        serializer.dumps(dict(queues=[dict(key, **b)], environment="prod")),
+    ))
+
+    assert merged["environment"] == "prod"
+    assert len(merged["queues"]) == 1
+    stat = merged["queues"][0]
+    assert stat["count"] == 2
+    assert stat["groups"]["db"]["sum"] == 10
+    assert stat["groups"]["http"]["count"] == 1
+
+
+def test_merge_payloads_groups_only_in_newer():
+    key = dict(queue="jobs", time="2023-01-10T12:00:00Z")
+    a = dict(key, count=1, sum=10, sumsq=100, tdigest=_digest(10))
+    b = dict(key, count=1, sum=20, sumsq=400, tdigest=_digest(20),
+             groups=dict(db=dict(count=1, sum=6, sumsq=36, tdigest=_digest(6))))
+
+    merged = json.loads(merge_payloads(
+        serializer.dumps(dict(queues=[a])),
+        serializer.dumps(dict(queues=[b])),
+    ))
+
+    assert merged["queues"][0]["groups"]["db"]["sum"] == 6
+
+
+def test_merge_payloads_span_paths():
+    key = dict(method="GET", route="/a", responseType="json",
+               time="2023-01-10T12:00:00Z")
+    a = dict(key, count=1, sum=10, sumsq=100, tdigest=_digest(10), groups={},
+             spans={"http.handler/sql": dict(count=2, total=4, self=4)})
+    b = dict(key, count=1, sum=20, sumsq=400, tdigest=_digest(20), groups={},
+             spans={"http.handler/sql": dict(count=1, total=3, self=3),
+                    "http.handler": dict(count=1, total=20, self=17)})
+
+    merged = json.loads(merge_payloads(
+        serializer.dumps(dict(routes=[a])),
+        serializer.dumps(dict(routes=[b])),
+    ))
+
+    assert len(merged["routes"]) == 1
+    spans = merged["routes"][0]["spans"]
+    assert spans["http.handler/sql"] == dict(count=3, total=7, self=7)
+    assert spans["http.handler"]["count"] == 1
+
+
+def _digest(ms):
+    stat = TDigestStat()
+    stat.add(ms)
+    return stat.__dict__["tdigest"]
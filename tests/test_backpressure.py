@@ -0,0 +1,69 @@
+import time
+
+import pybrake.metrics as metrics
+from pybrake.backpressure import BackPressure
+
+from .test_helper import MockResponse
+
+url = "http://localhost:5000/api/v5/projects/0/routes-stats"
+
+
+def test_429_pauses_endpoint():
+    bp = BackPressure()
+    assert not bp.throttled(url)
+    assert bp.interval(url, 15) == 15
+
+    bp.update(url, MockResponse(b"", code=429,
+                                headers={"X-RateLimit-Delay": "30"}))
+    assert bp.throttled(url)
+    assert not bp.throttled(url + "/other")
+    assert 29 < bp.interval(url, 15) <= 30
+
+    stats = bp.stats()[url]
+    assert stats["factor"] == 2
+    assert stats["throttled"] == 1
+
+
+def test_interval_widens_and_recovers():
+    bp = BackPressure(max_factor=8)
+    for _ in range(5):
+        bp.update(url, MockResponse(b"", code=429,
+                                    headers={"Retry-After": "0"}))
+    assert not bp.throttled(url)
+    assert bp.interval(url, 15) == 120
+
+    bp.update(url, MockResponse(b"", code=202))
+    assert bp.interval(url, 15) == 60
+    for _ in range(2):
+        bp.update(url, MockResponse(b"", code=202))
+    assert bp.interval(url, 15) == 15
+    assert bp.stats() == {}
+
+
+def test_retry_after_http_date():
+    bp = BackPressure()
+    date = time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+                         time.gmtime(time.time() + 120))
+    bp.update(url, MockResponse(b"", code=429, headers={"Retry-After": date}))
+    assert 100 < bp.stats()[url]["paused_for"] <= 120
+
+
+def test_missing_header_uses_default_delay():
+    bp = BackPressure(default_delay=7)
+    bp.update(url, MockResponse(b"", code=429))
+    assert 6 < bp.stats()[url]["paused_for"] <= 7
+
+
+def test_send_skips_paused_endpoint(mocker):
+    bp = BackPressure()
+    request = mocker.patch(
+        "pybrake.transport.Transport.request",
+        return_value=MockResponse(b"", code=429,
+                                  headers={"X-RateLimit-Delay": "60"}),
+    )
+
+    assert metrics.send(url=url, payload=b"{}", headers={},
+                        backpressure=bp) is False
+    assert metrics.send(url=url, payload=b"{}", headers={},
+                        backpressure=bp) is False
+    assert request.call_count == 1
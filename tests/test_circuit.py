@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+from pybrake.circuit import CircuitBreaker, CircuitOpenError, CLOSED, \
+    HALF_OPEN, OPEN
+
+host = "https://api.airbrake.io"
+
+
+def _fail(breaker, n):
+    for _ in range(n):
+        breaker.before_request(host)
+        breaker.record(host)
+
+
+def test_circuit_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    _fail(breaker, 2)
+    breaker.record(host, 201)
+    _fail(breaker, 2)
+    assert breaker.state(host) == CLOSED
+
+    _fail(breaker, 1)
+    assert breaker.state(host) == OPEN
+    with pytest.raises(CircuitOpenError) as exc_info:
+        breaker.before_request(host)
+    assert exc_info.value.retry_at == pytest.approx(time.time() + 60, abs=1)
+    breaker.before_request("https://other.host")
+
+    stats = breaker.stats()[host]
+    assert stats == dict(state=OPEN, failures=3, rejected=1, opened=1)
+
+
+def test_circuit_half_open_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    _fail(breaker, 1)
+    time.sleep(0.06)
+
+    breaker.before_request(host)
+    assert breaker.state(host) == HALF_OPEN
+    # Only a single probe is let through.
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request(host)
+
+    breaker.record(host)
+    assert breaker.state(host) == OPEN
+    assert breaker.stats()[host]["opened"] == 2
+
+    time.sleep(0.06)
+    breaker.before_request(host)
+    breaker.record(host, 200)
+    assert breaker.state(host) == CLOSED
+    breaker.before_request(host)
+
+
+def test_circuit_cancelled_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    _fail(breaker, 1)
+    time.sleep(0.06)
+
+    breaker.before_request(host)
+    breaker.cancel(host)
+    assert breaker.state(host) == OPEN
+    # The next request is the probe.
+    breaker.before_request(host)
+    assert breaker.state(host) == HALF_OPEN
+    assert breaker.stats()[host]["failures"] == 1
+
+
+def test_circuit_gateway_errors_are_failures():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record(host, 503)
+    breaker.record(host, 500)
+    assert breaker.state(host) == CLOSED
+    breaker.record(host, 502)
+    breaker.record(host, 504)
+    assert breaker.state(host) == OPEN
+
+
+def test_circuit_disabled():
+    breaker = CircuitBreaker(failure_threshold=0)
+    _fail(breaker, 10)
+    assert breaker.state(host) == CLOSED
@@ -0,0 +1,68 @@
+from pybrake.coalescer import Coalescer, fingerprint
+from pybrake.notifier import Notifier
+
+from .test_helper import get_exception, get_nested_exception
+
+
+def test_fingerprint_same_location():
+    assert fingerprint(get_exception()) == fingerprint(get_exception())
+    assert fingerprint(get_exception()) != fingerprint(get_nested_exception())
+    assert fingerprint("hello") == fingerprint("hello")
+    assert fingerprint("hello") != fingerprint("world")
+
+
+def test_fingerprint_unraised_exception():
+    assert fingerprint(ValueError("a")) == fingerprint(ValueError("a"))
+    assert fingerprint(ValueError("a")) != fingerprint(ValueError("b"))
+
+
+def test_coalesced_string_keeps_call_site(mocker):
+    notifier = Notifier(coalesce_window=60)
+    send = mocker.patch.object(notifier, "send_notice_sync")
+    mocker.patch.object(notifier, "send_notice")
+
+    for _ in range(3):
+        notifier.notify("hello")
+    notifier._coalescer._thread.cancel()
+    notifier._coalescer._flush()
+    notifier._coalescer._thread.cancel()
+
+    notice = send.call_args[0][0]
+    assert notice["params"]["occurrences"]["count"] == 2
+    frame = notice["errors"][0]["backtrace"][0]
+    assert frame["function"] == "test_coalesced_string_keeps_call_site"
+
+
+def test_coalescer_folds_repeats(mocker):
+    notifier = Notifier()
+    send = mocker.patch.object(notifier, "send_notice_sync")
+    coalescer = Coalescer(notifier, window=60)
+
+    assert coalescer.add(get_exception())
+    for _ in range(9):
+        assert not coalescer.add(get_exception())
+    assert coalescer.add(get_nested_exception())
+
+    coalescer._thread.cancel()
+    coalescer._flush()
+    coalescer._thread.cancel()
+
+    assert send.call_count == 1
+    notice = send.call_args[0][0]
+    assert notice["errors"][0]["type"] == "ValueError"
+    occurrences = notice["params"]["occurrences"]
+    assert occurrences["count"] == 9
+    assert occurrences["firstSeen"] <= occurrences["lastSeen"]
+
+
+def test_notify_coalesced():
+    notifier = Notifier(coalesce_window=60)
+    notifier.add_filter(lambda notice: None)
+
+    notice = notifier.notify_sync(get_exception())
+    assert notice["error"] == "notice is filtered out"
+
+    notice = notifier.notify(get_exception()).result()
+    assert notice["error"] == "notice is coalesced"
+
+    notifier._coalescer._thread.cancel()
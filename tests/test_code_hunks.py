@@ -0,0 +1,90 @@
+import os
+
+from pybrake import clock
+from pybrake.code_hunks import SourceCache, get_code_hunk
+
+
+def _write(path, lines):
+    path.write_text("\n".join(lines) + "\n")
+
+
+def test_get_code_hunk():
+    filename = os.path.join(os.path.dirname(__file__), "test_helper.py")
+
+    assert get_code_hunk(filename, 7) == {
+        5: "def get_exception():",
+        6: "    try:",
+        7: '        raise ValueError("hello")',
+        8: "    except ValueError as err:",
+        9: "        return err",
+    }
+    assert get_code_hunk(filename, 1, nlines=1) == {
+        1: "import logging",
+        2: "import urllib",
+    }
+
+
+def test_source_cache_hit_and_mtime(tmp_path):
+    path = tmp_path / "mod.py"
+    _write(path, [f"line{i}" for i in range(1, 101)])
+    cache = SourceCache()
+
+    assert cache.get_lines(str(path), 50, 1) == (49, [b"line49", b"line50",
+                                                     b"line51"])
+    assert cache.get_lines(str(path), 100, 2) == (98, [b"line98", b"line99",
+                                                      b"line100"])
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+    manual = clock.ManualClock(ns=clock.monotonic_ns())
+    prev = clock.set_clock(manual)
+    try:
+        _write(path, ["changed"] * 10)
+        os.utime(path, ns=(0, 0))
+        # The mtime is not checked again within a second.
+        cache.get_lines(str(path), 1, 0)
+        assert cache.stats()["hits"] == 2
+
+        manual.advance(1)
+        assert cache.get_lines(str(path), 1, 0) == (1, [b"changed"])
+        assert cache.stats()["misses"] == 2
+    finally:
+        clock.set_clock(prev)
+
+
+def test_source_cache_byte_budget(tmp_path):
+    cache = SourceCache(max_bytes=2000)
+    for i in range(10):
+        path = tmp_path / f"mod{i}.py"
+        _write(path, ["x"] * 100)
+        assert cache.get_lines(str(path), 1, 0) == (1, [b"x"])
+
+    stats = cache.stats()
+    assert stats["bytes"] <= 2000
+    assert stats["evictions"] > 0
+    assert stats["files"] < 10
+
+
+def test_source_cache_loader():
+    class Loader:
+        def get_source(self, module_name):
+            return "a = 1\nb = 2\nc = 3\n"
+
+    cache = SourceCache()
+    assert cache.get_lines("<generated>", 2, 1, loader=Loader(),
+                           module_name="gen") == (1, ["a = 1", "b = 2",
+                                                      "c = 3"])
+    assert cache.get_lines("<missing>", 2, 1) is None
+
+
+def test_source_cache_prefers_loader(tmp_path):
+    path = tmp_path / "mod.py"
+    _write(path, ["on disk"])
+
+    class Loader:
+        def get_source(self, module_name):
+            return "from loader\n"
+
+    cache = SourceCache()
+    assert cache.get_lines(str(path), 1, 0, loader=Loader(),
+                           module_name="mod") == (1, ["from loader"])
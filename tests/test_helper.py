@@ -88,5 +88,5 @@ class MockResponse(object):
 
 
 class TestBacklog(object):
-    def append_stats(self, val, url, retry_count=0):
+    def append_stats(self, val, url, retry_count=0, retry_at=None):
         pass
@@ -1,4 +1,16 @@
+import asyncio
+import contextvars
+import threading
+import tracemalloc
+
+import pytest
+
 import pybrake.metrics as metrics
+from pybrake import clock
+from pybrake.clock import ManualClock
+from pybrake.route_metric import RouteMetric
+from pybrake.circuit import CircuitOpenError
+from pybrake.notice import NoticeTooLargeError
 
 from pybrake.notifier import Notifier
 from .test_helper import get_exception, TestBacklog, MockResponse
@@ -38,7 +50,7 @@ metrics.APM_Backlog = TestBacklog()
 def test_send_500_status(mocker, caplog):
     resp = MockResponse(resp_data="Error: Internal Server Error", code=500)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -49,7 +61,7 @@ def test_send_500_status(mocker, caplog):
 def test_send_exception(mocker, caplog):
     resp = MockResponse(resp_data="IOError", code=200)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -60,17 +72,47 @@ def test_send_exception(mocker, caplog):
 def test_send_success(mocker, caplog):
     resp = MockResponse(resp_data="Done", code=200)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
-    assert metrics.send(url=route_url, payload=route_payload, headers=headers) is None
+    assert metrics.send(url=route_url, payload=route_payload, headers=headers) is True
+
+
+def test_send_circuit_open(mocker, caplog):
+    mocker.patch(
+        "pybrake.transport.Transport.request",
+        side_effect=CircuitOpenError("circuit is open", retry_at=30)
+    )
+    backlog = mocker.patch.object(metrics, "APM_Backlog")
+
+    sent = metrics.send(url=route_url, payload=route_payload, headers=headers)
+    assert not sent
+    assert sent is metrics.BACKLOGGED
+    backlog.append_stats.assert_called_once_with(
+        val=route_payload, url=route_url, retry_count=0, retry_at=30)
+    assert "circuit is open" not in caplog.text
+
+
+def test_send_notice_async_circuit_open(mocker):
+    class Transport:
+        async def request(self, url, **kwargs):
+            raise CircuitOpenError("circuit is open", retry_at=30)
+
+    backlog = mocker.patch.object(metrics, "Error_Backlog")
+
+    output = asyncio.run(metrics.send_notice_async(
+        notifier=notifier, url=error_url, notice=dict(notice),
+        headers=headers, retry_count=2, transport=Transport()))
+    assert isinstance(output["error"], CircuitOpenError)
+    backlog.append_stats.assert_called_once_with(
+        val=output, url=error_url, retry_count=2, retry_at=30)
 
 
 def test_send_json_loads(mocker, caplog):
     resp = MockResponse(resp_data=b'Gone', code=410)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -81,7 +123,7 @@ def test_send_json_loads(mocker, caplog):
 def test_send_return_message(mocker, caplog):
     resp = MockResponse(resp_data='{"message": "Message in data!"}'.encode("utf-8"), code=410)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -92,7 +134,7 @@ def test_send_return_message(mocker, caplog):
 def test_send_without_encode(mocker, caplog):
     resp = MockResponse(resp_data=b"\x81", code=410)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -103,19 +145,19 @@ def test_send_without_encode(mocker, caplog):
 def test_send_too_many_request(mocker, caplog):
     resp = MockResponse(resp_data="IOError", code=429)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
     assert metrics.send(url=route_url, payload=route_payload,
-                        headers=headers) is None
+                        headers=headers) is False
 
 
 def test_send_notice_unexpected_res(mocker, caplog):
     resp = MockResponse(resp_data='{"ID": "this id the ID"}'.encode(
         "utf-8"), code=200)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -127,7 +169,7 @@ def test_send_notice_unexpected_res(mocker, caplog):
 def test_send_notice_too_many_request(mocker, caplog):
     resp = MockResponse(resp_data="Too Many Request", code=429)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -139,7 +181,7 @@ def test_send_notice_too_many_request(mocker, caplog):
 def test_send_notice_backlog(mocker, caplog):
     resp = MockResponse(resp_data=b'Gone', code=410)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -152,7 +194,7 @@ def test_send_notice_backlog(mocker, caplog):
 def test_send_notice_unexpected(mocker, caplog):
     resp = MockResponse(resp_data=b'Gone', code=310)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -161,11 +203,21 @@ def test_send_notice_unexpected(mocker, caplog):
     assert str(output["error"]) == "airbrake: unexpected response status_code=310"
 
 
+def test_send_notice_too_large(mocker):
+    request = mocker.patch("pybrake.transport.Transport.request")
+
+    output = metrics.send_notice(notifier=notifier, url=error_url,
+                                 notice=dict(notifier=dict(name="x" * 70000)),
+                                 headers=headers)
+    assert isinstance(output["error"], NoticeTooLargeError)
+    request.assert_not_called()
+
+
 def test_send_notice_return_id(mocker, caplog):
     resp = MockResponse(resp_data='{"id": "this id the ID"}'.encode(
         "utf-8"), code=200)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -177,7 +229,7 @@ def test_send_notice_return_id(mocker, caplog):
 def test_send_notice_without_encode(mocker, caplog):
     resp = MockResponse(resp_data=b"\x81", code=410)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -190,7 +242,7 @@ def test_send_notice_without_encode(mocker, caplog):
 def test_send_notice_ioerror(mocker, caplog):
     resp = MockResponse(resp_data="IOError", code=200)
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
 
@@ -201,3 +253,271 @@ def test_send_notice_ioerror(mocker, caplog):
 
 metrics.APM_Backlog = None
 metrics.Error_Backlog = None
+
+
+def test_activated_metric_restores_previous():
+    outer = metrics.Metric()
+    inner = metrics.Metric()
+    with metrics.activated_metric(outer):
+        with metrics.activated_metric(inner):
+            assert metrics.get_active() is inner
+        assert metrics.get_active() is outer
+    assert metrics.get_active() is None
+
+
+def test_exit_metric_from_another_context():
+    token = metrics.enter_metric(metrics.Metric())
+    contextvars.copy_context().run(metrics.exit_metric, token)
+    metrics.exit_metric(token)
+    assert metrics.get_active() is None
+
+
+def test_active_metric_per_thread():
+    metric = metrics.Metric()
+    seen = []
+    with metrics.activated_metric(metric):
+        t = threading.Thread(target=lambda: seen.append(metrics.get_active()))
+        t.start()
+        t.join()
+    assert seen == [None]
+
+
+def test_active_metric_per_task():
+    async def handle(i):
+        metric = metrics.Metric()
+        token = metrics.enter_metric(metric)
+        try:
+            # Spans of interleaved requests land on their own metric.
+            for _ in range(3):
+                metrics.start_span(f"sql{i}")
+                await asyncio.sleep(0)
+                metrics.end_span(f"sql{i}")
+                assert metrics.get_active() is metric
+        finally:
+            metrics.exit_metric(token)
+        return metric
+
+    async def run():
+        return await asyncio.gather(*(handle(i) for i in range(100)))
+
+    for i, metric in enumerate(asyncio.run(run())):
+        assert list(metric._groups) == [f"sql{i}"]
+
+
+def test_enter_exit_metric_benchmark(benchmark):
+    benchmark.group = "active metric"
+    metric = metrics.Metric()
+
+    def run():
+        token = metrics.enter_metric(metric)
+        metrics.get_active()
+        metrics.exit_metric(token)
+
+    benchmark(run)
+
+
+@pytest.fixture
+def manual_clock():
+    clk = ManualClock(wall=1673352000.0, ns=10**12)
+    prev = clock.set_clock(clk)
+    yield clk
+    clock.set_clock(prev)
+
+
+def test_metric_durations_are_monotonic(manual_clock):
+    metric = RouteMetric(method="GET", route="/test")
+    metric.start_span("sql")
+    manual_clock.advance(0.05)
+    # NTP steps the wall clock back in the middle of the request.
+    manual_clock.set_wall_time(1673351990.0)
+    metric.start_span("template")
+    manual_clock.advance(0.02)
+    metric.end_span("template")
+    manual_clock.advance(0.01)
+    metric.end_span("sql")
+    manual_clock.advance(0.1)
+    metric.end()
+
+    assert metric.duration_ms() == pytest.approx(180)
+    assert metric._groups["sql"] == pytest.approx(60)
+    assert metric._groups["template"] == pytest.approx(20)
+    assert metric._groups["http.handler"] == pytest.approx(100)
+    # Wall time is only read once and end_time is derived from it.
+    assert metric.end_time == pytest.approx(1673352000.18)
+
+
+def test_metric_end_time_set_by_caller(manual_clock):
+    metric = metrics.Metric()
+    manual_clock.advance(1)
+    metric.end_time = metric.start_time + 0.25
+    assert metric.duration_ms() == pytest.approx(250)
+
+
+@pytest.fixture
+def span_tree():
+    metrics.set_span_tree(3)
+    yield
+    metrics.set_span_tree(0)
+
+
+def test_metric_span_tree(manual_clock, span_tree):
+    metric = RouteMetric(method="GET", route="/test")
+    for _ in range(2):
+        metric.start_span("template")
+        manual_clock.advance(0.01)
+        metric.start_span("sql")
+        manual_clock.advance(0.02)
+        metric.start_span("cache")
+        manual_clock.advance(0.005)
+        metric.end_span("cache")
+        metric.end_span("sql")
+        metric.end_span("template")
+    metric.start_span("sql")
+    manual_clock.advance(0.03)
+    metric.end_span("sql")
+    metric.end()
+
+    tree = {k: pytest.approx(v, abs=1e-3) for k, v in metric._tree.items()}
+    # Spans deeper than 3 levels are recorded as "other".
+    assert tree == {
+        ("http.handler", "template", "sql"): [2, 50, 40],
+        ("http.handler", "template", "other"): [2, 10, 10],
+        ("http.handler", "template"): [2, 70, 20],
+        ("http.handler", "sql"): [1, 30, 30],
+        ("http.handler",): [1, 100, 0],
+    }
+    # Groups still have the self time of every span name.
+    assert metric._groups["sql"] == pytest.approx(70)
+
+
+def test_metric_span_tree_disabled():
+    metric = _request()
+    assert metric._tree is None
+
+
+def test_metric_spans_benchmark(benchmark):
+    benchmark.group = "active metric"
+
+    def run():
+        metric = RouteMetric(method="GET", route="/test")
+        for _ in range(5):
+            metric.start_span("sql")
+            metric.end_span("sql")
+        metric.end()
+        return metric.duration_ms()
+
+    benchmark(run)
+
+
+def _request():
+    metric = RouteMetric(method="GET", route="/test")
+    for name in ("sql", "template", "sql", "cache"):
+        metric.start_span(name)
+        metric.end_span(name)
+    metric.status_code = 200
+    metric.content_type = "application/json"
+    metric.end()
+    return metric
+
+
+def _bytes_per_request(pooled, n=100):
+    metrics._metric_pools.clear()
+    if pooled:
+        for metric in [_request() for _ in range(n)]:
+            metric.release()
+
+    alive = []
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        for _ in range(n):
+            alive.append(_request())
+        used = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    return used / n
+
+
+def test_metric_release_reuses_objects():
+    metric = _request()
+    assert dict(metric._groups).keys() == {"http.handler", "sql",
+                                           "template", "cache"}
+    metric.release()
+    metric.release()  # released once only
+
+    reused = RouteMetric(method="POST", route="/other")
+    assert reused is metric
+    assert reused.method == "POST"
+    assert reused.end_time is None
+    assert list(reused._groups) == []
+    active = [name for name, span in reused._spans.items()
+              if not span._ended()]
+    assert active == ["http.handler"]
+    assert RouteMetric(method="GET") is not reused
+
+
+def test_released_metric_ignores_late_spans():
+    metrics._metric_pools.clear()
+
+    async def run():
+        late = asyncio.Event()
+        done = asyncio.Event()
+
+        async def background():
+            # Outlives the request, in a copy of its context.
+            await late.wait()
+            metrics.start_span("sql")
+            metrics.end_span("sql")
+            done.set()
+
+        metric_a = RouteMetric(method="GET", route="/a")
+        token = metrics.enter_metric(metric_a)
+        task = asyncio.ensure_future(background())
+        metric_a.end()
+        metric_a.release()
+        metrics.exit_metric(token)
+
+        metric_b = RouteMetric(method="GET", route="/b")
+        assert metric_b is metric_a
+        token = metrics.enter_metric(metric_b)
+        late.set()
+        await done.wait()
+        await task
+        metric_b.end()
+        metrics.exit_metric(token)
+        return metric_b
+
+    metric = asyncio.run(run())
+    assert "sql" not in metric._groups
+    assert metric.route == "/b"
+
+    metric.release()
+    metric.start_span("sql")
+    metric.end_span("sql")
+    assert "sql" not in metric._groups
+
+
+def test_metric_slots():
+    metric = RouteMetric(method="GET", route="/test")
+    with pytest.raises(AttributeError):
+        metric.foo = 1
+    # Groups can still be set to a plain dict.
+    metric._groups = {"redis": 24.0}
+    metric.release()
+    assert RouteMetric()._groups.get("redis") is None
+
+
+def test_metric_pool_allocations():
+    assert _bytes_per_request(True) < _bytes_per_request(False) / 2
+
+
+def test_metric_allocations_benchmark(benchmark):
+    benchmark.group = "metric allocations"
+    benchmark.extra_info["bytes_per_request"] = _bytes_per_request(True)
+    benchmark.extra_info["bytes_per_request_unpooled"] = \
+        _bytes_per_request(False)
+
+    def run():
+        _request().release()
+
+    benchmark(run)
@@ -1,7 +1,9 @@
 import collections
+import json
+
 import pytest
 
-from pybrake.notice import jsonify_notice
+from pybrake.notice import jsonify_notice, NoticeTooLargeError
 
 
 def make_defaultdict():
@@ -14,19 +16,19 @@ def make_defaultdict():
 @pytest.mark.parametrize(
     "param, wanted_size",
     [
-        (list(range(100000)), 558),
-        (set(range(100000)), 558),
-        ({i: i for i in range(100000)}, 1339),
-        ("x" * 100000, 1049),
-        (b"x" * 100000, 1049),
-        (bytearray([64] * 100000), 1049),
-        (bytearray([64] * 100000 + [128]), 1049),  # UnicodeDecodeError
-        (make_defaultdict(), 1339),
-        (collections.OrderedDict({i: i for i in range(100000)}), 1339),
-        (collections.UserDict({i: i for i in range(100000)}), 1339),
-        (collections.UserList(range(100000)), 558),
-        (collections.UserString("x" * 100000), 1049),
-        (collections.UserString(b"x" * 100000), 1049),
+        (list(range(100000)), 428),
+        (set(range(100000)), 428),
+        ({i: i for i in range(100000)}, 1082),
+        ("x" * 100000, 1047),
+        (b"x" * 100000, 1047),
+        (bytearray([64] * 100000), 1047),
+        (bytearray([64] * 100000 + [128]), 1047),  # UnicodeDecodeError
+        (make_defaultdict(), 1082),
+        (collections.OrderedDict({i: i for i in range(100000)}), 1082),
+        (collections.UserDict({i: i for i in range(100000)}), 1082),
+        (collections.UserList(range(100000)), 428),
+        (collections.UserString("x" * 100000), 1047),
+        (collections.UserString(b"x" * 100000), 1047),
     ],
 )
 def test_truncation(param, wanted_size):
@@ -41,3 +43,54 @@ def test_truncation_string():
 
     b = jsonify_notice(notice)
     assert len(b) == 2
+
+
+def make_large_notice():
+    return dict(
+        errors=[dict(type="ValueError", message="x" * 5000, backtrace=[])],
+        context=dict(url="http://localhost/", headers={
+            f"X-Header-{i}": "v" * 200 for i in range(100)}),
+        params=dict(form={f"field{i}": "é" * 2000 for i in range(200)}),
+        session=dict(user="admin"),
+        environment=dict(HOME="/root", LANG="en_US.UTF-8"),
+    )
+
+
+def test_truncation_shares_budget():
+    notice = make_large_notice()
+
+    b = jsonify_notice(notice)
+    assert len(b) < 64000
+    assert json.loads(b) == notice
+    assert notice["session"] == dict(user="admin")
+    assert notice["environment"]["HOME"] == "/root"
+    assert len(notice["errors"][0]["message"]) == 1024
+
+
+def test_jsonify_too_large_without_truncatable_keys():
+    notice = dict(errors=[], context={}, notifier=dict(name="x" * 70000))
+
+    with pytest.raises(NoticeTooLargeError):
+        jsonify_notice(notice)
+    assert notice["errors"] == []
+
+
+def test_jsonify_small_notice_is_unchanged():
+    notice = dict(errors=[dict(type="ValueError")], params={1: None, "a": b"b"})
+
+    assert jsonify_notice(notice) == json.dumps(
+        notice, default=lambda v: v.decode(), separators=(",", ":")
+    ).encode("utf8")
+
+
+def test_jsonify_benchmark_large_context(benchmark):
+    notice = make_large_notice()
+
+    benchmark.group = "jsonify_notice"
+    benchmark(jsonify_notice, notice)
+
+
+def test_jsonify_benchmark_large_fresh_context(benchmark):
+    benchmark.group = "jsonify_notice"
+    benchmark.pedantic(jsonify_notice, setup=lambda: ((make_large_notice(),), {}),
+                       rounds=50)
@@ -1,9 +1,19 @@
+import asyncio
+import os
 import re
+import signal
+import threading
+import time
 import warnings
 from urllib.error import URLError
 
+import pytest
+
+import pybrake.notifier as notifier_module
+from pybrake import metrics
 from pybrake.notifier import Notifier
 from pybrake.notice import jsonify_notice
+from pybrake.route_metric import RouteMetric
 from pybrake.utils import time_trunc_minute
 from .test_helper import (
     get_exception, get_nested_exception, get_exception_in_cython,
@@ -314,7 +324,7 @@ def test_rate_limited(mocker):
     resp = MockResponse(resp_data='{"message": "test"}'.encode("utf-8"),
                         code=429, headers={'X-RateLimit-Delay': 100})
     mocker.patch(
-        "urllib.request.urlopen",
+        "pybrake.transport.Transport.request",
         return_value=resp
     )
     notifier = Notifier()
@@ -359,3 +369,291 @@ def test_notifier_with_backlog(mocker):
     notifier._backlog.append_stats(data, notifier._ab_url)
 
     assert len(notifier._backlog._backlog) == 1
+
+
+def test_filter_ignore_notify_async():
+    notifier = Notifier()
+    notifier.add_filter(lambda notice: None)
+
+    notice = asyncio.run(notifier.notify_async("hello"))
+
+    assert notice["error"] == "notice is filtered out"
+
+
+def test_notify_async_return_id(mocker):
+    async def request(*args, **kwargs):
+        return MockResponse(resp_data=b'{"id": "1"}', code=201)
+
+    mocker.patch("pybrake.transport.AsyncTransport.request", new=request)
+    notifier = Notifier()
+
+    notice = asyncio.run(notifier.notify_async("hello"))
+
+    assert notice["id"] == "1"
+    assert notifier._async_in_flight == 0
+
+
+def test_spawn_async_keeps_task(mocker):
+    async def request(*args, **kwargs):
+        return MockResponse(resp_data=b'{"id": "1"}', code=201)
+
+    mocker.patch("pybrake.transport.AsyncTransport.request", new=request)
+    notifier = Notifier()
+
+    async def run():
+        task = notifier.spawn_async(notifier.notify_async("hello"))
+        assert notifier._async_tasks == {task}
+        return await task
+
+    assert asyncio.run(run())["id"] == "1"
+    assert notifier._async_tasks == set()
+
+
+def test_notify_async_queue_is_full():
+    notifier = Notifier(max_queue_size=0)
+
+    notice = asyncio.run(notifier.notify_async("hello"))
+
+    assert notice["error"] == "queue is full"
+
+
+def test_module_versions_cached():
+    versions = notifier_module.module_versions()
+    assert versions["python"]
+    assert versions["pytest"]
+    assert notifier_module.module_versions() is versions
+
+    notice = Notifier().build_notice("hello")
+    notice["context"]["versions"]["pytest"] = "[Filtered]"
+    assert versions["pytest"] != "[Filtered]"
+
+
+def test_build_notice_benchmark_uncached_versions(benchmark, monkeypatch):
+    notifier = Notifier()
+    err = get_exception()
+
+    def build_notice():
+        monkeypatch.setattr(notifier_module, "_versions_snapshot", (0, {}))
+        return notifier.build_notice(err)
+
+    benchmark.group = "build_notice"
+    benchmark(build_notice)
+
+
+def test_build_notice_benchmark_cached_versions(benchmark):
+    notifier = Notifier()
+    err = get_exception()
+
+    benchmark.group = "build_notice"
+    benchmark(notifier.build_notice, err)
+
+
+def test_deferred_notices(mocker):
+    notifier = Notifier(deferred_notices=True)
+    mocker.patch.object(notifier, "_send_notice_sync", side_effect=lambda n: n)
+    threads = []
+
+    def request_filter(notice):
+        threads.append(("request", threading.get_ident()))
+        notice["context"]["url"] = "/test"
+        notice["params"]["request"] = dict(password="secret")
+        return notice
+
+    def notice_filter(notice):
+        threads.append(("notice", threading.get_ident()))
+        return notice
+
+    notifier.add_filter(notice_filter)
+    notifier.add_request_filter(request_filter)
+
+    notice = notifier.notify(get_exception()).result()
+    notifier.close()
+
+    assert threads[0] == ("request", threading.get_ident())
+    assert threads[1][0] == "notice"
+    assert threads[1][1] != threading.get_ident()
+    assert notice["errors"][0]["type"] == "ValueError"
+    assert notice["context"]["url"] == "/test"
+    assert notice["context"]["versions"]
+    assert notice["params"]["request"] == {"password": "[Filtered]"}
+    assert notice["params"]["sys_executable"]
+
+
+def test_deferred_notices_from_str(mocker):
+    notifier = Notifier(deferred_notices=True)
+    mocker.patch.object(notifier, "_send_notice_sync", side_effect=lambda n: n)
+
+    notice = notifier.notify("hello").result()
+    notifier.close()
+
+    frame = notice["errors"][0]["backtrace"][0]
+    assert frame["file"] == "/PROJECT_ROOT/tests/test_notifier.py"
+    assert frame["function"] == "test_deferred_notices_from_str"
+
+
+def test_deferred_notices_request_filter_ignore():
+    notifier = Notifier(deferred_notices=True)
+    notifier.add_request_filter(lambda notice: None)
+
+    notice = notifier.notify(get_exception()).result()
+
+    assert notice["error"] == "notice is filtered out"
+
+
+def test_build_frame_cached():
+    notifier = Notifier()
+
+    notice1 = notifier.build_notice(get_exception())
+    notice2 = notifier.build_notice(get_exception())
+
+    frame = notice1["errors"][0]["backtrace"][0]
+    assert frame == notice2["errors"][0]["backtrace"][0]
+    assert frame is not notice2["errors"][0]["backtrace"][0]
+    assert frame["line"] == 7
+
+    # Frames belong to the notice, so changing them doesn't change the
+    # frames of other notices.
+    frame["file"] = "/tmp/file.py"
+    frame["code"][7] = "pass"
+    notice3 = notifier.build_notice(get_exception())
+    frame3 = notice3["errors"][0]["backtrace"][0]
+    assert frame3["file"] != "/tmp/file.py"
+    assert frame3["code"][7] != "pass"
+
+
+def test_filter_changes_cached_frames():
+    notifier = Notifier()
+
+    def rewrite_file(notice):
+        for error in notice["errors"]:
+            for frame in error["backtrace"]:
+                frame["file"] = "/app/" + frame["file"].rsplit("/", 1)[-1]
+        return notice
+
+    notifier.add_filter(rewrite_file)
+    for _ in range(2):
+        notice = notifier.build_notice(get_exception())
+        notice, ok = notifier._filter_notice(notice)
+        assert ok
+        assert notice["errors"][0]["backtrace"][0]["file"] == \
+            "/app/test_helper.py"
+
+
+def test_build_notice_benchmark_cached_frames(benchmark):
+    notifier = Notifier()
+    err = get_nested_exception()
+
+    benchmark.group = "build_notice"
+    benchmark(notifier.build_notice, err)
+
+
+def _notify_route(notifier):
+    metric = RouteMetric(method="GET", route="/test")
+    metric.status_code = 200
+    metric.end_time = time.time()
+    notifier.routes.notify(metric)
+
+
+def test_flush_sends_pending_stats(mocker):
+    send = mocker.patch("pybrake.metrics.send", return_value=True)
+    notifier = Notifier()
+    _notify_route(notifier)
+
+    report = notifier.flush(timeout=5)
+
+    assert report == dict(
+        dropped=dict(notices=0, routes=0, breakdowns=0, queries=0,
+                     queues=0),
+        backlogged=dict(routes=0, breakdowns=0, queries=0, queues=0),
+        timed_out=[],
+    )
+    assert send.call_count == 1
+    assert notifier.routes.stats._thread is None
+
+
+def test_flush_reports_dropped_stats(mocker):
+    mocker.patch("pybrake.metrics.send", return_value=False)
+    notifier = Notifier()
+    _notify_route(notifier)
+
+    report = notifier.flush(timeout=5)
+
+    assert report["dropped"]["routes"] == 1
+    assert report["backlogged"]["routes"] == 0
+
+
+def test_flush_reports_backlogged_stats(mocker):
+    mocker.patch("pybrake.metrics.send", return_value=metrics.BACKLOGGED)
+    notifier = Notifier()
+    _notify_route(notifier)
+
+    report = notifier.flush(timeout=5)
+
+    assert report["dropped"]["routes"] == 0
+    assert report["backlogged"]["routes"] == 1
+
+
+def test_close_sends_queued_notices(mocker):
+    notifier = Notifier()
+
+    def send(notice):
+        time.sleep(0.01)
+        notice["id"] = "1"
+        return notice
+
+    mocker.patch.object(notifier, "_send_notice_sync", side_effect=send)
+    futures_ = [notifier.notify("hello") for _ in range(10)]
+
+    report = notifier.close(timeout=5)
+
+    assert report["dropped"]["notices"] == 0
+    assert all(f.done() for f in futures_)
+    assert notifier.sender_stats()["sent"] == 10
+
+
+def test_close_timeout(mocker):
+    notifier = Notifier(max_workers=1)
+    release = threading.Event()
+
+    def send(notice):
+        release.wait(5)
+        return notice
+
+    mocker.patch.object(notifier, "_send_notice_sync", side_effect=send)
+    for _ in range(3):
+        notifier.notify("hello")
+
+    start = time.monotonic()
+    report = notifier.close(timeout=0.1)
+    release.set()
+
+    assert time.monotonic() - start < 1
+    assert report["dropped"]["notices"] == 3
+
+
+def test_close_on_sigterm(mocker):
+    prev = mocker.Mock()
+    old = signal.signal(signal.SIGTERM, prev)
+    try:
+        notifier = Notifier(close_on_sigterm=True, close_timeout=1)
+        close = mocker.patch.object(notifier, "close")
+
+        os.kill(os.getpid(), signal.SIGTERM)
+
+        close.assert_called_once_with(1)
+        assert prev.call_count == 1
+    finally:
+        signal.signal(signal.SIGTERM, old)
+
+
+def test_span_tree_depth_is_the_deepest_of_all_notifiers():
+    prev = metrics.get_span_tree()
+    metrics.set_span_tree(0)
+    try:
+        Notifier(span_tree=True, span_tree_max_depth=3)
+        Notifier(span_tree=True, span_tree_max_depth=2)
+        notifier = Notifier()
+        assert metrics.get_span_tree() == 3
+        assert not notifier.config["span_tree"]
+    finally:
+        metrics.set_span_tree(prev)
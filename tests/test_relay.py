@@ -0,0 +1,135 @@
+import threading
+import time
+
+import pytest
+
+from pybrake import serializer
+from pybrake.notifier import Notifier
+from pybrake.relay import Relay, RelayClient, bind_sockets, main
+
+ROUTE = dict(type="route", method="GET", route="/users/:id", status_code=200,
+             content_type="application/json", time=1673352000.5, ms=12.0,
+             groups=dict(sql=4.0))
+
+
+def _line(**msg):
+    return serializer.dumps(msg)
+
+
+@pytest.fixture
+def notifier(mocker):
+    for path in ("pybrake.routes.RouteStats", "pybrake.queries.QueryStats",
+                 "pybrake.queues.QueueStats",
+                 "pybrake.route_metric.RouteBreakdowns"):
+        mocker.patch(path + "._start_timer")
+    return Notifier(project_id=1, project_key="key",
+                    host="http://localhost:5000")
+
+
+def test_relay_aggregates_samples(notifier):
+    relay = Relay(notifier)
+    relay.ingest(b"\n".join([
+        _line(**ROUTE),
+        _line(**dict(ROUTE, ms=8.0)),
+        _line(type="query", query="SELECT 1", route="/users/:id",
+              time=1673352000.5, ms=1.5),
+        _line(type="queue", queue="mail", time=1673352000.5, ms=30.0,
+              groups=dict(sql=10.0)),
+        b'{"type": "unknown"}',
+        b"not json",
+    ]))
+
+    assert relay.stats() == dict(received=6, errors=2)
+
+    routes = notifier.routes.stats._shards.collect()
+    stat = next(iter(routes.values()))
+    assert (stat.method, stat.route, stat.count, stat.sum) == \
+        ("GET", "/users/:id", 2, 20.0)
+
+    breakdowns = notifier.routes.breakdowns._shards.collect()
+    groups = next(iter(breakdowns.values())).groups
+    assert groups["sql"].sum == 8.0
+    assert groups["http.handler"].sum == 12.0
+
+    queries = notifier.queries._shards.collect()
+    assert next(iter(queries.values())).sum == 1.5
+    queues = notifier.queues._shards.collect()
+    assert next(iter(queues.values())).groups["queue.handler"].sum == 20.0
+
+
+def test_relay_coalesces_notices(notifier, mocker):
+    send = mocker.patch.object(notifier, "send_notice")
+    relay = Relay(notifier, coalesce_window=60)
+    notice = dict(errors=[dict(type="KeyError", message="x", backtrace=[
+        dict(file="app.rb", line=10, function="show"),
+    ])], context={}, params={})
+
+    for _ in range(3):
+        relay.ingest(_line(type="notice", notice=notice))
+    send.assert_called_once()
+
+    send_sync = mocker.patch.object(notifier, "send_notice_sync",
+                                    return_value={"id": "1"})
+    assert relay._coalescer.flush() == 0
+    sent = send_sync.call_args[0][0]
+    assert sent["params"]["occurrences"]["count"] == 2
+    assert notice["params"] == {}
+
+
+def test_relay_serves_sockets(notifier, tmp_path):
+    path = str(tmp_path / "relay.sock")
+    socks = bind_sockets(path=path, udp="127.0.0.1:0")
+    port = socks[1].getsockname()[1]
+    relay = Relay(notifier)
+    stop = threading.Event()
+    thread = threading.Thread(target=relay.serve, args=(socks, stop))
+    thread.start()
+
+    clients = [RelayClient(path=path), RelayClient(udp=f"127.0.0.1:{port}")]
+    try:
+        for client in clients:
+            route = dict(ROUTE)
+            route.pop("type")
+            assert client.send("route", **route)
+        for _ in range(500):
+            if relay.received == 2:
+                break
+            stop.wait(0.01)
+    finally:
+        stop.set()
+        thread.join()
+        for sock in socks:
+            sock.close()
+        for client in clients:
+            client.close()
+
+    assert relay.stats() == dict(received=2, errors=0)
+
+
+def test_relay_client_drops_without_relay(tmp_path):
+    client = RelayClient(path=str(tmp_path / "missing.sock"))
+    assert not client.send("route", route="/", ms=1)
+    assert client.dropped == 1
+    client.close()
+
+
+def test_relay_requires_address():
+    with pytest.raises(SystemExit):
+        main([])
+
+
+@pytest.mark.parametrize("batch", [1, 50])
+def test_relay_ingest_benchmark(benchmark, notifier, batch):
+    benchmark.group = "relay ingest"
+    relay = Relay(notifier)
+    data = b"\n".join(_line(**dict(ROUTE, route=f"/r{i % 10}"))
+                      for i in range(batch))
+
+    start = time.perf_counter()
+    for _ in range(100):
+        relay.ingest(data)
+    benchmark.extra_info["samples_per_second"] = \
+        100 * batch / (time.perf_counter() - start)
+
+    benchmark(relay.ingest, data)
+    assert relay.errors == 0
@@ -22,7 +22,6 @@ def _test_setup(config: dict, status_code=200):
     metric = RouteMetric(method="GET", route="/test")
     metric.status_code = status_code
     metric.content_type = "application/json"
-    metric.FLUSH_PERIOD = 5
     metric._groups = {'route': 24.0, 'test': 0.4}
     metric.end_time = time.time()
 
@@ -127,3 +126,70 @@ def test_routes_ab_url():
     stats = RouteBreakdowns(**CONFIG)
     assert stats._ab_url() == \
            'http://localhost:5000/api/v5/projects/0/routes-breakdowns'
+
+
+def test_route_breakdown_span_tree():
+    stat = _RouteBreakdown(method="GET", route="/test",
+                           responseType="json", time=1648551580.0,
+                           max_width=2)
+    stat.add_span_tree({
+        ("http.handler",): [1, 100.0, 10.0],
+        ("http.handler", "sql"): [3, 30.0, 30.0],
+        ("http.handler", "template"): [1, 50.0, 40.0],
+        ("http.handler", "template", "sql"): [1, 10.0, 10.0],
+    })
+    # A third child of http.handler goes over the width.
+    stat.add_span_tree({
+        ("http.handler", "cache"): [2, 4.0, 4.0],
+        ("http.handler", "redis", "cache"): [1, 1.0, 1.0],
+        ("http.handler", "sql"): [1, 5.0, 5.0],
+    })
+
+    spans = stat.__dict__["spans"]
+    assert spans == {
+        "http.handler": dict(count=1, total=100.0, self=10.0),
+        "http.handler/sql": dict(count=4, total=35.0, self=35.0),
+        "http.handler/template": dict(count=1, total=50.0, self=40.0),
+        "http.handler/template/sql": dict(count=1, total=10.0, self=10.0),
+        "http.handler/other": dict(count=3, total=5.0, self=5.0),
+    }
+
+
+def test_route_breakdowns_notify_span_tree(mocker):
+    mocker.patch(
+        "pybrake.route_metric.RouteBreakdowns._start_timer",
+        return_value=None
+    )
+    metrics.set_span_tree(4)
+    try:
+        metric = RouteMetric(method="GET", route="/test", status_code=200,
+                             content_type="application/json")
+        metric.start_span("template")
+        metric.start_span("sql")
+        metric.end_span("sql")
+        metric.end_span("template")
+        metric.end()
+    finally:
+        metrics.set_span_tree(0)
+
+    breakdowns = RouteBreakdowns(config=dict(performance_stats=True))
+    breakdowns.notify(metric)
+    stat = next(iter(breakdowns._shards.collect().values()))
+    assert "spans" not in stat.__dict__
+
+    breakdowns = RouteBreakdowns(config=dict(performance_stats=True,
+                                             span_tree=True,
+                                             span_tree_max_depth=2))
+    breakdowns.notify(metric)
+    stat = next(iter(breakdowns._shards.collect().values()))
+    assert set(stat.__dict__["spans"]) == {
+        "http.handler", "http.handler/template", "http.handler/other",
+    }
+
+    breakdowns = RouteBreakdowns(config=dict(performance_stats=True,
+                                             span_tree=True))
+    breakdowns.notify(metric)
+    stat = next(iter(breakdowns._shards.collect().values()))
+    assert set(stat.__dict__["spans"]) == {
+        "http.handler", "http.handler/template", "http.handler/template/sql",
+    }
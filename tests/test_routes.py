@@ -5,6 +5,8 @@ from pybrake.route_metric import RouteMetric
 import pybrake.metrics as metrics
 from pybrake.routes import _Routes, RouteStats, RouteStat, route_stat_key
 
+from .test_helper import MockResponse
+
 metrics.FLUSH_PERIOD = 0
 CONFIG = {
     "config": {
@@ -21,7 +23,6 @@ def _test_setup(config: dict):
     metric = RouteMetric(method="GET", route="/test")
     metric.status_code = 200
     metric.content_type = "application/json"
-    metric.FLUSH_PERIOD = 5
     metric.end_time = time.time()
 
     key = route_stat_key(
@@ -71,7 +72,6 @@ def test_routes_notify(mocker):
     metric = RouteMetric(method="GET", route="/test")
     metric.status_code = 200
     metric.content_type = "application/json"
-    metric.FLUSH_PERIOD = 0
     metric.end_time = time.time()
     assert routes.notify(metric) == None
 
@@ -148,3 +148,32 @@ def test_routes_ab_url():
     stats = RouteStats(**CONFIG)
     assert stats._ab_url() == \
            'http://localhost:5000/api/v5/projects/0/routes-stats'
+
+
+def test_routes_kept_while_rate_limited(mocker):
+    request = mocker.patch(
+        "pybrake.transport.Transport.request",
+        return_value=MockResponse(b"", code=429,
+                                  headers={"X-RateLimit-Delay": "60"}),
+    )
+    routes = _test_setup(CONFIG)
+    stats = routes.stats
+
+    stats._flush()
+    assert request.call_count == 1
+    assert stats._thread is not None
+    stats._thread.cancel()
+    assert stats._thread.interval > 59
+
+    # New requests are aggregated with the stats that were not sent.
+    stat = next(iter(stats._stats.values()))
+    metric = RouteMetric(method="GET", route="/test")
+    metric.status_code = 200
+    metric.content_type = "application/json"
+    metric.end_time = time.time()
+    stats.notify(metric)
+
+    stats._flush()
+    assert request.call_count == 1
+    stats._thread.cancel()
+    assert sum(s.count for s in stats._stats.values()) == 2
@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+
+from pybrake.notifier import Notifier
+from pybrake.sender import Sender
+
+
+def _blocked_sender(**kwargs):
+    release = threading.Event()
+
+    def send(notice):
+        release.wait(5)
+        notice["id"] = "1"
+        return notice
+
+    sender = Sender(workers=1, **kwargs)
+    # Occupy the only worker so that the following notices stay queued.
+    sender.submit(send, {})
+    while sender.qsize():
+        pass
+    return sender, send, release
+
+
+def test_sender_drop_newest():
+    sender, send, release = _blocked_sender(max_queue_size=2)
+
+    futures = [sender.submit(send, {"n": i}) for i in range(4)]
+    release.set()
+    sender.shutdown()
+
+    assert [f.result().get("error") for f in futures] == [
+        None, None, "queue is full", "queue is full"]
+    assert sender.stats() == dict(
+        enqueued=3, dropped=2, sent=3, failed=0, queued=0)
+
+
+def test_sender_drop_oldest():
+    sender, send, release = _blocked_sender(max_queue_size=2,
+                                            drop_policy="drop_oldest")
+
+    futures = [sender.submit(send, {"n": i}) for i in range(4)]
+    release.set()
+    sender.shutdown()
+
+    assert [f.result().get("error") for f in futures] == [
+        "queue is full", "queue is full", None, None]
+    assert sender.stats()["dropped"] == 2
+
+
+def test_sender_block_timeout():
+    sender, send, release = _blocked_sender(max_queue_size=1,
+                                            drop_policy="block",
+                                            block_timeout=0.01)
+
+    f1 = sender.submit(send, {})
+    f2 = sender.submit(send, {})
+    release.set()
+    sender.shutdown()
+
+    assert "error" not in f1.result()
+    assert f2.result()["error"] == "queue is full"
+
+
+def test_sender_without_future():
+    sender = Sender()
+    done = threading.Event()
+
+    assert sender.submit(lambda notice: done.set() or notice, {},
+                         future=False) is None
+    assert done.wait(5)
+    sender.shutdown()
+    assert sender.stats()["sent"] == 1
+
+
+def test_sender_unknown_drop_policy():
+    with pytest.raises(ValueError, match="unknown drop policy"):
+        Sender(drop_policy="unknown")
+
+
+def test_notify_without_future(mocker):
+    notifier = Notifier()
+    send = mocker.patch.object(notifier, "_send_notice_sync",
+                               side_effect=lambda n: n)
+
+    assert notifier.notify("hello", future=False) is None
+    notifier.close()
+
+    assert send.call_count == 1
+    assert notifier.sender_stats()["sent"] == 1
+
+
+def test_sender_flush():
+    sender, send, release = _blocked_sender()
+    sender.submit(send, {})
+
+    assert sender.flush(timeout=0.01) == 2
+    release.set()
+    assert sender.flush(timeout=5) == 0
+    assert sender.stats()["sent"] == 2
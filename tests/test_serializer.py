@@ -0,0 +1,135 @@
+import collections
+import datetime
+import decimal
+import enum
+import json
+import math
+
+import pytest
+
+from pybrake import serializer
+from pybrake.notice import jsonify_notice
+from pybrake.notifier import Notifier
+
+from .test_helper import get_exception
+from .test_notice import make_large_notice
+
+BACKENDS = serializer.available_backends()
+
+PAYLOADS = [
+    dict(routes=[dict(
+        method="GET", route="/test", statusCode=200, time="2023-01-10T12:00:00Z",
+        count=10, sum=12.5, sumsq=31.25, tdigest="AAAAAkAkAAAAAAAAAAAAATvLIAAB",
+    )]),
+    dict(params={1: None, 2.5: True, "set": {1}, "bytes": b"\xffx"}),
+    dict(context=dict(url="http://localhost/é/😀", headers={"X": "\n\t\"\\\x01"})),
+    dict(session=collections.OrderedDict(a=collections.UserDict(b=1))),
+    dict(environment=dict(now=datetime.datetime(2023, 1, 10, 12, 0))),
+    dict(params=dict(big=2**70, surrogate="\ud800")),
+]
+
+
+
+class Color(enum.Enum):
+    RED = 1
+
+
+class Size(enum.IntEnum):
+    LARGE = 2
+
+
+EDGE_CASES = [
+    (dict(nan=math.nan, inf=[math.inf, -math.inf]),
+     b'{"nan":null,"inf":[null,null]}'),
+    (dict(color=Color.RED, size=Size.LARGE), b'{"color":1,"size":2}'),
+    ({Size.LARGE: 2}, b'{"2":2}'),
+    (dict(d=decimal.Decimal("1.10"), nan=decimal.Decimal("NaN")),
+     b'{"d":1.1,"nan":null}'),
+    ({(1, 2): 3, 1: {(4,): math.nan}}, b'{"(1, 2)":3,"1":{"(4,)":null}}'),
+    (dict(s={math.inf}), b'{"s":[null]}'),
+]
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+@pytest.mark.parametrize("payload,want", EDGE_CASES)
+def test_backends_agree_on_edge_cases(name, payload, want):
+    got = serializer.get_backend(name).dumps(payload)
+    assert got == want
+    json.loads(got)
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_backends_reject_circular_references(name):
+    payload = []
+    payload.append(payload)
+    with pytest.raises(ValueError):
+        serializer.get_backend(name).dumps(payload)
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_backends_are_byte_compatible(name, payload):
+    want = serializer.get_backend("json").dumps(payload)
+
+    assert serializer.get_backend(name).dumps(payload) == want
+    assert json.loads(want) == json.loads(json.dumps(
+        payload, default=serializer._default))
+
+
+def _notice_with_code_hunks():
+    notice = Notifier().build_notice(get_exception())
+    assert all(isinstance(line, int)
+               for line in notice["errors"][0]["backtrace"][0]["code"])
+    return notice
+
+
+@pytest.mark.skipif("orjson" not in BACKENDS, reason="orjson is not installed")
+def test_orjson_encodes_int_keys(mocker):
+    notice = _notice_with_code_hunks()
+    backend = serializer.get_backend("orjson")
+    fallback = mocker.spy(backend._fallback, "dumps")
+
+    got = backend.dumps(notice)
+    fallback.assert_not_called()
+    assert got == serializer.get_backend("json").dumps(notice)
+
+
+def test_set_backend():
+    prev = serializer.backend
+    try:
+        serializer.set_backend("json")
+        assert serializer.dumps(dict(a=[1])) == b'{"a":[1]}'
+
+        with pytest.raises(ValueError):
+            serializer.set_backend("unknown")
+    finally:
+        serializer.backend = prev
+
+
+def test_default_backend_is_fastest_available():
+    assert serializer.get_backend().name == BACKENDS[0]
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_benchmark_jsonify_notice(benchmark, name, monkeypatch):
+    monkeypatch.setattr(serializer, "backend", serializer.get_backend(name))
+    notice = make_large_notice()
+    notice["params"] = dict(user=dict(id=1, roles={"admin", "dev"}))
+    notice["errors"] = _notice_with_code_hunks()["errors"]
+
+    benchmark.group = "serializer notice"
+    benchmark(jsonify_notice, notice)
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_benchmark_route_stats(benchmark, name):
+    backend = serializer.get_backend(name)
+    payload = dict(routes=[
+        dict(method="GET", route=f"/api/v1/items/{i}", statusCode=200,
+             time="2023-01-10T12:00:00Z", count=i, sum=i * 1.5,
+             sumsq=i * 2.25, tdigest="AAAAAkAkAAAAAAAAAAAAATvLIAAB")
+        for i in range(1000)
+    ])
+
+    benchmark.group = "serializer stats"
+    benchmark(backend.dumps, payload)
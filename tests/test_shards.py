@@ -0,0 +1,128 @@
+import threading
+
+import pytest
+
+from pybrake.queries import QueryStats
+from pybrake.shards import StatShards
+from pybrake.tdigest import TDigestStat
+
+THREADS = 32
+QUERIES = 200
+
+CONFIG = {
+    "config": {
+        "performance_stats": True,
+        "query_stats": True,
+        "apm_host": "http://localhost:5000",
+    }
+}
+
+
+def _run_threads(target, n=THREADS):
+    start = threading.Barrier(n)
+
+    def run():
+        start.wait()
+        target()
+
+    threads = [threading.Thread(target=run) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def _add(shards, key, ms):
+    shard = shards.get()
+    with shard.lock:
+        stat = shard.stats.get(key)
+        if stat is None:
+            stat = TDigestStat()
+            shard.stats[key] = stat
+        stat.add(ms)
+
+
+def test_shards_merged_on_collect():
+    shards = StatShards()
+
+    def run():
+        for i in range(100):
+            _add(shards, i % 3, i)
+
+    _run_threads(run, n=4)
+
+    stats = shards.collect()
+    assert sorted(stats) == [0, 1, 2]
+    assert sum(s.count for s in stats.values()) == 400
+    assert sum(s.sum for s in stats.values()) == 4 * sum(range(100))
+    assert sum(len(s.td) > 0 for s in stats.values()) == 3
+    # The shards are emptied and those of exited threads are dropped.
+    assert shards.collect() == {}
+    assert len(shards) == 0
+
+
+def test_shards_collect_into_pending():
+    shards = StatShards()
+    _add(shards, "a", 10)
+
+    pending = TDigestStat()
+    pending.add(20)
+    stats = shards.collect({"a": pending})
+
+    assert stats["a"] is pending
+    assert pending.count == 2
+    assert pending.sum == 30
+
+
+def test_query_stats_from_many_threads(mocker):
+    mocker.patch("pybrake.queries.QueryStats._start_timer")
+    send = mocker.patch("pybrake.queries.QueryStats._send", return_value=True)
+    stats = QueryStats(**CONFIG)
+    _run_threads(lambda: _notify_queries(stats))
+
+    assert stats.flush() == (0, 0)
+    sent = send.call_args[0][0]
+    assert len(sent) == 1
+    assert next(iter(sent.values())).count == THREADS * QUERIES
+
+
+def _notify_queries(stats):
+    for _ in range(QUERIES):
+        stats.notify(query="SELECT 1", method="GET", route="/",
+                     start_time=1673352000.0, duration_ms=1.5)
+
+
+def test_query_stats_timer_after_flush_race(mocker):
+    stats = QueryStats(**CONFIG)
+    mocker.patch.object(stats, "_start_timer",
+                        side_effect=lambda: setattr(stats, "_thread", object()))
+    get = stats._shards.get
+
+    def get_after_flush():
+        # The timer flushes between the timer check and the insert.
+        with stats._lock:
+            stats._thread = None
+        return get()
+
+    mocker.patch.object(stats._shards, "get", side_effect=get_after_flush)
+    stats.notify(query="SELECT 1", method="GET", route="/",
+            start_time=1673352000.0, duration_ms=1.5)
+
+    # The stat is in a shard, so a timer must be left to send it.
+    assert stats._thread is not None
+
+
+@pytest.mark.parametrize("sharded", [True, False],
+                         ids=["sharded", "shared-lock"])
+def test_query_stats_contention_benchmark(benchmark, mocker, sharded):
+    benchmark.group = "stats contention"
+    mocker.patch("pybrake.queries.QueryStats._start_timer")
+    stats = QueryStats(**CONFIG)
+    if not sharded:
+        # All threads use one shard, like the previous global lock.
+        shard = stats._shards.get()
+        mocker.patch.object(stats._shards, "get", return_value=shard)
+
+    benchmark.extra_info["threads"] = THREADS
+    benchmark.pedantic(_run_threads, args=(lambda: _notify_queries(stats),),
+                       rounds=5)
@@ -0,0 +1,77 @@
+import os
+
+from pybrake.backlog import make_spool
+from pybrake.spool import Spool
+
+
+def _item(i, data=None):
+    return dict(retry_count=0, url=f"http://localhost/{i}",
+                data=data if data is not None else dict(n=i))
+
+
+def test_spool_fifo(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=100)
+    for i in range(10):
+        spool.append(_item(i))
+
+    assert len(spool) == 10
+    assert [spool.popleft()["data"]["n"] for _ in range(10)] == list(range(10))
+    assert len(spool) == 0
+    assert spool.stats()["segments"] == 1
+
+
+def test_spool_keeps_bytes_payloads(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(_item(0, b'{"routes":[]}'))
+
+    assert spool.popleft()["data"] == b'{"routes":[]}'
+
+
+def test_spool_replays_after_restart(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=100)
+    for i in range(5):
+        spool.append(_item(i))
+    spool.popleft()
+    spool.close()
+
+    spool = Spool(str(tmp_path), segment_bytes=100)
+    assert len(spool) == 4
+    assert [spool.popleft()["data"]["n"] for _ in range(4)] == [1, 2, 3, 4]
+
+    spool.append(_item(5))
+    assert spool.popleft()["data"]["n"] == 5
+
+
+def test_spool_discards_torn_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(_item(0))
+    spool.append(_item(1))
+    spool.close()
+
+    segment = os.path.join(tmp_path, "0000000000.seg")
+    size = os.path.getsize(segment)
+    with open(segment, "r+b") as f:
+        f.truncate(size - 3)
+
+    spool = Spool(str(tmp_path))
+    assert len(spool) == 1
+    assert spool.stats()["corrupted"] == 1
+    assert spool.popleft()["data"]["n"] == 0
+
+    spool.append(_item(2))
+    assert spool.popleft()["data"]["n"] == 2
+
+
+def test_spool_drops_oldest_segments(tmp_path):
+    spool = Spool(str(tmp_path), max_bytes=1000, segment_bytes=200)
+    for i in range(50):
+        spool.append(_item(i))
+
+    stats = spool.stats()
+    assert stats["bytes"] <= 1000
+    assert stats["dropped"] == 50 - len(spool)
+    assert spool.popleft()["data"]["n"] == stats["dropped"]
+
+
+def test_make_spool_without_dir():
+    assert make_spool(dict(), "apm") is None
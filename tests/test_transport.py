@@ -0,0 +1,247 @@
+import asyncio
+import gzip
+import http.client
+import threading
+import zlib
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from pybrake.circuit import CircuitBreaker, CircuitOpenError
+from pybrake.transport import AsyncTransport, Transport, _HostPool
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Content-Encoding",
+                         self.headers.get("Content-Encoding", "identity"))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_transport_reuses_connection(server_url):
+    transport = Transport()
+
+    for i in range(5):
+        resp = transport.request(server_url + "/api", data=b'{"i": %d}' % i,
+                                 method="POST")
+        assert resp.code == 201
+        assert resp.read() == b'{"i": %d}' % i
+
+    stats = transport.stats()
+    assert stats["requests"] == 5
+    assert stats["connections_created"] == 1
+    assert stats["connections_reused"] == 4
+    assert stats["hosts"][server_url]["connections_idle"] == 1
+
+    transport.close()
+    assert transport.stats()["connections_idle"] == 0
+
+
+def test_transport_bounded_connections(server_url):
+    transport = Transport(max_connections=2)
+
+    threads = [
+        threading.Thread(
+            target=transport.request,
+            args=(server_url,), kwargs=dict(data=b"{}"),
+        )
+        for _ in range(10)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    stats = transport.stats()
+    assert stats["requests"] == 10
+    assert stats["connections_created"] <= 2
+
+
+def test_transport_connection_error():
+    transport = Transport(timeout=1)
+
+    with pytest.raises(urllib.error.URLError) as exc_info:
+        transport.request("http://127.0.0.1:1/api", data=b"{}")
+
+    assert type(exc_info.value) is urllib.error.URLError
+    assert isinstance(exc_info.value.reason, OSError)
+    assert transport.stats()["errors"] == 1
+
+
+def test_transport_https_through_http_proxy(monkeypatch):
+    monkeypatch.setenv("https_proxy", "http://proxy.local:3128")
+    monkeypatch.delenv("no_proxy", raising=False)
+    pool = _HostPool("https", "api.airbrake.io", max_connections=1,
+                     timeout=1)
+
+    conn = pool.new_connection()
+    assert isinstance(conn, http.client.HTTPSConnection)
+    assert (conn.host, conn.port) == ("proxy.local", 3128)
+    assert conn._tunnel_host == "api.airbrake.io"
+
+
+def test_transport_circuit_breaker(mocker):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    transport = Transport(timeout=1, circuit_breaker=breaker)
+    url = "http://127.0.0.1:1/api"
+
+    for _ in range(2):
+        with pytest.raises(urllib.error.URLError):
+            transport.request(url, data=b"{}")
+
+    roundtrip = mocker.patch("pybrake.transport._roundtrip")
+    with pytest.raises(CircuitOpenError):
+        transport.request(url, data=b"{}")
+    roundtrip.assert_not_called()
+
+    stats = transport.stats()
+    assert stats["errors"] == 2
+    assert stats["circuits"]["http://127.0.0.1:1"]["state"] == "open"
+
+
+def test_transport_local_errors_are_not_host_failures(mocker):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    transport = Transport(max_connections=1, timeout=0.01,
+                          circuit_breaker=breaker)
+    url = "http://127.0.0.1:1/api"
+
+    mocker.patch("pybrake.transport._roundtrip",
+                 side_effect=KeyboardInterrupt)
+    with pytest.raises(KeyboardInterrupt):
+        transport.request(url, data=b"{}")
+
+    # The connection was returned to the pool.
+    pool = transport._get_pool("http", "127.0.0.1:1")
+    pool.acquire()
+    with pytest.raises(urllib.error.URLError, match="exhausted"):
+        transport.request(url, data=b"{}")
+
+    assert breaker.stats() == {}
+
+
+def test_async_transport_cancelled_request(mocker):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    transport = AsyncTransport(circuit_breaker=breaker)
+
+    async def hang(*args, **kwargs):
+        await asyncio.sleep(60)
+
+    mocker.patch("pybrake.transport._async_roundtrip", new=hang)
+    mocker.patch("pybrake.transport._AsyncHostPool.open",
+                 return_value=(mocker.Mock(), mocker.Mock(), False))
+
+    async def run():
+        task = asyncio.ensure_future(
+            transport.request("http://127.0.0.1:1/api", data=b"{}"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert breaker.stats() == {}
+
+
+def test_async_transport_reuses_connection(server_url):
+    transport = AsyncTransport()
+
+    async def run():
+        codes = []
+        for i in range(3):
+            resp = await transport.request(
+                server_url + "/api", data=b'{"i": %d}' % i, method="POST")
+            codes.append((resp.code, resp.read()))
+        return codes, transport.stats()
+
+    codes, stats = asyncio.run(run())
+    assert codes == [(201, b'{"i": %d}' % i) for i in range(3)]
+    assert stats["requests"] == 3
+    assert stats["connections_created"] == 1
+    assert stats["connections_reused"] == 2
+
+
+def test_async_transport_connection_error():
+    transport = AsyncTransport(timeout=1)
+
+    async def run():
+        with pytest.raises(urllib.error.URLError):
+            await transport.request("http://127.0.0.1:1/api", data=b"{}")
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("compression, decompress", [
+    ("gzip", gzip.decompress),
+    ("deflate", zlib.decompress),
+])
+def test_transport_compression(server_url, compression, decompress):
+    transport = Transport(compression=compression, compression_threshold=100)
+    small = b'{"a": 1}'
+    large = b'{"sql": "%s"}' % (b"SELECT * FROM users WHERE id = ?; " * 100)
+
+    resp = transport.request(server_url, data=small)
+    assert resp.headers["X-Content-Encoding"] == "identity"
+    assert resp.read() == small
+
+    resp = transport.request(server_url, data=large)
+    assert resp.headers["X-Content-Encoding"] == compression
+    assert decompress(resp.read()) == large
+
+    stats = transport.stats()
+    assert stats["requests_compressed"] == 1
+    assert stats["payload_bytes"] == len(small) + len(large)
+    assert stats["sent_bytes"] < len(large) / 10
+    assert stats["compression_ratio"] < 0.1
+
+
+def test_transport_unknown_compression():
+    with pytest.raises(ValueError):
+        Transport(compression="br")
+
+
+def test_async_transport_compression(server_url):
+    transport = AsyncTransport(compression="gzip", compression_threshold=10)
+    data = b'{"param": "%s"}' % (b"x" * 1000)
+
+    async def run():
+        resp = await transport.request(server_url, data=data)
+        return resp.headers["X-Content-Encoding"], resp.read()
+
+    encoding, body = asyncio.run(run())
+    assert encoding == "gzip"
+    assert gzip.decompress(body) == data
+    assert transport.stats()["requests_compressed"] == 1
+
+
+def test_compression_benchmark(benchmark):
+    transport = Transport(compression="gzip")
+    stats = b", ".join(
+        b'{"method": "GET", "route": "/api/%d", "statusCode": 200, '
+        b'"tdigest": "AAAAAkAkAAAAAAAAAAAAATvLIAAB"}' % i
+        for i in range(1000)
+    )
+
+    benchmark.group = "compression"
+    benchmark(transport.compressor.compress, stats, {})